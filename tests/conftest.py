@@ -85,6 +85,28 @@ def mocked_conn():
     return create_mocked_connection()
 
 
+# a scratch postgres database, its public schema is dropped by tests using it
+TEST_DATABASE_URL = os.environ.get('YO_TEST_DATABASE_URL')
+
+
+@pytest.fixture
+async def migrated_pool():
+    if TEST_DATABASE_URL is None:
+        pytest.skip('YO_TEST_DATABASE_URL is not set')
+    import sqlalchemy as sa
+    from yo.db import create_asyncpg_pool
+    from yo.db.migrations import migrate
+    engine = sa.create_engine(TEST_DATABASE_URL)
+    with engine.begin() as conn:
+        conn.execute('DROP SCHEMA public CASCADE')
+        conn.execute('CREATE SCHEMA public')
+    engine.dispose()
+    migrate(TEST_DATABASE_URL)
+    pool = await create_asyncpg_pool(TEST_DATABASE_URL, max_size=10)
+    yield pool
+    await pool.close()
+
+
 @pytest.fixture
 def mocked_rpc_client_session():
     return create_mocked_aiohttp_client_session()
@@ -54,7 +54,7 @@ async def test_rate_limited(mocked_pool):
     mocked_pool.fetchval.return_value = 1
     result = await mark_rate_limited(mocked_pool, 123, 'test_username', TransportType.email)
     assert result == 1
-    mocked_pool.fetchval.assert_called_once_with(yo.db.actions.INSERT_ACTION_STMT,
+    mocked_pool.fetchval.assert_called_once_with(yo.db.actions.RATE_LIMITED_ACTION_STMT,
         123,  # nid
         'test_username',  # username
         TransportType.email,  # transport
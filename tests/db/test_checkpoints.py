@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+import yo.db.checkpoints
+from yo.db.checkpoints import FOLLOWER_CHECKPOINT
+from yo.db.checkpoints import get_checkpoint
+from yo.db.checkpoints import set_checkpoint
+
+
+@pytest.mark.asyncio
+async def test_get_checkpoint(mocked_pool):
+    mocked_pool.fetchval.return_value = 20000000
+    result = await get_checkpoint(mocked_pool)
+    assert result == 20000000
+    mocked_pool.fetchval.assert_called_once_with(yo.db.checkpoints.GET_CHECKPOINT_STMT,
+                                                 FOLLOWER_CHECKPOINT)
+
+
+@pytest.mark.asyncio
+async def test_set_checkpoint(mocked_pool):
+    await set_checkpoint(mocked_pool, 'backfill/1-10', 5)
+    mocked_pool.execute.assert_called_once_with(yo.db.checkpoints.SET_CHECKPOINT_STMT,
+                                                'backfill/1-10',
+                                                5)
@@ -1,5 +1,16 @@
 # -*- coding: utf-8 -*-
+import asyncio
 
+import pytest
+
+from yo.db.desktop import create_desktop_notification
+
+from yo.db.desktop import deliver_batch
+from yo.db.desktop import DELIVER_BATCH_STMT
+from yo.db.desktop import _feed_query
+from yo.db.desktop import get_counts
+from yo.db.desktop import reconcile_counts
+from yo.db.desktop import RECONCILE_COUNTS_STMT
 from yo.db.desktop import get_user_desktop_notifications
 from yo.db.desktop import mark_shown
 from yo.db.desktop import mark_read
@@ -10,6 +21,20 @@ from yo.db.desktop import mark_unread
 def test_get_user_desktop_notifications():
     pass
 
+def test_feed_query():
+    stmt, args = _feed_query('test_user')
+    assert args == ['test_user']
+    assert 'WHERE to_username = $1\n' in stmt
+    assert 'LIMIT 30' in stmt
+
+    stmt, args = _feed_query('test_user', created_before='c', before_dnid=5,
+                             read=True, notify_types=[1, 2], limit=1000)
+    assert args == ['test_user', 'c', 5, [1, 2]]
+    assert '(created, dnid) < ($2, $3)' in stmt
+    assert 'read IS NOT NULL' in stmt
+    assert 'notify_type = ANY($4::int[])' in stmt
+    assert 'LIMIT 100' in stmt
+
 def test_mark_shown():
     pass
 
@@ -21,3 +46,82 @@ def test_mark_unshown():
 
 def test_mark_unread():
     pass
+
+
+@pytest.mark.asyncio
+async def test_deliver_batch(mocked_pool):
+    rows = [{'dnid': 1, 'notify_type': 1, 'to_username': 'test_user'}]
+    mocked_pool.fetch.return_value = rows
+    assert await deliver_batch(mocked_pool, 100) == rows
+    mocked_pool.fetch.assert_called_once_with(DELIVER_BATCH_STMT, 100)
+
+
+@pytest.mark.asyncio
+async def test_get_counts(mocked_pool):
+    mocked_pool.fetchrow.return_value = {'unread': 3, 'unshown': 1}
+    assert await get_counts(mocked_pool, 'test_user') == {'unread': 3, 'unshown': 1}
+    mocked_pool.fetchrow.return_value = None
+    assert await get_counts(mocked_pool, 'test_user') == {'unread': 0, 'unshown': 0}
+
+
+@pytest.mark.asyncio
+async def test_reconcile_counts(mocked_pool):
+    mocked_pool.fetch.side_effect = [[{'username': 'b'}], []]
+    mocked_pool.fetchval.side_effect = ['m', None]
+    assert await reconcile_counts(mocked_pool, batch_size=2) == 1
+    mocked_pool.fetch.assert_any_call(RECONCILE_COUNTS_STMT, '', 2)
+    mocked_pool.fetch.assert_any_call(RECONCILE_COUNTS_STMT, 'm', 2)
+
+
+@pytest.mark.asyncio
+async def test_marks_adjust_counts(migrated_pool):
+    dnids = [await create_desktop_notification(migrated_pool, eid=f'e{i}', notify_type=9,
+                                               to_username=username, json_data='{}')
+             for i, username in enumerate(['user_a', 'user_a', 'user_b'])]
+    assert await get_counts(migrated_pool, 'user_a') == {'unread': 2, 'unshown': 2}
+
+    assert await mark_read(migrated_pool, 'user_a', dnids) == dnids[:2]
+    assert await mark_read(migrated_pool, 'user_b', dnids) == dnids[2:]
+    # already read, nothing changes
+    assert await mark_read(migrated_pool, 'user_a', dnids[:1]) == []
+    assert await mark_shown(migrated_pool, 'user_a', dnids[0]) == dnids[:1]
+    assert await get_counts(migrated_pool, 'user_a') == {'unread': 0, 'unshown': 1}
+    assert await get_counts(migrated_pool, 'user_b') == {'unread': 0, 'unshown': 1}
+
+    await mark_unread(migrated_pool, 'user_a', dnids[1:2])
+    await mark_unread(migrated_pool, 'user_b', dnids[2:])
+    await mark_unshown(migrated_pool, 'user_a', dnids[0])
+    assert await get_counts(migrated_pool, 'user_a') == {'unread': 1, 'unshown': 2}
+    assert await get_counts(migrated_pool, 'user_b') == {'unread': 1, 'unshown': 1}
+
+
+@pytest.mark.asyncio
+async def test_marks_leave_other_users_notifications(migrated_pool):
+    dnid = await create_desktop_notification(migrated_pool, eid='e', notify_type=9,
+                                             to_username='user_a', json_data='{}')
+    assert await mark_read(migrated_pool, 'user_b', [dnid]) == []
+    assert await mark_shown(migrated_pool, 'user_b', dnid) == []
+    assert await get_counts(migrated_pool, 'user_a') == {'unread': 1, 'unshown': 1}
+    assert await get_counts(migrated_pool, 'user_b') == {'unread': 0, 'unshown': 0}
+
+
+@pytest.mark.asyncio
+async def test_concurrent_marks_dont_deadlock(migrated_pool):
+    users = [f'user_{i}' for i in range(20)]
+    dnids = {username: [await create_desktop_notification(migrated_pool,
+                                                          eid=f'{username}_{i}',
+                                                          notify_type=9,
+                                                          to_username=username,
+                                                          json_data='{}')
+                        for i in range(5)]
+             for username in users}
+    # batches touching the same rows in opposite orders
+    for _ in range(10):
+        await asyncio.gather(*[mark(migrated_pool, username, ids)
+                               for username in users
+                               for mark, ids in [(mark_read, dnids[username]),
+                                                 (mark_unread, dnids[username][::-1]),
+                                                 (mark_shown, dnids[username][::-1]),
+                                                 (mark_unshown, dnids[username])]])
+    # every mark adjusted the counters it changed exactly once
+    assert await reconcile_counts(migrated_pool) == 0
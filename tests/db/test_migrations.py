@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+import os
+
+import pytest
+import sqlalchemy as sa
+
+from yo.db.migrations import MIGRATIONS
+from yo.db.migrations import migrate
+from yo.db.migrations import migration_name
+from yo.db.migrations import pending_migrations
+
+# a scratch postgres database, its public schema is dropped by these tests
+TEST_DATABASE_URL = os.environ.get('YO_TEST_DATABASE_URL')
+
+requires_postgres = pytest.mark.skipif(TEST_DATABASE_URL is None,
+                                       reason='YO_TEST_DATABASE_URL is not set')
+
+
+def test_migration_versions_are_unique_and_ordered():
+    versions = [m.version for m in MIGRATIONS]
+    assert versions == sorted(set(versions))
+    for migration in MIGRATIONS:
+        assert migration_name(migration).startswith(f'm{migration.version:04d}_')
+        assert migration.__doc__
+
+
+def test_pending_migrations():
+    assert pending_migrations(set()) == MIGRATIONS
+    assert pending_migrations({1}) == MIGRATIONS[1:]
+    assert pending_migrations(set(), target=1) == MIGRATIONS[:1]
+    assert pending_migrations({m.version for m in MIGRATIONS}) == []
+
+
+@pytest.fixture
+def baseline_engine():
+    engine = sa.create_engine(TEST_DATABASE_URL)
+    with engine.begin() as conn:
+        conn.execute('DROP SCHEMA public CASCADE')
+        conn.execute('CREATE SCHEMA public')
+    migrate(TEST_DATABASE_URL, target=1)
+    yield engine
+    engine.dispose()
+
+
+def _indexes(conn, table_name:str) -> set:
+    rows = conn.execute(sa.text('SELECT indexname FROM pg_indexes WHERE tablename = :name'),
+                        name=table_name)
+    return {row[0] for row in rows}
+
+
+def _partitions(conn, table_name:str) -> set:
+    rows = conn.execute(sa.text('''SELECT inhrelid::regclass::text FROM pg_inherits
+                                   WHERE inhparent = to_regclass(:name)'''),
+                        name=table_name)
+    return {row[0] for row in rows}
+
+
+@requires_postgres
+def test_upgrade_baseline_database(baseline_engine):
+    with baseline_engine.begin() as conn:
+        conn.execute('''INSERT INTO queue(data, transport, timestamp)
+                        VALUES ('{"nid": 1, "priority": 3}', 2, NOW())''')
+        conn.execute('''INSERT INTO queue(data, transport, timestamp)
+                        VALUES ('{"nid": 2}', NULL, NOW())''')
+        conn.execute('''INSERT INTO desktop(eid, notify_type, to_username, created)
+                        VALUES ('test_eid', 9, 'test_user', NOW())''')
+        conn.execute('''INSERT INTO notifications(eid, notify_type, to_username, created)
+                        VALUES ('test_eid', 9, 'test_user', NOW())''')
+
+    applied = migrate(TEST_DATABASE_URL)
+    assert applied == [m.version for m in MIGRATIONS[1:]]
+
+    with baseline_engine.connect() as conn:
+        relkind = conn.execute("SELECT relkind FROM pg_class WHERE relname = 'queue'").scalar()
+        assert relkind == 'p'
+        rows = conn.execute('SELECT qid, transport, priority, attempts FROM queue')
+        assert rows.fetchall() == [(1, 2, 3, 0)]
+        # new items don't reuse the copied qids
+        qid = conn.execute('''INSERT INTO queue(data, transport)
+                              VALUES ('{"nid": 3}', 1) RETURNING qid''').scalar()
+        assert qid > 1
+        counts = conn.execute('SELECT username, unread, unshown FROM desktop_counts')
+        assert counts.fetchall() == [('test_user', 1, 1)]
+        assert 'desktop_feed_ix' in _indexes(conn, 'desktop')
+        assert 'ix_desktop' not in _indexes(conn, 'desktop')
+        assert 'actions_rates_ix' in _indexes(conn, 'actions')
+        for table_name in ('notifications', 'actions', 'desktop'):
+            relkind = conn.execute(sa.text('SELECT relkind FROM pg_class WHERE relname = :name'),
+                                   name=table_name).scalar()
+            assert relkind == 'p'
+            partitions = _partitions(conn, table_name)
+            assert {f'{table_name}_legacy', f'{table_name}_default'} < partitions
+            # the legacy partition traded its own key for the partitioned one
+            pkeys = conn.execute(sa.text('''SELECT pg_get_constraintdef(oid) FROM pg_constraint
+                                            WHERE conrelid = to_regclass(:name)
+                                            AND contype = 'p' '''),
+                                 name=f'{table_name}_legacy')
+            assert [row[0].endswith(', created)') for row in pkeys] == [True]
+        # the old rows stay where they were, in the legacy partition
+        partition = conn.execute('SELECT tableoid::regclass::text FROM desktop').scalar()
+        assert partition == 'desktop_legacy'
+        desktop_triggers = conn.execute('''SELECT tgrelid::regclass::text FROM pg_trigger
+                                           WHERE tgname = 'desktop_inserted_trigger' ''')
+        assert desktop_triggers.fetchall() == [('desktop',)]
+        keys = conn.execute('SELECT eid, to_username FROM notification_keys')
+        assert keys.fetchall() == [('test_eid', 'test_user')]
+        trigger = conn.execute('''SELECT tgname FROM pg_trigger
+                                  WHERE tgrelid = 'users'::regclass AND NOT tgisinternal''')
+        assert trigger.fetchall() == [('users_changed_trigger',)]
+
+    assert migrate(TEST_DATABASE_URL) == []
@@ -1,13 +1,164 @@
 # -*- coding: utf-8 -*-
+import asyncio
+from datetime import datetime
 
+import pytest
 
+import yo.db.checkpoints
+import yo.db.notifications
 from yo.db.notifications import create_notification
+from yo.db.notifications import create_notifications
+from yo.db.notifications import create_block_notifications
 from yo.db.notifications import get_last_processed_block
+from yo.db.notifications import prune_notification_keys
+from yo.db.users import DEFAULT_USER_TRANSPORT_SETTINGS
+from yo.schema import NotificationType
+from yo.schema import Priority
+
+TEST_NOTIFICATION = {
+    'eid':           '20000000/1/0/0',
+    'notify_type':   NotificationType.vote,
+    'to_username':   'testuser1337',
+    'from_username': 'testuser1336',
+    'json_data':     '{}',
+    'priority':      Priority.low.value
+}
+
 
 def test_create_notification():
     pass
 
-def test_get_last_processed_block():
-    pass
+
+@pytest.mark.asyncio
+async def test_create_notifications(mocked_pool):
+    mocked_pool.fetch.return_value = [{'nid': 1}]
+    result = await create_notifications(mocked_pool, [TEST_NOTIFICATION])
+    assert result == [1]
+    mocked_pool.fetch.assert_called_once_with(
+        yo.db.notifications.CREATE_NOTIFICATIONS_STMT,
+        ['20000000/1/0/0'],
+        [NotificationType.vote.value],
+        ['testuser1337'],
+        ['testuser1336'],
+        ['{}'],
+        [Priority.low.value],
+        DEFAULT_USER_TRANSPORT_SETTINGS,
+        yo.db.notifications.NOTIFY_TYPE_NAMES,
+        yo.db.notifications.TRANSPORT_TYPE_NAMES,
+        True)
+
+
+@pytest.mark.asyncio
+async def test_create_notifications_default_priority(mocked_pool):
+    mocked_pool.fetch.return_value = [{'nid': 1}, {'nid': 2}]
+    result = await create_notifications(mocked_pool, [
+        dict(TEST_NOTIFICATION, priority=None),
+        dict(TEST_NOTIFICATION, eid='20000000/1/0/1', priority=Priority.always)])
+    assert result == [1, 2]
+    priorities = mocked_pool.fetch.call_args[0][6]
+    assert priorities == [Priority.normal.value, Priority.always.value]
+
+
+@pytest.mark.asyncio
+async def test_create_notifications_empty(mocked_pool):
+    result = await create_notifications(mocked_pool, [])
+    assert result == []
+    mocked_pool.fetch.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_create_notifications_error(mocked_pool):
+    mocked_pool.fetch.side_effect = Exception()
+    result = await create_notifications(mocked_pool, [TEST_NOTIFICATION])
+    assert result is None
+
+
+def test_notify_type_names():
+    for notify_type in NotificationType:
+        assert yo.db.notifications.NOTIFY_TYPE_NAMES[notify_type.value - 1] == notify_type.name
+
+
+@pytest.mark.asyncio
+async def test_create_block_notifications(mocked_pool):
+    mocked_conn = mocked_pool.acquire.return_value.__aenter__.return_value
+    mocked_conn.fetch.return_value = [{'nid': 1}]
+    result = await create_block_notifications(mocked_pool, [TEST_NOTIFICATION], 20000000)
+    assert result == [1]
+    mocked_conn.execute.assert_called_once_with(yo.db.checkpoints.SET_CHECKPOINT_STMT,
+                                                yo.db.checkpoints.FOLLOWER_CHECKPOINT,
+                                                20000000)
+
+
+@pytest.mark.asyncio
+async def test_get_last_processed_block(mocked_pool):
+    mocked_pool.fetchval.return_value = 20000000
+    result = await get_last_processed_block(mocked_pool)
+    assert result == 20000000
+    mocked_pool.fetchval.assert_called_once_with(yo.db.checkpoints.GET_CHECKPOINT_STMT,
+                                                 yo.db.checkpoints.FOLLOWER_CHECKPOINT)
+
+
+@pytest.mark.asyncio
+async def test_create_block_notifications_waits_outside_transaction(mocked_pool):
+    mocked_pool.fetch.return_value = [{'nid': 1}]
+    previous_write = asyncio.Future()
+    previous_write.set_result([])
+    result = await create_block_notifications(mocked_pool, [TEST_NOTIFICATION], 20000000,
+                                              before_checkpoint=previous_write)
+    assert result == [1]
+    mocked_pool.acquire.assert_not_called()
+    mocked_pool.execute.assert_called_once_with(yo.db.checkpoints.SET_CHECKPOINT_STMT,
+                                                yo.db.checkpoints.FOLLOWER_CHECKPOINT,
+                                                20000000)
+
+
+@pytest.mark.asyncio
+async def test_create_block_notifications_propagates_previous_failure(mocked_pool):
+    mocked_pool.fetch.return_value = [{'nid': 1}]
+    previous_write = asyncio.Future()
+    previous_write.set_exception(ValueError('previous window failed'))
+    with pytest.raises(ValueError):
+        await create_block_notifications(mocked_pool, [TEST_NOTIFICATION], 20000000,
+                                         before_checkpoint=previous_write)
+    mocked_pool.execute.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_prune_notification_keys(mocked_pool):
+    mocked_pool.execute.side_effect = ['DELETE 2', 'DELETE 1']
+    now = datetime(2018, 6, 20)
+    assert await prune_notification_keys(mocked_pool, 24, now=now, batch_size=2) == 3
+    mocked_pool.execute.assert_called_with(yo.db.notifications.PRUNE_NOTIFICATION_KEYS_STMT,
+                                           datetime(2016, 6, 1), 2)
+
+
+@pytest.mark.asyncio
+async def test_concurrent_duplicates_are_stored_once(migrated_pool):
+    duplicate = dict(TEST_NOTIFICATION, from_username='testuser1335')
+    batch = [TEST_NOTIFICATION, duplicate, dict(TEST_NOTIFICATION, eid=None)]
+    results = await asyncio.gather(*[create_notifications(migrated_pool, batch)
+                                     for _ in range(4)])
+    # one writer stores the keyed notification, every writer its unkeyed one
+    assert sorted(len(nids) for nids in results) == [1, 1, 1, 2]
+    rows = await migrated_pool.fetch(
+        'SELECT from_username FROM notifications WHERE eid = $1', TEST_NOTIFICATION['eid'])
+    assert [row['from_username'] for row in rows] == ['testuser1336']
+    # replaying the batch after the notification is gone stores nothing keyed
+    await migrated_pool.execute('DELETE FROM notifications')
+    assert len(await create_notifications(migrated_pool, batch)) == 1
+
+
+@pytest.mark.asyncio
+async def test_create_notification_without_priority(migrated_pool):
+    assert await create_notification(migrated_pool, **dict(TEST_NOTIFICATION, priority=None))
+    rows = await migrated_pool.fetch('SELECT priority FROM notifications')
+    assert [row['priority'] for row in rows] == [Priority.normal.value]
+    rows = await migrated_pool.fetch('SELECT priority FROM queue')
+    assert rows and all(row['priority'] == Priority.normal.value for row in rows)
 
 
+@pytest.mark.asyncio
+async def test_create_notifications_without_queueing(migrated_pool):
+    nids = await create_notifications(migrated_pool, [TEST_NOTIFICATION], queue=False)
+    assert len(nids) == 1
+    assert await migrated_pool.fetchval('SELECT COUNT(*) FROM queue') == 0
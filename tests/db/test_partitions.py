@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+from datetime import datetime
+
+import pytest
+
+from yo.db.partitions import MAINTENANCE_LOCK_KEY
+from yo.db.partitions import Partition
+from yo.db.partitions import UNLOCK_STMT
+from yo.db.partitions import add_months
+from yo.db.partitions import create_partition_stmt
+from yo.db.partitions import drop_expired_partitions
+from yo.db.partitions import expired_partitions
+from yo.db.partitions import maintain_partitions
+from yo.db.partitions import missing_months
+from yo.db.partitions import months_to_create
+from yo.db.partitions import parse_partition
+
+
+def test_months_wrap_years():
+    assert add_months(datetime(2018, 11, 1), 3) == datetime(2019, 2, 1)
+    assert add_months(datetime(2018, 1, 1), -1) == datetime(2017, 12, 1)
+    assert months_to_create(datetime(2018, 12, 15), 1) == [datetime(2018, 12, 1),
+                                                           datetime(2019, 1, 1)]
+
+
+def test_create_partition_stmt():
+    stmt = create_partition_stmt('actions', datetime(2018, 12, 15, 10))
+    assert 'actions_y2018m12 PARTITION OF actions' in stmt
+    assert "FROM ('2018-12-01T00:00:00') TO ('2019-01-01T00:00:00')" in stmt
+
+
+def test_parse_partition():
+    assert parse_partition('actions_default', 'DEFAULT') == Partition('actions_default',
+                                                                      None, None, True)
+    partition = parse_partition(
+        'actions_legacy', "FOR VALUES FROM (MINVALUE) TO ('2018-08-01 00:00:00')")
+    assert partition == Partition('actions_legacy', datetime.min, datetime(2018, 8, 1), False)
+    partition = parse_partition(
+        'actions_y2018m08', "FOR VALUES FROM ('2018-08-01 00:00:00') TO ('2018-09-01 00:00:00')")
+    assert partition.lower == datetime(2018, 8, 1)
+    assert partition.upper == datetime(2018, 9, 1)
+
+
+def _monthly(table_name:str, year:int, month:int) -> Partition:
+    start = datetime(year, month, 1)
+    return Partition(f'{table_name}_y{year:04d}m{month:02d}', start, add_months(start, 1), False)
+
+
+def test_missing_months_skips_covered_ranges():
+    partitions = [Partition('actions_legacy', datetime.min, datetime(2018, 7, 1), False),
+                  Partition('actions_default', None, None, True),
+                  _monthly('actions', 2018, 8)]
+    assert missing_months(partitions, datetime(2018, 6, 20), 3) == [datetime(2018, 7, 1),
+                                                                    datetime(2018, 9, 1)]
+
+
+def test_expired_partitions():
+    partitions = [Partition('actions_legacy', datetime.min, datetime(2018, 2, 1), False),
+                  Partition('actions_default', None, None, True),
+                  _monthly('actions', 2018, 3),
+                  _monthly('actions', 2018, 4),
+                  _monthly('actions', 2018, 6)]
+    now = datetime(2018, 6, 20)
+    # the three months before june are kept
+    assert expired_partitions(partitions, 3, now) == ['actions_legacy']
+    assert expired_partitions(partitions, 2, now) == ['actions_legacy', 'actions_y2018m03']
+    assert expired_partitions(partitions, None, now) == []
+
+
+@pytest.mark.asyncio
+async def test_drop_expired_partitions(mocked_conn):
+    mocked_conn.fetch.return_value = [
+        {'relname': 'desktop_y2018m01',
+         'bound': "FOR VALUES FROM ('2018-01-01 00:00:00') TO ('2018-02-01 00:00:00')"},
+        {'relname': 'desktop_y2018m06',
+         'bound': "FOR VALUES FROM ('2018-06-01 00:00:00') TO ('2018-07-01 00:00:00')"},
+        {'relname': 'desktop_default', 'bound': 'DEFAULT'}]
+    dropped = await drop_expired_partitions(mocked_conn, 'desktop', 3, datetime(2018, 6, 1))
+    assert dropped == ['desktop_y2018m01']
+    statements = [call[0][0] for call in mocked_conn.execute.call_args_list]
+    assert statements == ['ALTER TABLE desktop DETACH PARTITION desktop_y2018m01',
+                          'DROP TABLE desktop_y2018m01']
+
+
+@pytest.mark.asyncio
+async def test_maintain_partitions_skips_unpartitioned_tables(mocked_pool):
+    mocked_conn = mocked_pool.acquire.return_value.__aenter__.return_value
+    # the advisory lock, then the relkind of an unpartitioned table
+    mocked_conn.fetchval.side_effect = [True, 'r']
+    assert await maintain_partitions(mocked_pool, {'actions': 3}) == {}
+    mocked_conn.fetch.assert_not_called()
+    mocked_conn.execute.assert_called_once_with(UNLOCK_STMT, MAINTENANCE_LOCK_KEY)
+
+
+@pytest.mark.asyncio
+async def test_maintain_partitions_waits_for_lock(mocked_pool):
+    mocked_conn = mocked_pool.acquire.return_value.__aenter__.return_value
+    mocked_conn.fetchval.return_value = False
+    assert await maintain_partitions(mocked_pool, {'actions': 3}) is None
+    mocked_conn.execute.assert_not_called()
@@ -1,9 +1,38 @@
 # -*- coding: utf-8 -*-
+import asyncio
+from unittest import mock
 
+import pytest
 
 from yo.db.queue import put
 from yo.db.queue import get
 from yo.db.queue import size
+from yo.db.queue import lease
+from yo.db.queue import ack
+from yo.db.queue import release
+from yo.db.queue import QItem
+from yo.db.queue import LEASE_Q_STMT
+from yo.db.queue import POP_Q_BY_TRANSPORT_STMT
+from yo.db.queue import Q_SIZE_BY_TRANSPORT_STMT
+from yo.db.queue import LEASE_Q_BY_TRANSPORT_STMT
+from yo.db.queue import ACK_Q_STMT
+from yo.db.queue import RELEASE_Q_STMT
+from yo.db.queue import DROP_FAILED_Q_STMT
+from yo.db.queue import RETRY_Q_STMT
+from yo.db.queue import FAILED_RETRY_DELAY_SECONDS
+from yo.db.queue import process_qitems
+from yo.db.queue import retry
+from yo.db.queue import AGE_Q_PRIORITIES_STMT
+from yo.db.queue import age_priorities
+from yo.db.queue import depth_by_priority
+from yo.db.actions import RateLimitException
+from yo.db.actions import PERMANENT_FAIL_COUNT
+from yo.schema import ActionStatus
+from yo.schema import Priority
+from yo.schema import TransportType
+
+TEST_QITEM = {'qid': 1, 'transport': 1,
+              'data': {'nid': 1, 'to_username': 'test_user'}}
 
 def test_put():
     pass
@@ -15,3 +44,144 @@ def test_size():
     pass
 
 
+@pytest.mark.asyncio
+async def test_get_by_transport(mocked_pool):
+    mocked_pool.fetchrow.return_value = TEST_QITEM
+    result = await get(mocked_pool, transport_type=TransportType.desktop)
+    assert result == TEST_QITEM
+    mocked_pool.fetchrow.assert_called_once_with(POP_Q_BY_TRANSPORT_STMT,
+                                                 TransportType.desktop.value)
+
+
+@pytest.mark.asyncio
+async def test_size_by_transport(mocked_pool):
+    mocked_pool.fetchval.return_value = 3
+    assert await size(mocked_pool, transport_type=TransportType.sms) == 3
+    mocked_pool.fetchval.assert_called_once_with(Q_SIZE_BY_TRANSPORT_STMT,
+                                                 TransportType.sms.value)
+
+
+@pytest.mark.asyncio
+async def test_lease(mocked_pool):
+    mocked_pool.fetch.return_value = [{'qid': 2}, {'qid': 1}]
+    result = await lease(mocked_pool, 10, 30)
+    assert [r['qid'] for r in result] == [1, 2]
+    mocked_pool.fetch.assert_called_once_with(LEASE_Q_STMT, 10, 30)
+
+
+@pytest.mark.asyncio
+async def test_lease_by_transport(mocked_pool):
+    mocked_pool.fetch.return_value = []
+    result = await lease(mocked_pool, 10, 30, transport_type=TransportType.email)
+    assert result == []
+    mocked_pool.fetch.assert_called_once_with(LEASE_Q_BY_TRANSPORT_STMT, 10, 30,
+                                              TransportType.email.value)
+
+
+@pytest.mark.asyncio
+async def test_ack_and_release(mocked_pool):
+    await ack(mocked_pool, [])
+    mocked_pool.execute.assert_not_called()
+    await ack(mocked_pool, (1, 2))
+    mocked_pool.execute.assert_called_with(ACK_Q_STMT, [1, 2])
+    await release(mocked_pool, [3], delay=60)
+    mocked_pool.execute.assert_called_with(RELEASE_Q_STMT, [3], 60)
+
+
+@pytest.mark.asyncio
+async def test_qitem_acks_on_success(mocked_pool):
+    mocked_pool.fetch.return_value = [TEST_QITEM]
+    async with QItem(mocked_pool) as qitem:
+        assert qitem['qid'] == 1
+    mocked_pool.execute.assert_called_once_with(ACK_Q_STMT, [1])
+
+
+@pytest.mark.asyncio
+async def test_qitem_releases_on_rate_limit(mocked_pool):
+    mocked_pool.fetch.return_value = [TEST_QITEM]
+    with pytest.raises(RateLimitException):
+        async with QItem(mocked_pool, retry_delay=60):
+            raise RateLimitException()
+    mocked_pool.execute.assert_called_once_with(RELEASE_Q_STMT, [1], 60)
+
+
+@pytest.mark.asyncio
+async def test_qitem_defers_rate_limited_item_to_window_end(mocked_pool):
+    mocked_pool.fetch.return_value = [TEST_QITEM]
+    with pytest.raises(RateLimitException):
+        async with QItem(mocked_pool, retry_delay=60):
+            raise RateLimitException(retry_after=1800.0)
+    mocked_pool.execute.assert_called_once_with(RELEASE_Q_STMT, [1], 1800.0)
+
+
+@pytest.mark.asyncio
+async def test_retry_backs_off_and_drops(mocked_pool):
+    mocked_pool.fetch.return_value = [{'qid': 4}]
+    dropped = await retry(mocked_pool, [3, 4])
+    assert dropped == [4]
+    mocked_pool.fetch.assert_called_once_with(DROP_FAILED_Q_STMT, [3, 4],
+                                              PERMANENT_FAIL_COUNT)
+    mocked_pool.execute.assert_called_once_with(RETRY_Q_STMT, [3, 4],
+                                                FAILED_RETRY_DELAY_SECONDS)
+
+
+@pytest.mark.asyncio
+async def test_qitem_records_dropped_item_as_perm_failed(mocked_pool):
+    mocked_pool.fetch.side_effect = [[TEST_QITEM], [{'qid': 1}]]
+    with pytest.raises(ValueError):
+        async with QItem(mocked_pool):
+            raise ValueError()
+    insert = mocked_pool.fetchval.call_args[0]
+    assert insert[-1] == ActionStatus.perm_failed
+
+
+@pytest.mark.asyncio
+async def test_process_qitems_times_out_slow_items(mocked_pool):
+    mocked_pool.fetch.return_value = []
+
+    async def worker_func(qitem, local_logger):
+        if qitem['qid'] == 1:
+            await asyncio.sleep(1)
+
+    qitems = [dict(TEST_QITEM, qid=1), dict(TEST_QITEM, qid=2)]
+    done, failed = await process_qitems(mocked_pool, qitems, worker_func,
+                                        mock.MagicMock(), item_timeout=0.01)
+    assert done == [2]
+    assert failed == [1]
+    mocked_pool.fetch.assert_called_once_with(DROP_FAILED_Q_STMT, [1],
+                                              PERMANENT_FAIL_COUNT)
+
+
+@pytest.mark.asyncio
+async def test_process_qitems_settles_through_qitem(mocked_pool):
+    async def worker_func(qitem, local_logger):
+        if qitem['qid'] == 2:
+            raise RateLimitException()
+
+    qitems = [dict(TEST_QITEM, qid=1), dict(TEST_QITEM, qid=2)]
+    done, failed = await process_qitems(mocked_pool, qitems, worker_func,
+                                        mock.MagicMock())
+    assert done == [1]
+    assert failed == [2]
+    mocked_pool.fetch.assert_not_called()
+    mocked_pool.execute.assert_any_call(ACK_Q_STMT, [1])
+    mocked_pool.execute.assert_any_call(RELEASE_Q_STMT, [2], 60)
+    statuses = [c[0][-1] for c in mocked_pool.fetchval.call_args_list]
+    assert statuses == [ActionStatus.sent.value, ActionStatus.rate_limited.value]
+
+
+@pytest.mark.asyncio
+async def test_depth_by_priority(mocked_pool):
+    mocked_pool.fetch.return_value = [{'priority': 1, 'depth': 1000000},
+                                      {'priority': 4, 'depth': 2}]
+    depths = await depth_by_priority(mocked_pool)
+    assert depths == {Priority.low: 1000000, Priority.normal: 0,
+                      Priority.high: 0, Priority.always: 2}
+
+
+@pytest.mark.asyncio
+async def test_age_priorities(mocked_pool):
+    mocked_pool.execute.return_value = 'UPDATE 5'
+    assert await age_priorities(mocked_pool, 3600, Priority.high) == 5
+    mocked_pool.execute.assert_called_once_with(AGE_Q_PRIORITIES_STMT, 3600,
+                                                Priority.high.value)
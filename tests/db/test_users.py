@@ -1,4 +1,5 @@
 # -*- coding: utf-8 -*-
+import asynctest
 import pytest
 
 from yo.db.users import create_user
@@ -11,6 +12,11 @@ from yo.db.users import UPDATE_USER_TRANSPORTS_STMT
 
 from yo.db.users import get_user_email
 from yo.db.users import get_user_phone
+from yo.db.users import prefetch_user_data
+from yo.db.users import USER_DATA
+from yo.db.users import UserTransportsCache
+
+TEST_USER_DATA = {'email': 'test@example.com', 'phone': '+15555555555'}
 
 TEST_USER_OBJECT = {
   "username": "test_username",
@@ -95,8 +101,57 @@ async def test_set_user_transports_user_doesnt_exist(mocked_pool):
 
 @pytest.mark.asyncio
 async def test_get_user_email(mocked_pool):
-    pass
+    USER_DATA.clear()
+    with asynctest.patch('yo.db.users.get_user_data',
+                         asynctest.CoroutineMock(return_value=TEST_USER_DATA)) as get_user_data:
+        assert await get_user_email('test_username') == 'test@example.com'
+        assert await get_user_phone('test_username') == '+15555555555'
+    get_user_data.assert_called_once_with('test_username')
 
 @pytest.mark.asyncio
 async def test_get_user_phone(mocked_pool):
-    pass
+    USER_DATA.clear()
+    with asynctest.patch('yo.db.users.get_user_data',
+                         asynctest.CoroutineMock(side_effect=KeyError('result'))) as get_user_data:
+        assert await get_user_phone('missing_username') is None
+        assert await get_user_phone('missing_username') is None
+    get_user_data.assert_called_once_with('missing_username')
+    assert USER_DATA.stats()['negative_hits'] == 1
+
+
+@pytest.mark.asyncio
+async def test_prefetch_user_data():
+    USER_DATA.clear()
+    USER_DATA.set('cached_username', TEST_USER_DATA)
+    results = {'test_username': TEST_USER_DATA, 'missing_username': None}
+    with asynctest.patch('yo.db.users.get_user_data_batch',
+                         asynctest.CoroutineMock(return_value=results)) as batch, \
+            asynctest.patch('yo.db.users.get_user_data', asynctest.CoroutineMock()) as get_user_data:
+        fetched = await prefetch_user_data(['test_username', 'missing_username',
+                                            'cached_username', 'test_username'])
+        assert await get_user_email('test_username') == 'test@example.com'
+        assert await get_user_email('missing_username') is None
+    assert fetched == 2
+    batch.assert_called_once_with(['missing_username', 'test_username'])
+    get_user_data.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_user_transports_cache(mocked_pool):
+    mocked_pool.fetchrow.return_value = TEST_USER_OBJECT
+    mocked_pool.fetchval.return_value = True
+    cache = UserTransportsCache(mocked_pool)
+    assert await cache.get('test_username') == DEFAULT_USER_TRANSPORT_SETTINGS
+    assert await cache.get('test_username') == DEFAULT_USER_TRANSPORT_SETTINGS
+    mocked_pool.fetchrow.assert_called_once_with(GET_USER_TRANSPORTS_STMT, 'test_username')
+
+    assert await cache.set('test_username', DEFAULT_USER_TRANSPORT_SETTINGS) is True
+    mocked_pool.fetchval.assert_called_once_with(UPDATE_USER_TRANSPORTS_STMT,
+                                                 DEFAULT_USER_TRANSPORT_SETTINGS,
+                                                 'test_username')
+    assert 'test_username' not in cache.cache
+
+    # invalidation NOTIFY from another process
+    await cache.get('test_username')
+    cache._users_changed(None, 1, 'users_changefeed', 'test_username')
+    assert 'test_username' not in cache.cache
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+import asyncio
+
+import pytest
+
+from yo.db.queue.watcher import QueueDispatcher
+from yo.db.queue.watcher import parse_payload
+from yo.db.queue.watcher import payload_count
+from yo.schema import TransportType
+
+
+def test_parse_payload():
+    assert parse_payload('{"qid": 1, "transport": 1}') == {'qid': 1, 'transport': 1}
+    assert parse_payload({'qid': 1}) == {'qid': 1}
+
+
+@pytest.mark.asyncio
+async def test_notify_wakes_one_waiter_per_item(event_loop):
+    dispatcher = QueueDispatcher('postgres://', worker_func=None, num_workers=3,
+                                 batch_size=1, loop=event_loop)
+    waits = [asyncio.ensure_future(dispatcher.wait(1)) for _ in range(3)]
+    await asyncio.sleep(0)
+    dispatcher._on_notify(None, 1, 'queue_changefeed', '{"qid": 1, "transport": 1}')
+    done, pending = await asyncio.wait(waits, timeout=0.1)
+    assert len(done) == 1
+    for waiter in pending:
+        waiter.cancel()
+
+
+@pytest.mark.asyncio
+async def test_notify_ignores_other_transports(event_loop):
+    dispatcher = QueueDispatcher('postgres://', worker_func=None,
+                                 transport_type=TransportType.desktop,
+                                 loop=event_loop)
+    dispatcher._on_notify(None, 1, 'queue_changefeed', '{"qid": 1, "transport": 2}')
+    assert await dispatcher.wait(0.01) is False
+    dispatcher._on_notify(None, 1, 'queue_changefeed', '{"qid": 2, "transport": 1}')
+    assert await dispatcher.wait(0.01) is True
+
+
+def test_payload_count():
+    assert payload_count({'qid': 1, 'transport': 1}) == 1
+    assert payload_count({'min_qid': 10, 'max_qid': 19, 'transport': 1}) == 10
+    assert payload_count({'min_qid': 10, 'max_qid': 19, 'count': 4}) == 4
+
+
+@pytest.mark.asyncio
+async def test_range_notify_wakes_workers_per_batch(event_loop):
+    dispatcher = QueueDispatcher('postgres://', worker_func=None, num_workers=5,
+                                 batch_size=10, loop=event_loop)
+    waits = [asyncio.ensure_future(dispatcher.wait(1)) for _ in range(5)]
+    await asyncio.sleep(0)
+    dispatcher._on_notify(None, 1, 'queue_changefeed',
+                          '{"min_qid": 1, "max_qid": 25, "count": 25, "transport": 1}')
+    done, pending = await asyncio.wait(waits, timeout=0.1)
+    assert len(done) == 3
+    for waiter in pending:
+        waiter.cancel()
@@ -2,14 +2,15 @@
 
 from datetime import datetime
 
+import asynctest
 import pytest
 import yo.json
+from yo.schema import NotificationType
 from yo.services.api_server.api_methods import api_get_notifications
 
 
 @pytest.mark.asyncio
-async def test_api_get_notifications(sqlite_db):
-    """Basic test of get_db_notifications backed by sqlite3"""
+async def test_api_get_notifications(mocked_pool):
     vote_data = {
         'author': 'testuser1337',
         'weight': 100,
@@ -21,30 +22,39 @@ async def test_api_get_notifications(sqlite_db):
             'depth': 0
         }
     }
-    test_data = {
-        'json_data':     yo.json.dumps(vote_data),
+    created = datetime(2018, 7, 11, 2, 0, 13)
+    mocked_pool.fetch.return_value = [{
+        'dnid': 7,
+        'eid': 'test-eid',
+        'notify_type': NotificationType.vote.value,
         'to_username': 'testuser1337',
         'from_username': 'testuser1336',
-        'notify_type': 'vote',
-        'trx_id': '123abc'
-    }
-    yo_db = sqlite_db
-    retval = yo_db.create_notification(**test_data)
-    assert retval is True
-
-    result = await api_get_notifications(
-        username='testuser1337', context=dict(yo_db=sqlite_db))
+        'json_data': yo.json.dumps(vote_data),
+        'created': created,
+        'shown': None,
+        'read': None,
+        'updated': created
+    }]
+    context = dict(app=asynctest.Mock(db_pool=mocked_pool))
+    result = await api_get_notifications(username='testuser1337',
+                                         created_before='2018-07-12T00:00:00+00:00',
+                                         before_id=8,
+                                         read=False,
+                                         notify_types=['vote'],
+                                         context=context)
 
     assert len(result) == 1
     result = result[0]
 
+    assert result['notify_id'] == 7
     assert result['notify_type'] == 'vote'
     assert result['to_username'] == 'testuser1337'
     assert result['from_username'] == 'testuser1336'
     assert yo.json.loads(result['json_data']) == vote_data
     assert isinstance(result['created'], datetime)
+    assert result['read'] is False
 
-    # notifications only columns
-    assert result['trx_id'] == '123abc'
-
-
+    stmt, *args = mocked_pool.fetch.call_args[0]
+    assert args == ['testuser1337', datetime(2018, 7, 12), 8,
+                    [NotificationType.vote.value]]
+    assert 'read IS NULL' in stmt
@@ -1,38 +1,22 @@
 # -*- coding: utf-8 -*-
-
-from datetime import datetime
-
+import asynctest
 import pytest
-import yo.json
+
+from yo.db.desktop import MARK_UNSHOWN_STMT
 from yo.services.api_server.api_methods import api_mark_unshown
 
 
 @pytest.mark.asyncio
-async def test_api_mark_unshown(sqlite_db):
-    test_notification = {
-        'json_data':     yo.json.dumps({
-            'author': 'testuser1336',
-            'weight': 100,
-            'item': {
-                'author': 'testuser1337',
-                'permlink': 'test-post-1',
-                'summary': 'A test post',
-                'category': 'test1',
-                'depth': 0
-            }
-        }),
-        'to_username': 'testuser1337',
-        'from_username': 'testuser1336',
-        'notify_type': 'vote',
-        'shown':         True
-    }
+async def test_api_mark_unshown(mocked_pool):
+    mocked_pool.fetch.return_value = [{'dnid': 1}, {'dnid': 3}]
+    context = dict(app=asynctest.Mock(db_pool=mocked_pool))
+    result = await api_mark_unshown(username='test_user', ids=[1, 2, 3], context=context)
+    assert result == [1, 3]
+    mocked_pool.fetch.assert_called_once_with(MARK_UNSHOWN_STMT, [1, 2, 3], 'test_user')
 
-    _ = sqlite_db.create_wwwpoll_notification(**test_notification)
-    assert _ is True
-    notification = sqlite_db.get_wwwpoll_notifications()[0]
-    assert notification['shown'] is True
-    result = await api_mark_unshown(ids=[notification['nid']],
-                                                                    context=dict(yo_db=sqlite_db))
-    assert result == [True]
-    notification = sqlite_db.get_wwwpoll_notifications()[0]
-    assert notification['shown'] is False
+
+@pytest.mark.asyncio
+async def test_api_mark_unshown_no_ids(mocked_pool):
+    context = dict(app=asynctest.Mock(db_pool=mocked_pool))
+    assert await api_mark_unshown(username='test_user', ids=[], context=context) == []
+    mocked_pool.fetch.assert_not_called()
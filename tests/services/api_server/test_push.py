@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import json
+from unittest import mock
+
+import asynctest
+import pytest
+
+from yo.schema import NotificationType
+import yo.services.api_server.push
+from yo.services.api_server.push import DesktopPushHub
+
+
+@pytest.mark.asyncio
+async def test_notify_fans_out_to_user_subscriptions():
+    hub = DesktopPushHub()
+    first = hub.subscribe('test_user')
+    second = hub.subscribe('test_user')
+    other = hub.subscribe('other_user')
+    payload = json.dumps([[1, 'test_user', NotificationType.vote.value, 'voter'],
+                          [2, 'nobody', NotificationType.comment_reply.value, 'replier']])
+    hub._on_notify(None, 1, 'desktop_changefeed', payload)
+
+    for subscription in (first, second):
+        message = await subscription.get()
+        assert message['notify_id'] == 1
+        assert message['notify_type'] == 'vote'
+        assert message['from_username'] == 'voter'
+    assert other.queue.empty()
+
+    hub.unsubscribe(first)
+    hub.unsubscribe(second)
+    hub.unsubscribe(other)
+    assert hub.stats() == {'users': 0, 'connections': 0}
+
+
+@pytest.mark.asyncio
+async def test_full_subscription_drops_and_resyncs():
+    hub = DesktopPushHub(maxsize=2)
+    subscription = hub.subscribe('test_user')
+    hub.publish([[dnid, 'test_user', NotificationType.vote.value, 'voter']
+                 for dnid in range(1, 5)])
+    assert subscription.overflowed
+
+    assert (await subscription.get())['notify_id'] == 1
+    assert (await subscription.get())['notify_id'] == 2
+    assert (await subscription.get()) == {'type': 'resync'}
+    assert not subscription.overflowed
+    assert subscription.queue.empty()
+
+
+def _listen_conn():
+    conn = mock.MagicMock()
+    conn.is_closed.return_value = False
+    conn.add_listener = asynctest.CoroutineMock()
+    conn.close = asynctest.CoroutineMock()
+    return conn
+
+
+@pytest.mark.asyncio
+async def test_lost_listen_connection_reconnects_and_resyncs():
+    hub = DesktopPushHub(check_interval=0.01)
+    subscription = hub.subscribe('test_user')
+    first, second = _listen_conn(), _listen_conn()
+    with mock.patch.object(yo.services.api_server.push, 'create_asyncpg_conn',
+                           asynctest.CoroutineMock(side_effect=[first, second])) as connect:
+        await hub.listen('postgres://test')
+        first.is_closed.return_value = True
+        await asyncio.sleep(0.05)
+    assert connect.call_count == 2
+    second.add_listener.assert_called_once_with('desktop_changefeed', hub._on_notify)
+    # inserts made while the connection was down were never pushed
+    assert await subscription.get() == {'type': 'resync'}
+    await hub.close()
+    second.close.assert_called_once_with()
+
+
+@pytest.mark.asyncio
+async def test_failed_sender_unsubscribes_and_closes_socket():
+    hub = DesktopPushHub()
+    ws = mock.MagicMock(closed=False)
+    ws.send_json = asynctest.CoroutineMock(side_effect=ConnectionResetError())
+    ws.close = asynctest.CoroutineMock()
+    subscription = hub.subscribe('test_user')
+    sender = hub.start_sender(ws, subscription)
+    hub.publish([[1, 'test_user', NotificationType.vote.value, 'voter']])
+    await asyncio.sleep(0.01)
+    assert sender.done()
+    assert hub.stats() == {'users': 0, 'connections': 0}
+    ws.close.assert_called_once_with(code=mock.ANY, message=b'send failed')
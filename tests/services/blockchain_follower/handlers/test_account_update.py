@@ -2,7 +2,25 @@
 
 
 from yo.services.blockchain_follower.handlers import handle_account_update
+from yo.schema import NotificationType
+from yo.schema import Priority
 
-def test_handle_account_update():
-    pass
+ACCOUNT_UPDATE_OP = {
+    'block': 20000000,
+    'trx_in_block': 1,
+    'op_in_trx': 0,
+    'virtual_op': 0,
+    'op': ['account_update', {'account': 'testuser1337',
+                              'memo_key': 'STM6x1Qy8tp6NeF4Yk8ZsxWJ1j7Hy6RvbZ3D7K6NT8L8Swb5aRXTJ',
+                              'json_metadata': ''}]
+}
 
+def test_handle_account_update():
+    notifications = handle_account_update(ACCOUNT_UPDATE_OP)
+    assert len(notifications) == 1
+    notification = notifications[0]
+    assert notification['eid'] == '20000000/1/0/0'
+    assert notification['to_username'] == 'testuser1337'
+    assert notification['notify_type'] == NotificationType.account_update
+    # account security changes jump ahead of queued votes
+    assert notification['priority'] == Priority.always.value
@@ -1,7 +1,61 @@
 # -*- coding: utf-8 -*-
+import pytest
 
-
+from yo.schema import NotificationType
 from yo.services.blockchain_follower.handlers import handle_comment
+from yo.services.blockchain_follower.handlers import remember_post
+from yo.services.blockchain_follower.handlers import PARENT_POSTS
+
+
+def comment_op(author, permlink, parent_author='', parent_permlink='test'):
+    return {
+        'block': 20000000,
+        'op': [
+            'comment',
+            {
+                'author': author,
+                'permlink': permlink,
+                'parent_author': parent_author,
+                'parent_permlink': parent_permlink,
+                'title': '',
+                'body': 'test body',
+                'json_metadata': '{}'
+            }
+        ],
+        'op_in_trx': 0,
+        'timestamp': '2018-02-19T07:16:54',
+        'trx_id': '0000000000000000000000000000000000000000',
+        'trx_in_block': 1,
+        'virtual_op': 0
+    }
+
+
+async def handle_remembered_comment(op):
+    # gather_block_notifications remembers the posts of a window first
+    remember_post(op['op'][1])
+    return await handle_comment(op)
+
+
+@pytest.mark.asyncio
+async def test_handle_comment():
+    PARENT_POSTS.clear()
+    result = await handle_remembered_comment(comment_op('testuser1337', 'test-post-1'))
+    assert result == []
+    assert PARENT_POSTS.get('@testuser1337/test-post-1') is False
+
+    result = await handle_remembered_comment(
+        comment_op('testuser1336', 're-test-post-1', 'testuser1337', 'test-post-1'))
+    assert len(result) == 1
+    assert result[0]['notify_type'] == NotificationType.post_reply
+    assert result[0]['to_username'] == 'testuser1337'
+
+    result = await handle_remembered_comment(
+        comment_op('testuser1337', 're-re-test-post-1', 'testuser1336', 're-test-post-1'))
+    assert result[0]['notify_type'] == NotificationType.comment_reply
+
 
-def test_handle_comment():
-    pass
+@pytest.mark.asyncio
+async def test_handle_comment_does_not_remember_post():
+    PARENT_POSTS.clear()
+    await handle_comment(comment_op('testuser1337', 'test-post-1'))
+    assert PARENT_POSTS.get('@testuser1337/test-post-1') is None
@@ -1,6 +1,12 @@
 # -*- coding: utf-8 -*-
 
 from yo.services.blockchain_follower.handlers import handle_send
+from yo.schema import Priority
 
 def test_handle_send():
-    pass
+    op = {'block': 1, 'trx_in_block': 2, 'op_in_trx': 0, 'virtual_op': 0,
+          'op': ['transfer', {'amount': '1.000 STEEM', 'from': 'testuser1337',
+                              'memo': '', 'to': 'testuser1336'}]}
+    notifications = handle_send(op)
+    assert [n['to_username'] for n in notifications] == ['testuser1337']
+    assert notifications[0]['priority'] == Priority.high.value
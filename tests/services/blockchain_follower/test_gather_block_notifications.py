@@ -0,0 +1,53 @@
+# coding=utf-8
+from unittest import mock
+
+import pytest
+
+from yo.schema import NotificationType
+from yo.services.blockchain_follower.service import gather_block_notifications
+from yo.services.blockchain_follower.service import get_blocks_ops
+
+VOTE_OP = {
+    'block': 20000000,
+    'op': [
+        'vote',
+        {
+            'author': 'testuser1337',
+            'permlink': 'test-post-1',
+            'voter': 'testuser1336',
+            'weight': 100
+        }
+    ],
+    'op_in_trx': 0,
+    'timestamp': '2018-02-19T07:16:54',
+    'trx_id': '0000000000000000000000000000000000000000',
+    'trx_in_block': 1,
+    'virtual_op': 0
+}
+
+AUTHOR_REWARD_OP = {
+    'block': 20000000,
+    'op': ['author_reward', {'author': 'testuser1337'}],
+    'op_in_trx': 0,
+    'timestamp': '2018-02-19T07:16:54',
+    'trx_id': '0000000000000000000000000000000000000000',
+    'trx_in_block': 4294967295,
+    'virtual_op': 12
+}
+
+
+@pytest.mark.asyncio
+async def test_gather_block_notifications():
+    result = await gather_block_notifications([VOTE_OP, AUTHOR_REWARD_OP, VOTE_OP])
+    assert len(result) == 2
+    assert all(n['notify_type'] == NotificationType.vote for n in result)
+    assert result[0]['eid'] == '20000000/1/0/0'
+
+
+def test_get_blocks_ops():
+    blockchain = mock.Mock()
+    blockchain.steem.get_ops_in_block.side_effect = [[VOTE_OP], [], [AUTHOR_REWARD_OP]]
+    result = get_blocks_ops(blockchain, [1, 2, 3])
+    assert result == [VOTE_OP, AUTHOR_REWARD_OP]
+    blockchain.steem.get_ops_in_block.assert_has_calls(
+        [mock.call(1, False), mock.call(2, False), mock.call(3, False)])
@@ -1,7 +1,8 @@
 # coding=utf-8
+from yo.services.blockchain_follower.service import get_start_block
 
 
-import yo.services.blockchain_follower.service
-
 def test_get_start_block():
-    pass
+    assert get_start_block(10, 1000) == 10
+    assert get_start_block(-10, 1000) == 990
+    assert get_start_block(None, 1000) is None
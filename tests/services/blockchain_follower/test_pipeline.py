@@ -0,0 +1,117 @@
+# coding=utf-8
+import asyncio
+from unittest import mock
+
+import pytest
+
+import yo.services.blockchain_follower.service
+from yo.services.blockchain_follower.service import transform_stage
+from yo.services.blockchain_follower.service import write_stage
+
+
+@pytest.mark.asyncio
+async def test_write_stage_commits_checkpoints_in_order():
+    committed = []
+
+    async def create_block_notifications(pool, notifications, block_num,
+                                         checkpoint_name=None, before_checkpoint=None):
+        # later windows finish their inserts first
+        await asyncio.sleep(0.01 * (5 - block_num))
+        if before_checkpoint is not None:
+            await before_checkpoint
+        committed.append(block_num)
+        return []
+
+    in_q = asyncio.Queue()
+    for block_num in range(1, 5):
+        transform = asyncio.ensure_future(asyncio.sleep(0, result=[]))
+        await in_q.put(([block_num], 0, transform))
+
+    with mock.patch.object(yo.services.blockchain_follower.service,
+                           'create_block_notifications',
+                           create_block_notifications):
+        stage = asyncio.ensure_future(write_stage(None, in_q, concurrency=4))
+        await asyncio.sleep(0.2)
+        stage.cancel()
+
+    assert committed == [1, 2, 3, 4]
+
+
+@pytest.mark.asyncio
+async def test_write_stage_stops_after_failed_write():
+    calls = []
+
+    async def create_block_notifications(pool, notifications, block_num,
+                                         checkpoint_name=None, before_checkpoint=None):
+        calls.append(block_num)
+        if block_num == 1:
+            raise ValueError('write failed')
+        await before_checkpoint
+        return []
+
+    in_q = asyncio.Queue()
+    for block_num in range(1, 4):
+        transform = asyncio.ensure_future(asyncio.sleep(0, result=[]))
+        await in_q.put(([block_num], 0, transform))
+
+    with mock.patch.object(yo.services.blockchain_follower.service,
+                           'create_block_notifications',
+                           create_block_notifications):
+        with pytest.raises(ValueError):
+            await asyncio.wait_for(write_stage(None, in_q, concurrency=2), 1)
+
+    # window 2 fails with window 1 instead of retrying forever
+    assert calls == [1, 2]
+
+
+@pytest.mark.asyncio
+async def test_transform_stage_limits_concurrency():
+    running = []
+    peak = []
+
+    async def gather_block_notifications(ops):
+        running.append(ops)
+        peak.append(len(running))
+        await asyncio.sleep(0.01)
+        running.remove(ops)
+        return []
+
+    in_q = asyncio.Queue()
+    out_q = asyncio.Queue()
+    for block_num in range(1, 7):
+        fetch = asyncio.ensure_future(asyncio.sleep(0, result=[block_num]))
+        await in_q.put(([block_num], fetch))
+
+    with mock.patch.object(yo.services.blockchain_follower.service,
+                           'gather_block_notifications',
+                           gather_block_notifications):
+        stage = asyncio.ensure_future(transform_stage(in_q, out_q, concurrency=2))
+        await asyncio.sleep(0.2)
+        stage.cancel()
+
+    assert out_q.qsize() == 6
+    assert max(peak) == 2
+
+
+@pytest.mark.asyncio
+async def test_write_stage_gives_up_on_failing_window():
+    calls = []
+
+    async def create_block_notifications(pool, notifications, block_num,
+                                         checkpoint_name=None, before_checkpoint=None):
+        calls.append(block_num)
+        return None
+
+    in_q = asyncio.Queue()
+    for block_num in range(1, 3):
+        transform = asyncio.ensure_future(asyncio.sleep(0, result=[]))
+        await in_q.put(([block_num], 0, transform))
+
+    service = yo.services.blockchain_follower.service
+    with mock.patch.object(service, 'create_block_notifications',
+                           create_block_notifications), \
+         mock.patch.object(service, 'BLOCK_INTERVAL', 0):
+        with pytest.raises(RuntimeError):
+            await asyncio.wait_for(write_stage(None, in_q, concurrency=1), 1)
+
+    assert calls == [1] * service.WRITE_ATTEMPTS
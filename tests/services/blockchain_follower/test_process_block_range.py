@@ -0,0 +1,31 @@
+# coding=utf-8
+from unittest import mock
+
+import pytest
+
+import yo.services.blockchain_follower.service
+from yo.services.blockchain_follower.service import process_block_range
+
+
+class BlockSource:
+    async def get_blocks_ops(self, block_nums):
+        return []
+
+
+@pytest.mark.asyncio
+async def test_process_block_range_does_not_queue(mocked_pool):
+    mocked_pool.fetchval.return_value = None
+    calls = []
+
+    async def create_block_notifications(pool, notifications, block_num,
+                                         checkpoint_name=None, queue=True):
+        calls.append((block_num, checkpoint_name, queue))
+        return []
+
+    with mock.patch.object(yo.services.blockchain_follower.service,
+                           'create_block_notifications',
+                           create_block_notifications):
+        await process_block_range(mocked_pool, BlockSource(), start_block=1,
+                                  end_block=3, blocks_per_batch=2)
+
+    assert calls == [(2, 'backfill/1-3', False), (3, 'backfill/1-3', False)]
@@ -0,0 +1,14 @@
+# coding=utf-8
+from yo.services.blockchain_follower.service import split_block_range
+
+
+def test_split_block_range():
+    assert split_block_range(1, 10, 3) == [(1, 4), (5, 7), (8, 10)]
+
+
+def test_split_block_range_more_shards_than_blocks():
+    assert split_block_range(5, 6, 8) == [(5, 5), (6, 6)]
+
+
+def test_split_block_range_single_shard():
+    assert split_block_range(100, 200, 1) == [(100, 200)]
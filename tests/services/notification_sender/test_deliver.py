@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+import asynctest
+import pytest
+import structlog
+
+from yo.db.actions import RateLimitException
+from yo.schema import TransportType
+from yo.services.notification_sender.service import deliver
+from yo.services.notification_sender.service import TransportMetrics
+
+TEST_QITEM = {'qid': 1, 'transport': TransportType.desktop.value,
+              'data': {'nid': 1, 'to_username': 'test_user'}}
+
+
+@pytest.mark.asyncio
+async def test_deliver_counts_sent(mocked_pool):
+    handler = asynctest.CoroutineMock()
+    metrics = TransportMetrics(TransportType.desktop)
+    await deliver(TEST_QITEM, structlog.get_logger(), handler=handler,
+                  pool=mocked_pool, metrics=metrics)
+    handler.assert_called_once_with(mocked_pool, TEST_QITEM['data'], asynctest.ANY)
+    # the QItem settling the item records the action
+    mocked_pool.fetchval.assert_not_called()
+    assert metrics.report()['sent'] == 1
+
+
+@pytest.mark.asyncio
+async def test_deliver_reraises_rate_limit(mocked_pool):
+    handler = asynctest.CoroutineMock(side_effect=RateLimitException())
+    metrics = TransportMetrics(TransportType.email)
+    with pytest.raises(RateLimitException):
+        await deliver(TEST_QITEM, structlog.get_logger(), handler=handler,
+                      pool=mocked_pool, metrics=metrics)
+    report = metrics.report()
+    assert report['sent'] == 0
+    assert report['rate_limited'] == 1
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+import time
+
+import pytest
+
+from yo.db.actions import RateLimitException
+from yo.schema import TransportType
+from yo.services.notification_sender.ratelimits import RateLimiter
+
+
+@pytest.mark.asyncio
+async def test_acquire_enforces_hour_limit():
+    limiter = RateLimiter({'email': {'hour': 1, 'day': 10}})
+    await limiter.acquire('test_user', TransportType.email)
+    with pytest.raises(RateLimitException):
+        await limiter.acquire('test_user', TransportType.email)
+    # other users and unlimited transports are unaffected
+    await limiter.acquire('other_user', TransportType.email)
+    await limiter.acquire('test_user', TransportType.desktop)
+    await limiter.acquire('test_user', TransportType.desktop)
+
+
+@pytest.mark.asyncio
+async def test_windows_slide():
+    limiter = RateLimiter({'sms': {'hour': 2, 'day': 3}})
+    now = time.time()
+    limiter._sends[('test_user', TransportType.sms)] = [now - 90000, now - 7200, now - 3700]
+    assert limiter.counts('test_user', TransportType.sms, now=now) == {'hour': 0, 'day': 2}
+    await limiter.acquire('test_user', TransportType.sms)
+    with pytest.raises(RateLimitException):
+        await limiter.acquire('test_user', TransportType.sms)
+
+
+def test_check_reports_when_window_has_room():
+    limiter = RateLimiter({'sms': {'hour': 2, 'day': 3}})
+    now = time.time()
+    limiter._sends[('test_user', TransportType.sms)] = [now - 3000, now - 1200]
+    with pytest.raises(RateLimitException) as exc_info:
+        limiter.check('test_user', TransportType.sms, now=now)
+    # the hour window has room once the send 3000 seconds ago ages out
+    assert exc_info.value.retry_after == pytest.approx(600)
+    limiter._sends[('test_user', TransportType.sms)] = [now - 80000, now - 3000, now - 1200]
+    with pytest.raises(RateLimitException) as exc_info:
+        limiter.check('test_user', TransportType.sms, now=now)
+    # both windows are full, the day window frees up last
+    assert exc_info.value.retry_after == pytest.approx(6400)
+
+
+@pytest.mark.asyncio
+async def test_cancel():
+    limiter = RateLimiter({'email': {'hour': 1, 'day': 10}})
+    sent_at = await limiter.acquire('test_user', TransportType.email)
+    limiter.cancel('test_user', TransportType.email, sent_at)
+    await limiter.acquire('test_user', TransportType.email)
+
+
+@pytest.mark.asyncio
+async def test_reconcile(mocked_pool):
+    mocked_pool.fetch.return_value = [
+        {'username': 'test_user', 'transport': TransportType.email.value, 'ages': [60.0]}
+    ]
+    limiter = RateLimiter({'email': {'hour': 1, 'day': 10}})
+    await limiter.reconcile(mocked_pool)
+    assert limiter.counts('test_user', TransportType.email) == {'hour': 1, 'day': 1}
+    with pytest.raises(RateLimitException):
+        limiter.check('test_user', TransportType.email)
+
+
+@pytest.mark.asyncio
+async def test_shared_limiter_sees_other_processes_sends(mocked_pool):
+    # another process sent test_user an email a minute ago
+    mocked_pool.fetch.return_value = [{'age': 60.0}]
+    limiter = RateLimiter({'email': {'hour': 1, 'day': 10}}, pool=mocked_pool)
+    with pytest.raises(RateLimitException):
+        await limiter.acquire('test_user', TransportType.email)
+    mocked_pool.fetch.return_value = []
+    await limiter.acquire('other_user', TransportType.email)
+    # unlimited transports don't query
+    await limiter.acquire('test_user', TransportType.desktop)
+    assert mocked_pool.fetch.call_count == 2
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+import multiprocessing
+import threading
+import time
+from unittest import mock
+
+from yo.services.notification_sender.supervisor import MAX_RESTART_DELAY
+from yo.services.notification_sender.supervisor import SenderProcess
+from yo.services.notification_sender.supervisor import SenderSupervisor
+
+
+def test_restart_delay_backs_off():
+    child = SenderProcess(0, {}, multiprocessing.get_context('fork'))
+    delays = []
+    for restarts in range(10):
+        child.restarts = restarts
+        delays.append(child.restart_delay())
+    assert delays[:3] == [1, 2, 4]
+    assert max(delays) == MAX_RESTART_DELAY
+
+
+def test_is_hung():
+    child = SenderProcess(0, {}, multiprocessing.get_context('fork'))
+    child.heartbeat.value = time.time()
+    assert child.is_hung(60) is False
+    child.heartbeat.value = time.time() - 120
+    assert child.is_hung(60) is True
+    assert child.is_alive() is False
+
+
+def exited_child(supervisor:SenderSupervisor) -> SenderProcess:
+    child = supervisor.children[0]
+    child.process = mock.Mock(exitcode=1, pid=1)
+    child.process.is_alive.return_value = False
+    child.started = time.time()
+    child.start = mock.Mock()
+    return child
+
+
+def test_check_restarts_exited_child():
+    supervisor = SenderSupervisor(1, {})
+    child = exited_child(supervisor)
+    with mock.patch.object(SenderProcess, 'restart_delay', return_value=0):
+        supervisor.check()
+    child.start.assert_called_once_with()
+    assert child.restarts == 1
+
+
+def test_stop_during_restart_delay_skips_restart():
+    supervisor = SenderSupervisor(1, {})
+    child = exited_child(supervisor)
+    child.restarts = 5
+    timer = threading.Timer(0.1, supervisor._stop, args=(15, None))
+    timer.start()
+    started = time.time()
+    supervisor.check()
+    assert time.time() - started < child.restart_delay()
+    child.start.assert_not_called()
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+import os
+
+import pytest
+
+from yo.schema import NotificationType
+from yo.services.notification_sender.transports.email import SendGridTransport
+from yo.services.notification_sender.transports.email.email_templates import EmailRenderer
+from yo.services.notification_sender.transports.email.email_templates import template_name
+
+TEMPLATES_DIR = os.path.join(os.path.dirname(__file__), '..', '..', '..', '..', '..',
+                             'mail_templates')
+
+# notification types the blockchain follower creates
+FOLLOWER_TYPES = [
+    NotificationType.power_down,
+    NotificationType.resteem,
+    NotificationType.send,
+    NotificationType.mention,
+    NotificationType.follow,
+    NotificationType.vote,
+    NotificationType.comment_reply,
+    NotificationType.post_reply,
+    NotificationType.account_update,
+    NotificationType.receive
+]
+
+TEST_JSON_DATA = ('{"author": "testuser1337", "permlink": "test-post", '
+                  '"amount": "1.000 STEEM", "from": "testuser1336", "to": "testuser1337", '
+                  '"memo": "", "vesting_shares": "1.000000 VESTS"}')
+
+
+def queued_notification(notify_type):
+    return {'nid': 1, 'eid': '20000000/1/0/0', 'notify_type': int(notify_type),
+            'to_username': 'testuser1337', 'from_username': 'testuser1336',
+            'json_data': TEST_JSON_DATA, 'priority': 2}
+
+
+def test_template_name():
+    assert template_name(NotificationType.vote.value) == 'vote'
+
+
+@pytest.mark.parametrize('notify_type', FOLLOWER_TYPES)
+def test_render_follower_types(notify_type):
+    transport = SendGridTransport()
+    transport.renderer = EmailRenderer(TEMPLATES_DIR)
+    email = transport.render(queued_notification(notify_type))
+    assert email['subject']
+    assert 'testuser13' in email['subject'] + email['text']
+
+
+def test_render_failure_raises():
+    transport = SendGridTransport()
+    transport.renderer = EmailRenderer(TEMPLATES_DIR)
+    with pytest.raises(Exception):
+        transport.render(queued_notification(NotificationType.feed))
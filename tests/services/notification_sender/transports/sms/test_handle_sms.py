@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+from yo.schema import NotificationType
+from yo.services.notification_sender.transports.sms import SMS_MESSAGES
+from yo.services.notification_sender.transports.sms import TwilioTransport
+
+TEST_JSON_DATA = ('{"author": "testuser1337", "permlink": "test-post", '
+                  '"amount": "1.000 STEEM", "from": "testuser1336", "to": "testuser1337", '
+                  '"memo": "", "vesting_shares": "1.000000 VESTS"}')
+
+
+def queued_notification(notify_type):
+    return {'nid': 1, 'eid': '20000000/1/0/0', 'notify_type': int(notify_type),
+            'to_username': 'testuser1337', 'from_username': 'testuser1336',
+            'json_data': TEST_JSON_DATA, 'priority': 2}
+
+
+@pytest.mark.parametrize('notify_type', list(SMS_MESSAGES))
+def test_render(notify_type):
+    message = TwilioTransport().render(queued_notification(notify_type))
+    assert message.startswith('Steemit: ')
+    assert '{' not in message
+
+
+def test_render_unknown_type_raises():
+    with pytest.raises(KeyError):
+        TwilioTransport().render(queued_notification(NotificationType.feed))
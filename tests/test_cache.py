@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+import asyncio
+
+import pytest
+
+from yo.cache import AsyncTTLCache
+
+
+def test_lru_eviction():
+    cache = AsyncTTLCache(maxsize=2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert cache.get('a') == 1
+    cache.set('c', 3)
+    assert 'b' not in cache
+    assert cache.get('a') == 1
+    assert cache.get('c') == 3
+    assert cache.evictions == 1
+
+
+def test_ttl_expiry():
+    cache = AsyncTTLCache(ttl=-1)
+    cache.set('a', 1)
+    assert cache.get('a') is None
+    assert cache.stats()['misses'] == 1
+
+
+@pytest.mark.asyncio
+async def test_get_or_fetch_coalesces():
+    cache = AsyncTTLCache()
+    calls = []
+
+    async def fetch(key):
+        calls.append(key)
+        await asyncio.sleep(0.01)
+        return key.upper()
+
+    results = await asyncio.gather(*[cache.get_or_fetch('a', fetch, 'a') for _ in range(5)])
+    assert results == ['A'] * 5
+    assert calls == ['a']
+    assert await cache.get_or_fetch('a', fetch, 'a') == 'A'
+    assert cache.hits == 1
+    assert cache.misses == 5
+
+
+@pytest.mark.asyncio
+async def test_invalidate_drops_inflight_result():
+    cache = AsyncTTLCache()
+    values = iter(['stale', 'fresh'])
+
+    async def fetch():
+        value = next(values)
+        await asyncio.sleep(0.01)
+        return value
+
+    inflight = asyncio.ensure_future(cache.get_or_fetch('a', fetch))
+    await asyncio.sleep(0)
+    cache.invalidate('a')
+    # the fetch started before the invalidation isn't cached
+    assert await inflight == 'stale'
+    assert 'a' not in cache
+    assert await cache.get_or_fetch('a', fetch) == 'fresh'
+    assert cache.get('a') == 'fresh'
@@ -0,0 +1,37 @@
+# coding=utf-8
+import asynctest
+import pytest
+
+from yo.steemd_client import AsyncSteemd
+from yo.steemd_client import SteemdRPCError
+
+
+@pytest.mark.asyncio
+async def test_get_ops_in_blocks_batches():
+    steemd = AsyncSteemd(max_batch_size=2)
+    steemd._post = asynctest.CoroutineMock(side_effect=[
+        [{'id': 1, 'result': ['op2']}, {'id': 0, 'result': ['op1']}],
+        [{'id': 0, 'result': []}]
+    ])
+    result = await steemd.get_ops_in_blocks([1, 2, 3])
+    assert result == [['op1'], ['op2'], []]
+    first_batch = steemd._post.call_args_list[0][0][0]
+    assert [r['params'] for r in first_batch] == [[1, False], [2, False]]
+    assert first_batch[0]['method'] == 'condenser_api.get_ops_in_block'
+
+
+@pytest.mark.asyncio
+async def test_get_blocks_ops():
+    steemd = AsyncSteemd()
+    steemd._post = asynctest.CoroutineMock(return_value=[
+        {'id': 0, 'result': ['op1']}, {'id': 1, 'result': ['op2', 'op3']}])
+    assert await steemd.get_blocks_ops([1, 2]) == ['op1', 'op2', 'op3']
+
+
+@pytest.mark.asyncio
+async def test_batch_error():
+    steemd = AsyncSteemd()
+    steemd._post = asynctest.CoroutineMock(return_value=[
+        {'id': 0, 'error': {'code': -32000}}])
+    with pytest.raises(SteemdRPCError):
+        await steemd.get_blocks([1])
@@ -16,3 +16,37 @@ async def test_get_user_data(mocked_rpc_client_session):
 async def test_get_user_data():
     # FIXME
     pass
+
+@pytest.mark.asyncio
+async def test_get_user_data_batch():
+    from yo import rpc_client
+    responses = [
+        {'id': 1, 'jsonrpc': '2.0', 'error': {'code': 404}},
+        {'id': 0, 'jsonrpc': '2.0', 'result': {'email': 'test@example.com'}}
+    ]
+    with asynctest.patch.object(rpc_client, 'auth_batch_request',
+                                asynctest.CoroutineMock(return_value=responses)) as request:
+        result = await rpc_client.get_user_data_batch(['testuser1337', 'testuser1336'])
+    assert result == {'testuser1337': {'email': 'test@example.com'},
+                      'testuser1336': None}
+    rpc_requests = request.call_args[0][0]
+    assert [r['params']['username'] for r in rpc_requests] == ['testuser1337', 'testuser1336']
+
+
+@pytest.mark.asyncio
+async def test_get_user_data_batch_rejected():
+    from yo import rpc_client
+    response = {'id': None, 'jsonrpc': '2.0', 'error': {'code': -32600}}
+    with asynctest.patch.object(rpc_client, 'auth_batch_request',
+                                asynctest.CoroutineMock(return_value=response)):
+        with pytest.raises(ValueError):
+            await rpc_client.get_user_data_batch(['testuser1337', 'testuser1336'])
+
+
+@pytest.mark.asyncio
+async def test_configure_session_pool_size():
+    from yo import rpc_client
+    session = rpc_client.configure_session(pool_size=7)
+    assert rpc_client.get_session() is session
+    assert session.connector.limit == 7
+    await rpc_client.close_session()
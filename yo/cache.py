@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import itertools
+import time
+from collections import OrderedDict
+
+import structlog
+
+logger = structlog.getLogger(__name__, source='cache')
+
+_MISSING = object()
+
+
+class AsyncTTLCache:
+    """Bounded LRU cache with per-entry TTL for values fetched by coroutines
+
+    Concurrent get_or_fetch calls for the same key share one in-flight
+    fetch. Fetches returning None are cached for `negative_ttl` seconds
+    instead of `ttl`. Invalidating a key starts a new generation of it, the
+    result of a fetch started before the invalidation is returned to its
+    callers but not cached.
+    """
+    def __init__(self, maxsize:int=10000, ttl:float=3600, negative_ttl:float=None,
+                 name:str=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.negative_ttl = ttl if negative_ttl is None else negative_ttl
+        self.name = name
+        self._data = OrderedDict()
+        # key -> (generation, future) of the fetch whose result will be cached
+        self._inflight = dict()
+        self._generations = itertools.count()
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return self._lookup(key) is not _MISSING
+
+    def _lookup(self, key):
+        try:
+            expires, value = self._data[key]
+        except KeyError:
+            return _MISSING
+        if expires < time.monotonic():
+            del self._data[key]
+            return _MISSING
+        self._data.move_to_end(key)
+        return value
+
+    def _hit(self, value):
+        self.hits += 1
+        if value is None:
+            self.negative_hits += 1
+        return value
+
+    def get(self, key, default=None):
+        value = self._lookup(key)
+        if value is _MISSING:
+            self.misses += 1
+            return default
+        return self._hit(value)
+
+    def set(self, key, value, ttl:float=None) -> None:
+        if ttl is None:
+            ttl = self.negative_ttl if value is None else self.ttl
+        self._data[key] = (time.monotonic() + ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, key) -> None:
+        self._data.pop(key, None)
+        # a fetch already running may return the old value, don't cache it
+        self._inflight.pop(key, None)
+
+    def clear(self) -> None:
+        self._data.clear()
+        self._inflight.clear()
+
+    async def get_or_fetch(self, key, fetch, *args, **kwargs):
+        value = self._lookup(key)
+        if value is not _MISSING:
+            return self._hit(value)
+        self.misses += 1
+        inflight = self._inflight.get(key)
+        if inflight is None:
+            generation = next(self._generations)
+            future = asyncio.ensure_future(self._fetch(key, generation, fetch, *args, **kwargs))
+            inflight = self._inflight[key] = (generation, future)
+        return await asyncio.shield(inflight[1])
+
+    def _is_current(self, key, generation:int) -> bool:
+        inflight = self._inflight.get(key)
+        return inflight is not None and inflight[0] == generation
+
+    async def _fetch(self, key, generation:int, fetch, *args, **kwargs):
+        try:
+            value = await fetch(*args, **kwargs)
+            if self._is_current(key, generation):
+                self.set(key, value)
+            return value
+        finally:
+            if self._is_current(key, generation):
+                del self._inflight[key]
+
+    def stats(self) -> dict:
+        return {
+            'name':          self.name,
+            'size':          len(self._data),
+            'maxsize':       self.maxsize,
+            'hits':          self.hits,
+            'negative_hits': self.negative_hits,
+            'misses':        self.misses,
+            'evictions':     self.evictions,
+            'inflight':      len(self._inflight)
+        }
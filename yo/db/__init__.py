@@ -14,23 +14,23 @@ logger = structlog.getLogger(__name__)
 metadata = sqlalchemy.MetaData()
 
 def init_db(db_url):
-    from .notifications import notifications_table
-    from .users import user_settings_table
-    from .queue import queue
-    from .desktop import desktop
+    from .migrations import migrate
     url = make_url(db_url)
     log = logger.bind(db_url=url)
     log.info('initializing database')
-    engine = sa.create_engine(db_url)
-    metadata.create_all(bind=engine)
+    migrate(db_url)
     log.info('database initialized')
 
 def reset_db(db_url):
     from .actions import actions_table
+    from .checkpoints import checkpoints_table
     from .notifications import notifications_table
     from .users import user_settings_table
     from .queue import queue
     from .desktop import desktop
+    from .desktop import desktop_counts
+    from .migrations import migrate
+    from .migrations import schema_migrations_table
     url = make_url(db_url)
     log = logger.bind(db_url=url)
     engine = sa.create_engine(db_url)
@@ -38,7 +38,7 @@ def reset_db(db_url):
     metadata.drop_all(bind=engine)
     log.info('database reset')
     log.info('initializing database')
-    metadata.create_all(bind=engine)
+    migrate(db_url)
     log.info('database initialized')
 
 
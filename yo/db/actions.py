@@ -1,4 +1,6 @@
 # -*- coding: utf-8 -*-
+from typing import List
+from typing import Optional
 from typing import Tuple
 from typing import TypeVar
 import sqlalchemy as sa
@@ -12,6 +14,7 @@ from ..schema import ActionStatus
 from ..schema import TransportType
 
 from yo.db import metadata
+from .partitions import partition_by_month
 
 logger = structlog.getLogger(__name__, source='YoDB')
 
@@ -25,13 +28,17 @@ PERMANENT_FAIL_COUNT = 3
 actions_table = sa.Table(
     'actions',
     metadata,
-    sa.Column('aid', sa.BigInteger, primary_key=True),
+    sa.Column('aid', sa.BigInteger, primary_key=True, autoincrement=True),
     sa.Column('nid', sa.BigInteger),
     sa.Column('username', sa.Text(), index=True, nullable=False),
     sa.Column('transport', sa.Integer, nullable=False, index=True),
     sa.Column('status',sa.Integer,nullable=False,index=True),
-    sa.Column('created', sa.DateTime, index=True)
+    sa.Column('created', sa.DateTime, primary_key=True, index=True),
+    # covers the rate limit queries
+    sa.Index('actions_rates_ix', 'username', 'transport', 'status', 'created'),
+    postgresql_partition_by='RANGE (created)'
 )
+partition_by_month(actions_table)
 
 INSERT_ACTION_STMT = '''
     INSERT INTO actions(nid, username, transport, status, created)
@@ -39,6 +46,17 @@ INSERT_ACTION_STMT = '''
     RETURNING aid
 '''
 
+# a notification is recorded as rate limited once, however often it is re-leased
+RATE_LIMITED_ACTION_STMT = '''
+    INSERT INTO actions(nid, username, transport, status, created)
+    SELECT $1,$2,$3,$4,NOW()
+    WHERE NOT EXISTS (
+        SELECT 1 FROM actions
+        WHERE nid=$1 AND username=$2 AND transport=$3 AND status=$4
+    )
+    RETURNING aid
+'''
+
 GET_NOTIFICATION_STATE_STMT = '''
     SELECT status FROM actions WHERE nid=$1
     ORDER BY aid DESC
@@ -62,8 +80,27 @@ GET_RATES_STMT = '''
   GROUP BY hour
 '''
 
+# age in seconds of each send in the last day, per user and transport
+GET_RECENT_SENDS_STMT = '''
+  SELECT username, transport, array_agg(extract(epoch FROM NOW() - created)::float8) AS ages
+  FROM actions
+  WHERE status = $1 AND transport = ANY($2::int[]) AND created >= NOW() - '1 day'::interval
+  GROUP BY username, transport
+'''
+
+# age in seconds of each send in the last day to one user by one transport
+GET_USER_RECENT_SENDS_STMT = '''
+  SELECT extract(epoch FROM NOW() - created)::float8 AS age
+  FROM actions
+  WHERE username = $1 AND transport = $2 AND status = $3
+  AND created >= NOW() - '1 day'::interval
+'''
+
 class RateLimitException(BaseException):
-    pass
+    def __init__(self, retry_after:float=None):
+        super().__init__(retry_after)
+        # seconds until the exceeded window has room again, if known
+        self.retry_after = retry_after
 
 class PermanentFailException(BaseException):
     pass
@@ -90,9 +127,11 @@ async def mark_failed(pool_or_conn:PoolOrConn, nid:int, username:str, transport:
     return aid, nid, status
 
 
-async def mark_rate_limited(pool_or_conn:PoolOrConn, nid:int, username:str, transport:TransportType) -> ActionId:
-    return await store(pool_or_conn, nid, username, transport,
-                       status=ActionStatus.rate_limited)
+async def mark_rate_limited(pool_or_conn:PoolOrConn, nid:int, username:str, transport:TransportType) -> Optional[ActionId]:
+    """Store a rate_limited action unless the notification already has one
+    """
+    return await pool_or_conn.fetchval(RATE_LIMITED_ACTION_STMT, nid, username,
+                                       transport, ActionStatus.rate_limited)
 
 
 async def mark_sent(pool_or_conn:PoolOrConn, nid:int, username:str, transport:TransportType) -> ActionId:
@@ -103,3 +142,15 @@ async def mark_sent(pool_or_conn:PoolOrConn, nid:int, username:str, transport:Tr
 async def get_rates(pool_or_conn:PoolOrConn, username:str, transport:TransportType, ):
     rows = await pool_or_conn.fetch(GET_RATES_STMT, username, transport, ActionStatus.sent.value)
     return rows
+
+
+async def get_recent_sends(pool_or_conn:PoolOrConn, transports:list):
+    return await pool_or_conn.fetch(GET_RECENT_SENDS_STMT, ActionStatus.sent.value,
+                                    [int(t) for t in transports])
+
+
+async def get_user_recent_sends(pool_or_conn:PoolOrConn, username:str,
+                                transport:TransportType) -> List[float]:
+    rows = await pool_or_conn.fetch(GET_USER_RECENT_SENDS_STMT, username, int(transport),
+                                    ActionStatus.sent.value)
+    return [row['age'] for row in rows]
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+from typing import Optional
+from typing import TypeVar
+
+import sqlalchemy as sa
+import structlog
+
+from asyncpg.pool import Pool
+from asyncpg.connection import Connection
+
+from yo.db import metadata
+
+logger = structlog.getLogger(__name__, source='YoDB')
+
+PoolOrConn = TypeVar('PoolOrConn', Pool, Connection)
+
+FOLLOWER_CHECKPOINT = 'blockchain_follower'
+
+checkpoints_table = sa.Table(
+    'checkpoints',
+    metadata,
+    sa.Column('name', sa.Text(), primary_key=True),
+    sa.Column('block_num', sa.BigInteger(), nullable=False),
+    sa.Column('updated', sa.DateTime, default=sa.func.now(), nullable=False)
+)
+
+GET_CHECKPOINT_STMT = '''
+SELECT block_num FROM checkpoints WHERE name = $1
+'''
+
+SET_CHECKPOINT_STMT = '''
+INSERT INTO checkpoints(name, block_num, updated)
+VALUES ($1, $2, NOW())
+ON CONFLICT (name) DO UPDATE SET block_num = EXCLUDED.block_num, updated = NOW()
+'''
+
+
+async def get_checkpoint(pool_or_conn:PoolOrConn, name:str=FOLLOWER_CHECKPOINT) -> Optional[int]:
+    return await pool_or_conn.fetchval(GET_CHECKPOINT_STMT, name)
+
+
+async def set_checkpoint(pool_or_conn:PoolOrConn, name:str, block_num:int) -> None:
+    await pool_or_conn.execute(SET_CHECKPOINT_STMT, name, block_num)
@@ -4,12 +4,26 @@
 import click
 import yo.yolog
 
-@click.command(name='db')
+@click.group(name='db')
+def db():
+    pass
+
+
+@db.command()
 @click.option('--database_url', envvar='DATABASE_URL')
 def reset(database_url):
     from yo.db import reset_db
     reset_db(database_url)
 
 
+@db.command()
+@click.option('--database_url', envvar='DATABASE_URL')
+@click.option('--target', type=int, default=None,
+              help='migrate up to this version, defaults to the latest')
+def migrate(database_url, target):
+    from yo.db.migrations import migrate as migrate_db
+    migrate_db(database_url, target=target)
+
+
 if __name__ == "__main__":
-    reset()
+    db()
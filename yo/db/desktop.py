@@ -1,5 +1,10 @@
 # -*- coding: utf-8 -*-
 
+import asyncio
+from datetime import datetime
+from typing import List
+from typing import Tuple
+
 import sqlalchemy as sa
 import structlog
 import toolz
@@ -8,48 +13,220 @@ import toolz
 logger = structlog.getLogger(__name__, source='YoDB')
 
 from yo.db import metadata
+from .partitions import partition_by_month
+from ..schema import ActionStatus
 from ..schema import NotificationType
+from ..schema import TransportType
 
 
 desktop = sa.Table(
     'desktop',
     metadata,
-    sa.Column('dnid', sa.BigInteger(), primary_key=True),
+    sa.Column('dnid', sa.BigInteger(), primary_key=True, autoincrement=True),
     sa.Column('eid', sa.Text()),
     sa.Column('notify_type', sa.Integer(), nullable=False),
-    sa.Column('to_username',sa.Text(),nullable=False, index=True),
+    sa.Column('to_username',sa.Text(),nullable=False),
     sa.Column('from_username',sa.Text(),nullable=True),
     sa.Column('json_data', sa.UnicodeText()),
-    sa.Column('created', sa.DateTime, nullable=False),
+    sa.Column('created', sa.DateTime, nullable=False, primary_key=True),
     sa.Column('shown', sa.DateTime, nullable=True),
     sa.Column('read', sa.DateTime, nullable=True),
-    sa.Index('ix_desktop','to_username','shown','read')
+    # feed pages are keyset scans of these, newest first
+    sa.Index('desktop_feed_ix', 'to_username', sa.text('created DESC'), sa.text('dnid DESC')),
+    sa.Index('desktop_unread_feed_ix', 'to_username', sa.text('created DESC'), sa.text('dnid DESC'),
+             postgresql_where=sa.text('read IS NULL')),
+    postgresql_partition_by='RANGE (created)'
+)
+partition_by_month(desktop)
+
+DESKTOP_CHANNEL = 'desktop_changefeed'
+
+# NOTIFY DESKTOP_CHANNEL with [dnid, to_username, notify_type, from_username]
+# arrays of the inserted rows, at most 100 rows per notification
+sa.event.listen(desktop, 'after_create', sa.DDL(f'''
+CREATE OR REPLACE FUNCTION notify_desktop_inserted() RETURNS TRIGGER AS $$
+DECLARE
+    chunk json;
+BEGIN
+    FOR chunk IN
+        SELECT json_agg(json_build_array(dnid, to_username, notify_type, from_username))
+        FROM (SELECT dnid, to_username, notify_type, from_username,
+                     (row_number() OVER ()) / 100 AS grp
+              FROM new_rows) numbered
+        GROUP BY grp
+    LOOP
+        PERFORM pg_notify('{DESKTOP_CHANNEL}', chunk::text);
+    END LOOP;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER desktop_inserted_trigger AFTER INSERT ON desktop
+REFERENCING NEW TABLE AS new_rows
+FOR EACH STATEMENT EXECUTE PROCEDURE notify_desktop_inserted();
+'''))
+
+# unread and unshown desktop notifications per user, kept up to date by the
+# statements below which insert or mark desktop rows
+desktop_counts = sa.Table(
+    'desktop_counts',
+    metadata,
+    sa.Column('username', sa.Text(), primary_key=True),
+    sa.Column('unread', sa.Integer(), nullable=False, server_default='0'),
+    sa.Column('unshown', sa.Integer(), nullable=False, server_default='0'),
+    sa.Column('updated', sa.DateTime, nullable=False, server_default=sa.func.now())
 )
 
-CREATE_STMT = '''
-INSERT INTO desktop(eid, notify_type, to_username, from_username, json_data, created)
-VALUES ($1, $2, $3, $4, $5, NOW())
-RETURNING dnid
+# count the rows of a delivered (to_username, ...) CTE as unread and unshown
+COUNT_DELIVERED_CTE = '''
+counted AS (
+    INSERT INTO desktop_counts(username, unread, unshown, updated)
+    SELECT to_username, COUNT(*), COUNT(*), NOW()
+    FROM delivered
+    GROUP BY to_username
+    -- lock counters in username order so concurrent batches can't deadlock
+    ORDER BY to_username
+    ON CONFLICT (username) DO UPDATE
+    SET unread = desktop_counts.unread + EXCLUDED.unread,
+        unshown = desktop_counts.unshown + EXCLUDED.unshown,
+        updated = NOW()
+)'''
+
+CREATE_STMT = f'''
+WITH delivered AS (
+    INSERT INTO desktop(eid, notify_type, to_username, from_username, json_data, created)
+    VALUES ($1, $2, $3, $4, $5, NOW())
+    RETURNING dnid, to_username
+),
+{COUNT_DELIVERED_CTE}
+SELECT dnid FROM delivered
+'''
+
+# claim up to $1 unleased desktop queue rows, store them as desktop
+# notifications, record them as sent and delete them, in one statement
+DELIVER_BATCH_STMT = f'''
+WITH claimed AS (
+    DELETE FROM queue
+    WHERE transport = {TransportType.desktop.value}
+    AND qid IN (
+        SELECT qid
+        FROM queue
+        WHERE transport = {TransportType.desktop.value}
+        AND (leased_until IS NULL OR leased_until < NOW())
+        ORDER BY priority DESC, qid
+        FOR UPDATE SKIP LOCKED
+        LIMIT $1
+    )
+    RETURNING data
+),
+delivered AS (
+    INSERT INTO desktop(eid, notify_type, to_username, from_username, json_data, created)
+    SELECT data->>'eid',
+           (data->>'notify_type')::int,
+           data->>'to_username',
+           data->>'from_username',
+           data->>'json_data',
+           NOW()
+    FROM claimed
+    RETURNING dnid, notify_type, to_username
+),
+sent AS (
+    INSERT INTO actions(nid, username, transport, status, created)
+    SELECT (data->>'nid')::bigint,
+           data->>'to_username',
+           {TransportType.desktop.value},
+           {ActionStatus.sent.value},
+           NOW()
+    FROM claimed
+),
+{COUNT_DELIVERED_CTE}
+SELECT dnid, notify_type, to_username FROM delivered
 '''
 
-GET_STMT = '''
-SELECT * FROM desktop where to_username == $1 and shown = $2 and read = $3
+FEED_STMT = '''
+SELECT dnid, eid, notify_type, to_username, from_username, json_data,
+       created, shown, read, GREATEST(created, shown, read) AS updated
+FROM desktop
+WHERE {where}
+ORDER BY created DESC, dnid DESC
+LIMIT {limit}
 '''
 
-MARK_SHOWN_STMT = '''
-UPDATE desktop SET shown = NOW() WHERE dnid = $1
+MAX_FEED_LIMIT = 100
+
+# update $1 dnids of user $2 whose column is not already in the new state and adjust
+# the matching counter of their users by delta; the counters are locked in
+# username order first, the join of an UPDATE ... FROM has no fixed order
+MARK_STMT = '''
+WITH changed AS (
+    UPDATE desktop SET {column} = {value}
+    WHERE dnid = ANY($1::bigint[]) AND to_username = $2 AND {column} IS {current}
+    RETURNING dnid, to_username
+),
+locked AS (
+    SELECT c.username, d.n
+    FROM desktop_counts c
+    JOIN (SELECT to_username, COUNT(*) AS n FROM changed GROUP BY to_username) d
+    ON c.username = d.to_username
+    ORDER BY c.username
+    FOR UPDATE OF c
+),
+counted AS (
+    UPDATE desktop_counts c
+    SET {counter} = GREATEST(c.{counter} + {delta} * l.n, 0), updated = NOW()
+    FROM locked l
+    WHERE c.username = l.username
+)
+SELECT dnid FROM changed
 '''
 
-MARK_READ_STMT = '''
-UPDATE desktop SET read = NOW() WHERE dnid = $1
+MARK_SHOWN_STMT = MARK_STMT.format(column='shown', value='NOW()', current='NULL',
+                                   counter='unshown', delta=-1)
+MARK_READ_STMT = MARK_STMT.format(column='read', value='NOW()', current='NULL',
+                                  counter='unread', delta=-1)
+MARK_UNSHOWN_STMT = MARK_STMT.format(column='shown', value='NULL', current='NOT NULL',
+                                     counter='unshown', delta=1)
+MARK_UNREAD_STMT = MARK_STMT.format(column='read', value='NULL', current='NOT NULL',
+                                    counter='unread', delta=1)
+
+GET_COUNTS_STMT = '''
+SELECT unread, unshown FROM desktop_counts WHERE username = $1
 '''
 
-MARK_UNSHOWN_STMT = '''
-UPDATE desktop SET shown = NULL WHERE dnid = $1
+# recount a batch of users after $1, in username order
+RECONCILE_COUNTS_STMT = '''
+UPDATE desktop_counts c
+SET unread = d.unread, unshown = d.unshown, updated = NOW()
+FROM (
+    SELECT batch.username,
+           COUNT(dt.dnid) FILTER (WHERE dt.read IS NULL) AS unread,
+           COUNT(dt.dnid) FILTER (WHERE dt.shown IS NULL) AS unshown
+    FROM (SELECT username FROM desktop_counts
+          WHERE username > $1 ORDER BY username LIMIT $2) batch
+    LEFT JOIN desktop dt ON dt.to_username = batch.username
+    GROUP BY batch.username
+) d
+WHERE c.username = d.username
+AND (c.unread <> d.unread OR c.unshown <> d.unshown)
+RETURNING c.username
 '''
 
-MARK_UNREAD_STMT = '''
-UPDATE desktop SET read = NULL WHERE dnid = $1
+RECONCILE_BATCH_END_STMT = '''
+SELECT MAX(username) FROM (
+    SELECT username FROM desktop_counts WHERE username > $1 ORDER BY username LIMIT $2
+) batch
+'''
+
+# counters for users with desktop rows from before desktop_counts existed
+SEED_COUNTS_STMT = '''
+INSERT INTO desktop_counts(username, unread, unshown, updated)
+SELECT to_username,
+       COUNT(*) FILTER (WHERE read IS NULL),
+       COUNT(*) FILTER (WHERE shown IS NULL),
+       NOW()
+FROM desktop
+GROUP BY to_username
+ON CONFLICT (username) DO NOTHING
 '''
 
 async def create_desktop_notification(conn,
@@ -60,18 +237,123 @@ async def create_desktop_notification(conn,
                                       json_data:dict=None) -> int:
     return await conn.fetchval(CREATE_STMT, eid, notify_type, to_username, from_username, json_data)
 
-async def get_user_desktop_notifications(pool, username:str, read=None, shown=None):
-    return await pool.fetch(GET_STMT, username, read, shown)
+async def deliver_batch(conn, limit:int=500) -> list:
+    """Move up to limit desktop queue items into the desktop table
+
+    Returns:
+        list: dnid, notify_type, to_username records of the stored notifications
+    """
+    return await conn.fetch(DELIVER_BATCH_STMT, limit)
+
+def _feed_query(username:str,
+                created_before:datetime=None,
+                before_dnid:int=None,
+                updated_after:datetime=None,
+                read:bool=None,
+                notify_types:List[int]=None,
+                limit:int=30) -> Tuple[str, list]:
+    where = ['to_username = $1']
+    args = [username]
+
+    def arg(value) -> str:
+        args.append(value)
+        return f'${len(args)}'
+
+    if created_before is not None and before_dnid is not None:
+        # keyset cursor, the last row of the previous page
+        where.append(f'(created, dnid) < ({arg(created_before)}, {arg(before_dnid)})')
+    elif created_before is not None:
+        where.append(f'created < {arg(created_before)}')
+    if updated_after is not None:
+        where.append(f'GREATEST(created, shown, read) > {arg(updated_after)}')
+    if read is False:
+        where.append('read IS NULL')
+    elif read is True:
+        where.append('read IS NOT NULL')
+    if notify_types:
+        where.append(f'notify_type = ANY({arg(list(notify_types))}::int[])')
+    limit = max(1, min(int(limit), MAX_FEED_LIMIT))
+    return FEED_STMT.format(where=' AND '.join(where), limit=limit), args
+
+async def get_user_desktop_notifications(pool,
+                                         username:str,
+                                         created_before:datetime=None,
+                                         before_dnid:int=None,
+                                         updated_after:datetime=None,
+                                         read:bool=None,
+                                         notify_types:List[int]=None,
+                                         limit:int=30) -> list:
+    """Fetch one page of a user's notifications, newest first
+
+    Pass the created and dnid of the last row of a page as created_before
+    and before_dnid to get the next page.
+    """
+    stmt, args = _feed_query(username,
+                             created_before=created_before,
+                             before_dnid=before_dnid,
+                             updated_after=updated_after,
+                             read=read,
+                             notify_types=notify_types,
+                             limit=limit)
+    return await pool.fetch(stmt, *args)
+
+def _dnids(dnids) -> List[int]:
+    if isinstance(dnids, int):
+        return [dnids]
+    return list(dnids)
+
+async def _mark(pool, stmt:str, username:str, dnids) -> List[int]:
+    dnids = _dnids(dnids)
+    if not dnids:
+        return []
+    rows = await pool.fetch(stmt, dnids, username)
+    return [row['dnid'] for row in rows]
+
+async def mark_shown(pool, username:str, dnids) -> List[int]:
+    """Mark username's notifications shown, returns the dnids which were not already shown
+    """
+    return await _mark(pool, MARK_SHOWN_STMT, username, dnids)
+
+async def mark_read(pool, username:str, dnids) -> List[int]:
+    """Mark username's notifications read, returns the dnids which were not already read
+    """
+    return await _mark(pool, MARK_READ_STMT, username, dnids)
 
-async def mark_shown(pool, dnid):
-    return await pool.execute(MARK_SHOWN_STMT, dnid)
+async def mark_unshown(pool, username:str, dnids) -> List[int]:
+    return await _mark(pool, MARK_UNSHOWN_STMT, username, dnids)
 
-async def mark_read(pool, dnid):
-    return await pool.execute(MARK_READ_STMT, dnid)
+async def mark_unread(pool, username:str, dnids) -> List[int]:
+    return await _mark(pool, MARK_UNREAD_STMT, username, dnids)
 
-async def mark_unshown(pool, dnid):
-    return await pool.execute(MARK_UNSHOWN_STMT, dnid)
+async def get_counts(pool, username:str) -> dict:
+    row = await pool.fetchrow(GET_COUNTS_STMT, username)
+    if row is None:
+        return {'unread': 0, 'unshown': 0}
+    return {'unread': row['unread'], 'unshown': row['unshown']}
 
-async def mark_unread(pool, dnid):
-    return await pool.execute(MARK_UNREAD_STMT, dnid)
+async def reconcile_counts(pool, batch_size:int=1000, seed:bool=False) -> int:
+    """Recount every user's counters in batches, returns the number corrected
+    """
+    if seed:
+        await pool.execute(SEED_COUNTS_STMT)
+    corrected = 0
+    after = ''
+    while True:
+        rows = await pool.fetch(RECONCILE_COUNTS_STMT, after, batch_size)
+        corrected += len(rows)
+        after = await pool.fetchval(RECONCILE_BATCH_END_STMT, after, batch_size)
+        if after is None:
+            break
+    if corrected:
+        logger.warning('desktop counts corrected', corrected=corrected)
+    return corrected
 
+async def reconcile_counts_task(pool, interval:float=3600, batch_size:int=1000) -> None:
+    seed = True
+    while True:
+        try:
+            await reconcile_counts(pool, batch_size=batch_size, seed=seed)
+            seed = False
+        except Exception:
+            logger.exception('desktop counts reconcile failed')
+        await asyncio.sleep(interval)
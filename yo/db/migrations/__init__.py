@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+"""Versioned schema migrations
+
+Each migration is a module in this package with a `version`, a docstring
+describing it, an `upgrade(conn)` function and a `transactional` flag.
+Migrations are frozen once released, they spell out their own SQL rather
+than using the table definitions, which describe the latest schema.
+Transactional migrations run in a transaction with the insert of their
+schema_migrations row. Migrations which can't run in a transaction, like
+CREATE INDEX CONCURRENTLY, run in autocommit mode and must be safe to
+re-run if they fail halfway.
+"""
+from datetime import datetime
+from typing import List
+
+import sqlalchemy as sa
+import structlog
+
+from sqlalchemy.engine.url import make_url
+
+from yo.db import metadata
+
+from . import m0001_baseline
+from . import m0002_checkpoints
+from . import m0003_queue_leases
+from . import m0004_desktop_counts
+from . import m0005_hot_query_indexes
+from . import m0006_users_changefeed
+from . import m0007_queue_attempts
+from . import m0008_notification_keys
+from . import m0009_monthly_partitions
+
+logger = structlog.getLogger(__name__, source='YoDB')
+
+MIGRATIONS = sorted([
+    m0001_baseline,
+    m0002_checkpoints,
+    m0003_queue_leases,
+    m0004_desktop_counts,
+    m0005_hot_query_indexes,
+    m0006_users_changefeed,
+    m0007_queue_attempts,
+    m0008_notification_keys,
+    m0009_monthly_partitions
+], key=lambda m: m.version)
+
+# held while migrating so two deploys don't migrate at once
+MIGRATE_LOCK_KEY = 7476925
+
+schema_migrations_table = sa.Table(
+    'schema_migrations',
+    metadata,
+    sa.Column('version', sa.Integer(), primary_key=True),
+    sa.Column('name', sa.Text(), nullable=False),
+    sa.Column('applied', sa.DateTime, nullable=False)
+)
+
+
+def migration_name(migration) -> str:
+    return migration.__name__.rsplit('.', 1)[-1]
+
+
+def applied_versions(conn) -> set:
+    schema_migrations_table.create(bind=conn, checkfirst=True)
+    rows = conn.execute(sa.select([schema_migrations_table.c.version]))
+    return {row[0] for row in rows}
+
+
+def _record(conn, migration) -> None:
+    conn.execute(schema_migrations_table.insert().values(
+        version=migration.version,
+        name=migration_name(migration),
+        applied=datetime.utcnow()))
+
+
+def _apply(engine, migration) -> None:
+    if migration.transactional:
+        with engine.begin() as conn:
+            migration.upgrade(conn)
+            _record(conn, migration)
+        return
+    with engine.connect() as conn:
+        conn = conn.execution_options(isolation_level='AUTOCOMMIT')
+        migration.upgrade(conn)
+        _record(conn, migration)
+
+
+def pending_migrations(applied:set, target:int=None) -> list:
+    return [m for m in MIGRATIONS
+            if m.version not in applied and (target is None or m.version <= target)]
+
+
+def migrate(db_url:str, target:int=None) -> List[int]:
+    """Apply pending migrations up to target, returns the applied versions
+    """
+    log = logger.bind(db_url=make_url(db_url))
+    engine = sa.create_engine(db_url)
+    applied = []
+    with engine.connect() as lock_conn:
+        lock_conn = lock_conn.execution_options(isolation_level='AUTOCOMMIT')
+        lock_conn.execute(sa.text('SELECT pg_advisory_lock(:key)'), key=MIGRATE_LOCK_KEY)
+        try:
+            pending = pending_migrations(applied_versions(lock_conn), target)
+            for migration in pending:
+                log.info('applying migration', version=migration.version,
+                         name=migration_name(migration))
+                _apply(engine, migration)
+                applied.append(migration.version)
+        finally:
+            lock_conn.execute(sa.text('SELECT pg_advisory_unlock(:key)'), key=MIGRATE_LOCK_KEY)
+    log.info('database migrated', applied=applied)
+    return applied
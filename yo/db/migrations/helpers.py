@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+"""Building blocks shared by migrations"""
+import sqlalchemy as sa
+
+RELKIND_SQL = 'SELECT relkind FROM pg_class WHERE oid = to_regclass(:name)'
+
+INDEX_VALID_SQL = 'SELECT indisvalid FROM pg_index WHERE indexrelid = to_regclass(:name)'
+
+LIST_PARTITIONS_SQL = '''
+SELECT c.relname
+FROM pg_inherits i
+JOIN pg_class c ON c.oid = i.inhrelid
+WHERE i.inhparent = to_regclass(:name)
+ORDER BY c.relname
+'''
+
+
+def _index_valid(conn, name:str):
+    """True or False for an existing index, None if there is no such index
+    """
+    return conn.execute(sa.text(INDEX_VALID_SQL), name=name).scalar()
+
+
+def _create_index_concurrently(conn, name:str, table_name:str, columns:str,
+                               where:str=None) -> None:
+    valid = _index_valid(conn, name)
+    if valid:
+        return
+    if valid is False:
+        # left behind by a failed concurrent build
+        conn.execute(f'DROP INDEX CONCURRENTLY {name}')
+    where = f' WHERE {where}' if where else ''
+    conn.execute(f'CREATE INDEX CONCURRENTLY {name} ON {table_name} ({columns}){where}')
+
+
+def create_index_concurrently(conn, name:str, table_name:str, columns:str,
+                              where:str=None) -> None:
+    """Build an index without blocking writes, conn must be in autocommit mode
+
+    Postgres can't build indexes on partitioned tables concurrently, so for
+    those each partition is indexed concurrently, then an index is created
+    on the parent alone and the partition indexes are attached to it.
+    """
+    if _index_valid(conn, name):
+        return
+    relkind = conn.execute(sa.text(RELKIND_SQL), name=table_name).scalar()
+    if relkind != 'p':
+        _create_index_concurrently(conn, name, table_name, columns, where)
+        return
+    where_clause = f' WHERE {where}' if where else ''
+    conn.execute(f'CREATE INDEX IF NOT EXISTS {name} '
+                 f'ON ONLY {table_name} ({columns}){where_clause}')
+    partitions = [row[0] for row in
+                  conn.execute(sa.text(LIST_PARTITIONS_SQL), name=table_name)]
+    for partition in partitions:
+        partition_index = f'{partition}_{name}'
+        _create_index_concurrently(conn, partition_index, partition, columns, where)
+        conn.execute(f'ALTER INDEX {name} ATTACH PARTITION {partition_index}')
+
+
+TABLE_INDEXES_SQL = '''
+SELECT c.relname
+FROM pg_index i
+JOIN pg_class c ON c.oid = i.indexrelid
+WHERE i.indrelid = to_regclass(:name)
+'''
+
+SERIAL_SEQUENCES_SQL = '''
+SELECT pg_get_serial_sequence(:name, attname)
+FROM pg_attribute
+WHERE attrelid = to_regclass(:name) AND attnum > 0 AND NOT attisdropped
+'''
+
+
+def execute_sql(conn, sql:str) -> None:
+    """Run a block of SQL, like plpgsql function definitions, as-is
+    """
+    # text() escapes the % and leaves the :: casts of the SQL alone
+    conn.execute(sa.text(sql))
+
+
+def table_exists(conn, table_name:str) -> bool:
+    return conn.execute(sa.text(RELKIND_SQL), name=table_name).scalar() is not None
+
+
+def is_partitioned(conn, table_name:str) -> bool:
+    return conn.execute(sa.text(RELKIND_SQL), name=table_name).scalar() == 'p'
+
+
+def set_aside(conn, table_name:str, suffix:str) -> str:
+    """Rename a table with its indexes and serial sequences out of the way
+
+    The table can then be recreated under its own name, with the same index
+    and sequence names. Returns the new name of the old table.
+    """
+    indexes = [row[0] for row in conn.execute(sa.text(TABLE_INDEXES_SQL), name=table_name)]
+    for index in indexes:
+        conn.execute(f'ALTER INDEX {index} RENAME TO {index}_{suffix}')
+    sequences = [row[0] for row in conn.execute(sa.text(SERIAL_SEQUENCES_SQL), name=table_name)
+                 if row[0] is not None]
+    for sequence in sequences:
+        conn.execute(f'ALTER SEQUENCE {sequence} RENAME TO {sequence.rsplit(".", 1)[-1]}_{suffix}')
+    old_name = f'{table_name}_{suffix}'
+    conn.execute(f'ALTER TABLE {table_name} RENAME TO {old_name}')
+    return old_name
+
+
+def sync_sequence(conn, table_name:str, column:str, from_table:str) -> None:
+    """Start the serial sequence of table_name.column after the ids of from_table
+    """
+    conn.execute(sa.text(
+        f'SELECT setval(pg_get_serial_sequence(:name, :column), '
+        f'COALESCE((SELECT MAX({column}) FROM {from_table}), 0) + 1, false)'),
+        name=table_name, column=column)
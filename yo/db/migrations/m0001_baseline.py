@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+"""Tables as init_db created them before migrations existed
+
+Frozen, later schema changes are separate migrations. Databases which
+already have these tables are left as they are.
+"""
+from .helpers import execute_sql
+
+version = 1
+transactional = True
+
+BASELINE_SQL = '''
+CREATE TABLE IF NOT EXISTS notifications (
+    nid BIGSERIAL NOT NULL,
+    eid TEXT,
+    notify_type INTEGER NOT NULL,
+    to_username TEXT NOT NULL,
+    from_username TEXT,
+    json_data TEXT,
+    created TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+    priority INTEGER,
+    PRIMARY KEY (nid)
+);
+CREATE UNIQUE INDEX IF NOT EXISTS ix_notifications_unique ON notifications (eid, to_username);
+
+CREATE TABLE IF NOT EXISTS actions (
+    aid BIGSERIAL NOT NULL,
+    nid BIGINT,
+    username TEXT NOT NULL,
+    transport INTEGER NOT NULL,
+    status INTEGER NOT NULL,
+    created TIMESTAMP WITHOUT TIME ZONE,
+    PRIMARY KEY (aid)
+);
+CREATE INDEX IF NOT EXISTS ix_actions_username ON actions (username);
+CREATE INDEX IF NOT EXISTS ix_actions_transport ON actions (transport);
+CREATE INDEX IF NOT EXISTS ix_actions_status ON actions (status);
+CREATE INDEX IF NOT EXISTS ix_actions_created ON actions (created);
+
+CREATE TABLE IF NOT EXISTS users (
+    username TEXT NOT NULL,
+    transports JSONB NOT NULL,
+    created TIMESTAMP WITHOUT TIME ZONE,
+    updated TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+    PRIMARY KEY (username)
+);
+CREATE INDEX IF NOT EXISTS ix_users_updated ON users (updated);
+CREATE INDEX IF NOT EXISTS users_transports_ix ON users USING gin (transports);
+
+CREATE TABLE IF NOT EXISTS queue (
+    qid BIGSERIAL NOT NULL,
+    data JSONB NOT NULL,
+    transport INTEGER,
+    timestamp TIMESTAMP WITHOUT TIME ZONE,
+    PRIMARY KEY (qid)
+);
+CREATE INDEX IF NOT EXISTS ix_queue_transport ON queue (transport);
+CREATE INDEX IF NOT EXISTS ix_queue_timestamp ON queue (timestamp);
+
+CREATE TABLE IF NOT EXISTS desktop (
+    dnid BIGSERIAL NOT NULL,
+    eid TEXT,
+    notify_type INTEGER NOT NULL,
+    to_username TEXT NOT NULL,
+    from_username TEXT,
+    json_data TEXT,
+    created TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+    shown TIMESTAMP WITHOUT TIME ZONE,
+    read TIMESTAMP WITHOUT TIME ZONE,
+    PRIMARY KEY (dnid)
+);
+CREATE INDEX IF NOT EXISTS ix_desktop_to_username ON desktop (to_username);
+CREATE INDEX IF NOT EXISTS ix_desktop ON desktop (to_username, shown, read);
+'''
+
+
+def upgrade(conn) -> None:
+    execute_sql(conn, BASELINE_SQL)
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+"""Named block checkpoints of the blockchain follower and backfills
+"""
+from .helpers import execute_sql
+
+version = 2
+transactional = True
+
+CHECKPOINTS_SQL = '''
+CREATE TABLE IF NOT EXISTS checkpoints (
+    name TEXT NOT NULL,
+    block_num BIGINT NOT NULL,
+    updated TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+    PRIMARY KEY (name)
+);
+'''
+
+
+def upgrade(conn) -> None:
+    execute_sql(conn, CHECKPOINTS_SQL)
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+"""Rebuild the queue partitioned by transport, with leases and priorities
+
+The old queue's items are copied over, items without a known transport
+can't be delivered and are dropped. The queue is locked while it is
+rebuilt, it only holds undelivered items so this is quick.
+"""
+from .helpers import execute_sql
+from .helpers import set_aside
+from .helpers import sync_sequence
+
+version = 3
+transactional = True
+
+QUEUE_SQL = '''
+CREATE TABLE queue (
+    qid BIGSERIAL NOT NULL,
+    data JSONB NOT NULL,
+    transport INTEGER NOT NULL,
+    timestamp TIMESTAMP WITHOUT TIME ZONE DEFAULT now(),
+    leased_until TIMESTAMP WITHOUT TIME ZONE,
+    priority SMALLINT DEFAULT '2' NOT NULL,
+    PRIMARY KEY (qid, transport)
+) PARTITION BY LIST (transport);
+CREATE INDEX ix_queue_timestamp ON queue (timestamp);
+CREATE INDEX ix_queue_leased_until ON queue (leased_until);
+CREATE INDEX queue_priority_qid_ix ON queue (priority DESC, qid);
+CREATE TABLE queue_desktop PARTITION OF queue FOR VALUES IN (1);
+CREATE TABLE queue_email PARTITION OF queue FOR VALUES IN (2);
+CREATE TABLE queue_sms PARTITION OF queue FOR VALUES IN (3);
+'''
+
+COPY_QUEUE_SQL = '''
+INSERT INTO queue(qid, data, transport, timestamp, priority)
+SELECT qid, data, transport, COALESCE(timestamp, NOW()),
+       COALESCE((data->>'priority')::smallint, 2)
+FROM queue_unpartitioned
+WHERE transport IN (1, 2, 3)
+'''
+
+# the statement level insert trigger of yo/db/watch_table.sql as it was when
+# this migration was written, one NOTIFY per transport per INSERT
+WATCH_QUEUE_SQL = '''
+-- Check if rows on queue table have been added by a statement.
+-- Sends one notification per transport with the range of inserted qids,
+-- rather than one per row. Requires Postgres 10+ (transition tables).
+CREATE OR REPLACE FUNCTION if_insert_queue_table_stmt_func() RETURNS TRIGGER AS $$
+DECLARE
+    channel text;
+    inserted record;
+
+BEGIN
+    IF TG_WHEN <> 'AFTER' OR TG_LEVEL <> 'STATEMENT' THEN
+        RAISE EXCEPTION 'if_insert_queue_table_stmt_func() may only run as an AFTER STATEMENT trigger';
+    END IF;
+    IF TG_OP <> 'INSERT' THEN
+        RAISE EXCEPTION 'if_insert_queue_table_stmt_func() may only run as trigger on INSERT operations';
+    END IF;
+
+    channel = TG_ARGV[0];
+
+    FOR inserted IN
+        SELECT transport, MIN(qid) AS min_qid, MAX(qid) AS max_qid, COUNT(*) AS count
+        FROM new_rows
+        GROUP BY transport
+    LOOP
+        perform pg_notify(channel, jsonb_build_object(
+                                 'table_name', TG_TABLE_NAME::text,
+                                 'transaction_time', transaction_timestamp(),
+                                 'source', 'trigger',
+                                 'transport', inserted.transport,
+                                 'min_qid', inserted.min_qid,
+                                 'max_qid', inserted.max_qid,
+                                 'count', inserted.count)::text);
+    END LOOP;
+
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+
+-- Unwatch queue table.
+CREATE OR REPLACE FUNCTION unwatch_queue_table(target_table regclass) RETURNS void AS $$
+BEGIN
+    EXECUTE 'DROP TRIGGER IF EXISTS watch_trigger_row ON ' || target_table;
+    EXECUTE 'DROP TRIGGER IF EXISTS watch_trigger_stmt ON ' || target_table;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Create triggers that will execute on any change to the table.
+CREATE OR REPLACE FUNCTION watch_queue_table(target_table regclass, channel text) RETURNS void AS $$
+DECLARE
+  stmt text;
+BEGIN
+    -- Drop existing triggers if they exist.
+    PERFORM unwatch_queue_table(target_table);
+
+    -- Statement level watch trigger, one NOTIFY per transport per INSERT.
+    stmt = 'CREATE TRIGGER watch_trigger_stmt AFTER INSERT ON ' || target_table ||
+           ' REFERENCING NEW TABLE AS new_rows' ||
+           ' FOR EACH STATEMENT EXECUTE PROCEDURE if_insert_queue_table_stmt_func(' ||
+             quote_literal(channel) || ');';
+    RAISE NOTICE '%', stmt;
+    EXECUTE stmt;
+END;
+$$ LANGUAGE plpgsql;
+'''
+
+QUEUE_CHANNEL = 'queue_changefeed'
+
+
+def upgrade(conn) -> None:
+    old_queue = set_aside(conn, 'queue', 'unpartitioned')
+    execute_sql(conn, QUEUE_SQL)
+    conn.execute(COPY_QUEUE_SQL)
+    sync_sequence(conn, 'queue', 'qid', old_queue)
+    conn.execute(f'DROP TABLE {old_queue}')
+    execute_sql(conn, WATCH_QUEUE_SQL)
+    conn.execute(f"SELECT watch_queue_table('queue', '{QUEUE_CHANNEL}')")
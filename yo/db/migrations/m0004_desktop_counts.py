@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+"""Unread and unshown counters per user and NOTIFY of new desktop rows
+"""
+from .helpers import execute_sql
+
+version = 4
+transactional = True
+
+DESKTOP_COUNTS_SQL = '''
+CREATE TABLE IF NOT EXISTS desktop_counts (
+    username TEXT NOT NULL,
+    unread INTEGER DEFAULT '0' NOT NULL,
+    unshown INTEGER DEFAULT '0' NOT NULL,
+    updated TIMESTAMP WITHOUT TIME ZONE DEFAULT now() NOT NULL,
+    PRIMARY KEY (username)
+);
+
+INSERT INTO desktop_counts(username, unread, unshown, updated)
+SELECT to_username,
+       COUNT(*) FILTER (WHERE read IS NULL),
+       COUNT(*) FILTER (WHERE shown IS NULL),
+       NOW()
+FROM desktop
+GROUP BY to_username
+ORDER BY to_username
+ON CONFLICT (username) DO NOTHING;
+
+CREATE OR REPLACE FUNCTION notify_desktop_inserted() RETURNS TRIGGER AS $$
+DECLARE
+    chunk json;
+BEGIN
+    FOR chunk IN
+        SELECT json_agg(json_build_array(dnid, to_username, notify_type, from_username))
+        FROM (SELECT dnid, to_username, notify_type, from_username,
+                     (row_number() OVER ()) / 100 AS grp
+              FROM new_rows) numbered
+        GROUP BY grp
+    LOOP
+        PERFORM pg_notify('desktop_changefeed', chunk::text);
+    END LOOP;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS desktop_inserted_trigger ON desktop;
+CREATE TRIGGER desktop_inserted_trigger AFTER INSERT ON desktop
+REFERENCING NEW TABLE AS new_rows
+FOR EACH STATEMENT EXECUTE PROCEDURE notify_desktop_inserted();
+'''
+
+
+def upgrade(conn) -> None:
+    execute_sql(conn, DESKTOP_COUNTS_SQL)
@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+"""Indexes for the rate limit, queue dequeue and desktop feed queries
+
+Built concurrently so the tables stay writable while they are built. The
+desktop indexes they replace are dropped afterwards.
+"""
+version = 5
+transactional = False
+
+
+def upgrade(conn) -> None:
+    from .helpers import create_index_concurrently
+    create_index_concurrently(conn, 'actions_rates_ix', 'actions',
+                              'username, transport, status, created')
+    create_index_concurrently(conn, 'queue_priority_qid_ix', 'queue',
+                              'priority DESC, qid')
+    create_index_concurrently(conn, 'desktop_feed_ix', 'desktop',
+                              'to_username, created DESC, dnid DESC')
+    create_index_concurrently(conn, 'desktop_unread_feed_ix', 'desktop',
+                              'to_username, created DESC, dnid DESC',
+                              where='read IS NULL')
+    conn.execute('DROP INDEX CONCURRENTLY IF EXISTS ix_desktop')
+    conn.execute('DROP INDEX CONCURRENTLY IF EXISTS ix_desktop_to_username')
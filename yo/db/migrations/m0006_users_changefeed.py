@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+"""NOTIFY users_changefeed with the username of updated or deleted users
+
+Transport caches invalidate the user when they receive it.
+"""
+from .helpers import execute_sql
+
+version = 6
+transactional = True
+
+USERS_CHANGEFEED_SQL = '''
+CREATE OR REPLACE FUNCTION notify_users_changed() RETURNS TRIGGER AS $$
+BEGIN
+    PERFORM pg_notify('users_changefeed', OLD.username);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS users_changed_trigger ON users;
+CREATE TRIGGER users_changed_trigger AFTER UPDATE OR DELETE ON users
+FOR EACH ROW EXECUTE PROCEDURE notify_users_changed();
+'''
+
+
+def upgrade(conn) -> None:
+    execute_sql(conn, USERS_CHANGEFEED_SQL)
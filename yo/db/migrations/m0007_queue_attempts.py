@@ -0,0 +1,15 @@
+# -*- coding: utf-8 -*-
+"""Count the failed delivery attempts of queue items
+"""
+from .helpers import execute_sql
+
+version = 7
+transactional = True
+
+QUEUE_ATTEMPTS_SQL = '''
+ALTER TABLE queue ADD COLUMN IF NOT EXISTS attempts SMALLINT DEFAULT '0' NOT NULL;
+'''
+
+
+def upgrade(conn) -> None:
+    execute_sql(conn, QUEUE_ATTEMPTS_SQL)
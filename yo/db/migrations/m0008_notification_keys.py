@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+"""Deduplicate notifications by (eid, to_username) in a separate table
+
+A partitioned notifications table can only have unique indexes which
+include the partition key, so the keys of stored notifications move to
+notification_keys. It is filled from the existing notifications.
+"""
+from .helpers import execute_sql
+
+version = 8
+transactional = True
+
+NOTIFICATION_KEYS_SQL = '''
+CREATE TABLE IF NOT EXISTS notification_keys (
+    eid TEXT NOT NULL,
+    to_username TEXT NOT NULL,
+    created TIMESTAMP WITHOUT TIME ZONE DEFAULT now() NOT NULL,
+    PRIMARY KEY (eid, to_username)
+);
+CREATE INDEX IF NOT EXISTS ix_notification_keys_created ON notification_keys (created);
+
+INSERT INTO notification_keys(eid, to_username, created)
+SELECT eid, to_username, MIN(created)
+FROM notifications
+WHERE eid IS NOT NULL
+GROUP BY eid, to_username
+ON CONFLICT DO NOTHING;
+'''
+
+
+def upgrade(conn) -> None:
+    execute_sql(conn, NOTIFICATION_KEYS_SQL)
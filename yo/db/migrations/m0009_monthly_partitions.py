@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+"""Partition notifications, actions and desktop by month of created
+
+Each table is recreated RANGE partitioned on created and the old table is
+attached as its first partition, <table>_legacy, covering everything up to
+the end of the current month, so no rows are copied. Attaching scans the
+old table and builds its (id, created) primary key while holding a lock,
+so run this in a quiet period. The legacy partition is dropped like any
+other once it is older than the table's retention. A default partition
+and the monthly partitions of the next months are created too.
+"""
+from datetime import datetime
+
+import sqlalchemy as sa
+
+from .helpers import execute_sql
+from .helpers import is_partitioned
+from .helpers import set_aside
+from .helpers import sync_sequence
+
+version = 9
+transactional = True
+
+# partitions created ahead of the legacy partition
+PREMAKE_MONTHS = 3
+
+NOTIFICATIONS_SQL = '''
+CREATE TABLE notifications (
+    nid BIGSERIAL NOT NULL,
+    eid TEXT,
+    notify_type INTEGER NOT NULL,
+    to_username TEXT NOT NULL,
+    from_username TEXT,
+    json_data TEXT,
+    created TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+    priority INTEGER,
+    PRIMARY KEY (nid, created)
+) PARTITION BY RANGE (created);
+'''
+
+ACTIONS_SQL = '''
+CREATE TABLE actions (
+    aid BIGSERIAL NOT NULL,
+    nid BIGINT,
+    username TEXT NOT NULL,
+    transport INTEGER NOT NULL,
+    status INTEGER NOT NULL,
+    created TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+    PRIMARY KEY (aid, created)
+) PARTITION BY RANGE (created);
+CREATE INDEX ix_actions_username ON actions (username);
+CREATE INDEX ix_actions_transport ON actions (transport);
+CREATE INDEX ix_actions_status ON actions (status);
+CREATE INDEX ix_actions_created ON actions (created);
+CREATE INDEX actions_rates_ix ON actions (username, transport, status, created);
+'''
+
+DESKTOP_SQL = '''
+CREATE TABLE desktop (
+    dnid BIGSERIAL NOT NULL,
+    eid TEXT,
+    notify_type INTEGER NOT NULL,
+    to_username TEXT NOT NULL,
+    from_username TEXT,
+    json_data TEXT,
+    created TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+    shown TIMESTAMP WITHOUT TIME ZONE,
+    read TIMESTAMP WITHOUT TIME ZONE,
+    PRIMARY KEY (dnid, created)
+) PARTITION BY RANGE (created);
+CREATE INDEX desktop_feed_ix ON desktop (to_username, created DESC, dnid DESC);
+CREATE INDEX desktop_unread_feed_ix ON desktop (to_username, created DESC, dnid DESC)
+WHERE read IS NULL;
+
+DROP TRIGGER IF EXISTS desktop_inserted_trigger ON desktop_legacy;
+CREATE TRIGGER desktop_inserted_trigger AFTER INSERT ON desktop
+REFERENCING NEW TABLE AS new_rows
+FOR EACH STATEMENT EXECUTE PROCEDURE notify_desktop_inserted();
+'''
+
+CREATED_NULLABLE_SQL = '''
+SELECT NOT attnotnull FROM pg_attribute
+WHERE attrelid = to_regclass(:name) AND attname = 'created'
+'''
+
+PRIMARY_KEY_SQL = '''
+SELECT conname FROM pg_constraint
+WHERE conrelid = to_regclass(:name) AND contype = 'p'
+'''
+
+# table name, serial column, SQL creating the partitioned table
+TABLES = [
+    ('notifications', 'nid', NOTIFICATIONS_SQL),
+    ('actions', 'aid', ACTIONS_SQL),
+    ('desktop', 'dnid', DESKTOP_SQL)
+]
+
+
+def _add_months(dt:datetime, months:int) -> datetime:
+    month = dt.month - 1 + months
+    return datetime(dt.year + month // 12, month % 12 + 1, 1)
+
+
+def _legacy_upper_bound(conn, legacy:str, now:datetime) -> datetime:
+    # the end of the current month, or of the newest row's month if later
+    upper = _add_months(now, 1)
+    newest = conn.execute(f'SELECT MAX(created) FROM {legacy}').scalar()
+    if newest is not None and newest >= upper:
+        upper = _add_months(newest, 1)
+    return upper
+
+
+def _partition(conn, table_name:str, legacy:str, serial_column:str, sql:str,
+               now:datetime) -> None:
+    if conn.execute(sa.text(CREATED_NULLABLE_SQL), name=legacy).scalar():
+        # range partitions can't hold a NULL key
+        conn.execute(f"UPDATE {legacy} SET created = '1970-01-01' WHERE created IS NULL")
+        conn.execute(f'ALTER TABLE {legacy} ALTER COLUMN created SET NOT NULL')
+    # a partition can't keep its own single column primary key, attaching
+    # gives it the (id, created) key of the partitioned table instead
+    pkey = conn.execute(sa.text(PRIMARY_KEY_SQL), name=legacy).scalar()
+    if pkey is not None:
+        conn.execute(f'ALTER TABLE {legacy} DROP CONSTRAINT {pkey}')
+    execute_sql(conn, sql)
+    upper = _legacy_upper_bound(conn, legacy, now)
+    conn.execute(f'ALTER TABLE {table_name} ATTACH PARTITION {legacy} '
+                 f"FOR VALUES FROM (MINVALUE) TO ('{upper.isoformat()}')")
+    sync_sequence(conn, table_name, serial_column, legacy)
+    conn.execute(f'CREATE TABLE {table_name}_default PARTITION OF {table_name} DEFAULT')
+    month = upper
+    while month <= _add_months(now, PREMAKE_MONTHS):
+        conn.execute(f'CREATE TABLE {table_name}_y{month.year:04d}m{month.month:02d} '
+                     f'PARTITION OF {table_name} FOR VALUES '
+                     f"FROM ('{month.isoformat()}') TO ('{_add_months(month, 1).isoformat()}')")
+        month = _add_months(month, 1)
+
+
+def upgrade(conn) -> None:
+    now = datetime.utcnow()
+    for table_name, serial_column, sql in TABLES:
+        if is_partitioned(conn, table_name):
+            continue
+        legacy = set_aside(conn, table_name, 'legacy')
+        _partition(conn, table_name, legacy, serial_column, sql, now)
@@ -1,4 +1,7 @@
 # -*- coding: utf-8 -*-
+import asyncio
+from datetime import datetime
+
 import sqlalchemy as sa
 import structlog
 
@@ -7,44 +10,113 @@ from ..schema import NotificationType
 from ..schema import TransportType
 from ..schema import Priority
 
-from .users import get_user_transports_for_notification
+from .users import DEFAULT_USER_TRANSPORT_SETTINGS
+from .users import PoolOrConn
+from .checkpoints import FOLLOWER_CHECKPOINT
+from .checkpoints import get_checkpoint
+from .checkpoints import set_checkpoint
+from .partitions import add_months
+from .partitions import month_start
+from .partitions import partition_by_month
 
 
 logger = structlog.getLogger(__name__, source='YoDB')
 
 from yo.db import metadata
-from .queue import put_many
 
-class DuplicateNotificationError(BaseException):
-    pass
+# postgres arrays are 1-indexed, so enum values index these directly
+NOTIFY_TYPE_NAMES = [NotificationType(i).name for i in range(1, len(NotificationType) + 1)]
+TRANSPORT_TYPE_NAMES = [TransportType(i).name for i in range(1, len(TransportType) + 1)]
 
 notifications_table = sa.Table(
     'notifications',
     metadata,
-    sa.Column('nid', sa.BigInteger(), primary_key=True),
+    sa.Column('nid', sa.BigInteger(), primary_key=True, autoincrement=True),
     sa.Column('eid', sa.Text()),
     sa.Column('notify_type', sa.Integer(), nullable=False),
     sa.Column('to_username',sa.Text(),nullable=False),
     sa.Column('from_username',sa.Text(),nullable=True),
     sa.Column('json_data', sa.UnicodeText()),
-    sa.Column('created', sa.DateTime, default=sa.func.now(), nullable=False),
+    # primary keys of partitioned tables must include the partition key
+    sa.Column('created', sa.DateTime, default=sa.func.now(), nullable=False, primary_key=True),
     sa.Column('priority', sa.Integer, default=Priority.normal.value),
-    sa.Index('ix_notifications_unique','eid','to_username',unique=True)
+    postgresql_partition_by='RANGE (created)'
 )
+partition_by_month(notifications_table)
 
-INSERT_NOTIFICATON_STMT = '''
-INSERT INTO notifications(eid, notify_type, to_username, from_username, json_data, priority, created)
-VALUES($1, $2, $3, $4, $5, $6, NOW()) 
-ON CONFLICT DO NOTHING
-RETURNING nid'''
-
+# one row per stored (eid, to_username); a unique index on the partitioned
+# notifications table would have to include created. Keys outlive the
+# notifications partitions so replayed blocks are still recognised.
+notification_keys_table = sa.Table(
+    'notification_keys',
+    metadata,
+    sa.Column('eid', sa.Text(), primary_key=True),
+    sa.Column('to_username', sa.Text(), primary_key=True),
+    sa.Column('created', sa.DateTime, nullable=False, server_default=sa.func.now(), index=True)
+)
 
+NOTIFICATION_KEYS_RETENTION_MONTHS = 24
 
-GET_LAST_BLOCK_STMT = '''
-SELECT eid FROM notifications ORDER BY DESC nid LIMIT 1; 
+# $7 default user transports, $8 notify type names, $9 transport names,
+# $10 whether to queue the new notifications for delivery
+CREATE_NOTIFICATIONS_STMT = '''
+WITH batch AS (
+    SELECT n.*, row_number() OVER (PARTITION BY eid, to_username ORDER BY i) AS dup
+    FROM unnest($1::text[], $2::int[], $3::text[], $4::text[], $5::text[], $6::int[])
+        WITH ORDINALITY AS n(eid, notify_type, to_username, from_username, json_data, priority, i)
+),
+new_keys AS (
+    INSERT INTO notification_keys(eid, to_username, created)
+    SELECT eid, to_username, NOW()
+    FROM batch
+    WHERE eid IS NOT NULL AND dup = 1
+    -- concurrent writers lock keys in the same order
+    ORDER BY eid, to_username
+    ON CONFLICT DO NOTHING
+    RETURNING eid, to_username
+),
+new_notifications AS (
+    INSERT INTO notifications(eid, notify_type, to_username, from_username, json_data, priority, created)
+    SELECT b.eid, b.notify_type, b.to_username, b.from_username, b.json_data, b.priority, NOW()
+    FROM batch b
+    LEFT JOIN new_keys k ON k.eid = b.eid AND k.to_username = b.to_username
+    -- notifications without an eid can't be duplicates
+    WHERE b.eid IS NULL OR (b.dup = 1 AND k.eid IS NOT NULL)
+    ORDER BY b.i
+    RETURNING nid, eid, notify_type, to_username, from_username, json_data, priority
+),
+new_users AS (
+    INSERT INTO users(username, transports, created, updated)
+    SELECT DISTINCT to_username, $7::jsonb, NOW(), NOW()
+    FROM new_notifications
+    -- concurrent writers lock new users in the same order
+    ORDER BY to_username
+    ON CONFLICT DO NOTHING
+),
+enabled_transports AS (
+    SELECT n.*, array_position($9::text[], ut.key) AS transport
+    FROM new_notifications n
+    LEFT JOIN users u ON u.username = n.to_username
+    CROSS JOIN LATERAL jsonb_each(COALESCE(u.transports, $7::jsonb)) AS ut
+    WHERE ut.value->'notification_types' ? ($8::text[])[n.notify_type]
+),
+queued AS (
+    INSERT INTO queue(data, transport, priority)
+    SELECT jsonb_build_object('nid',           nid,
+                              'eid',           eid,
+                              'notify_type',   notify_type,
+                              'to_username',   to_username,
+                              'from_username', from_username,
+                              'json_data',     json_data,
+                              'priority',      priority),
+           transport,
+           priority
+    FROM enabled_transports
+    WHERE $10 AND transport IS NOT NULL
+)
+SELECT nid FROM new_notifications
 '''
 
-
 '''
 flow
 bf detects operation
@@ -90,48 +162,153 @@ async def create_notification(pool,
                  from_username=from_username,
                  json_data=json_data,
                  priority=priority)
+    nids = await create_notifications(pool, [dict(eid=eid,
+                                                  notify_type=notify_type,
+                                                  to_username=to_username,
+                                                  from_username=from_username,
+                                                  json_data=json_data,
+                                                  priority=priority)])
+    return nids is not None
+
+
+def _priority(notification:dict) -> int:
+    # queue.priority is NOT NULL, a missing priority is normal
+    priority = notification.get('priority')
+    return int(Priority.normal if priority is None else priority)
+
+
+def _create_notifications_args(notifications:list, queue:bool=True) -> tuple:
+    return ([n['eid'] for n in notifications],
+            [int(n['notify_type']) for n in notifications],
+            [n['to_username'] for n in notifications],
+            [n.get('from_username') for n in notifications],
+            [n.get('json_data') for n in notifications],
+            [_priority(n) for n in notifications],
+            DEFAULT_USER_TRANSPORT_SETTINGS,
+            NOTIFY_TYPE_NAMES,
+            TRANSPORT_TYPE_NAMES,
+            queue)
+
+
+async def create_notifications(pool_or_conn:PoolOrConn, notifications:list,
+                               queue:bool=True):
+    """Store a batch of notifications and queue them for delivery
+
+    The notifications, any missing users and the queue items for every
+    transport the recipients have enabled are written by a single
+    statement. Duplicate notifications are skipped. With queue=False the
+    notifications are stored without being delivered.
+
+    Returns:
+        list: nids of the newly stored notifications, or None on error
+    """
+    logger.debug('create_notifications', count=len(notifications))
+    if not notifications:
+        return []
+    try:
+        rows = await pool_or_conn.fetch(CREATE_NOTIFICATIONS_STMT,
+                                        *_create_notifications_args(notifications, queue))
+    except Exception as e:
+        logger.exception('error creating notifications')
+        return None
+    nids = [row['nid'] for row in rows]
+    logger.debug('notifications created', count=len(notifications), created=len(nids))
+    return nids
+
+
+async def create_block_notifications(pool,
+                                     notifications:list,
+                                     block_num:int,
+                                     checkpoint_name:str=FOLLOWER_CHECKPOINT,
+                                     before_checkpoint=None,
+                                     queue:bool=True):
+    """Store the notifications of a block batch and advance the checkpoint
+
+    Without `before_checkpoint` both writes happen in one transaction, so a
+    stored batch is never replayed after a restart and a failed batch never
+    advances the checkpoint.
+
+    Concurrent writers pass the write of the preceding batch as
+    `before_checkpoint`. Their notifications are stored in one transaction,
+    then `before_checkpoint` is awaited outside of any transaction, so a
+    writer never holds row locks its predecessor may be waiting on, and the
+    checkpoint is written in a second transaction. Checkpoints therefore
+    commit in block order. A batch stored without its checkpoint is replayed
+    after a restart, which duplicate detection makes harmless. Exceptions
+    raised by `before_checkpoint` are propagated.
+
+    Backfills of past blocks pass queue=False, so old events are stored
+    without being delivered again.
+
+    Returns:
+        list: nids of the newly stored notifications, or None on error
+    """
+    logger.debug('create_block_notifications', count=len(notifications),
+                 block_num=block_num, checkpoint_name=checkpoint_name)
+    if before_checkpoint is not None:
+        nids = []
+        if notifications:
+            nids = await create_notifications(pool, notifications, queue)
+            if nids is None:
+                return None
+        await before_checkpoint
+        try:
+            await set_checkpoint(pool, checkpoint_name, block_num)
+        except Exception as e:
+            logger.exception('error storing checkpoint', block_num=block_num)
+            return None
+        return nids
     async with pool.acquire() as conn:
         try:
             async with conn.transaction():
-                # store notification
-                nid = await conn.fetchval(INSERT_NOTIFICATON_STMT, eid, notify_type, to_username, from_username, json_data, priority)
-                if not nid:
-                    raise DuplicateNotificationError()
-
-                # load applicable user transport settings
-                enabled_transports = await get_user_transports_for_notification(conn, to_username, notify_type)
-                logger.debug('enabled_transports',acct=to_username,enabled=enabled_transports)
-                if not enabled_transports:
-                    return True
-
-                # create/put transport-notifications
-                queue_item = {
-                    'nid':           nid,
-                    'eid':           eid,
-                    'notify_type':   notify_type.value,
-                    'to_username':   to_username,
-                    'from_username': from_username,
-                    'json_data':     json_data,
-                    'priority':      priority
-                }
-                queue_items = [(queue_item, TransportType[tt]) for tt in enabled_transports]
-                await put_many(conn, queue_items)
-
-                logger.debug('notifications created', notify_type=notify_type.name, transports=enabled_transports)
-                return True
-
-        except DuplicateNotificationError:
-            logger.debug('duplicate notification', eid=eid,
-                         to_username=to_username)
-            return True
-
+                rows = []
+                if notifications:
+                    rows = await conn.fetch(CREATE_NOTIFICATIONS_STMT,
+                                            *_create_notifications_args(notifications,
+                                                                        queue))
+                await set_checkpoint(conn, checkpoint_name, block_num)
         except Exception as e:
-            logger.exception('error creating notification')
-            return False
+            logger.exception('error creating block notifications', block_num=block_num)
+            return None
+    return [row['nid'] for row in rows]
+
+
+PRUNE_NOTIFICATION_KEYS_STMT = '''
+DELETE FROM notification_keys
+WHERE ctid = ANY(ARRAY(
+    SELECT ctid FROM notification_keys WHERE created < $1 LIMIT $2
+))
+'''
+
+
+async def prune_notification_keys(pool, keep_months:int=NOTIFICATION_KEYS_RETENTION_MONTHS,
+                                  now:datetime=None, batch_size:int=10000) -> int:
+    """Delete keys older than keep_months in batches, returns the number deleted
+
+    A block replayed after its keys are pruned is notified again.
+    """
+    cutoff = add_months(month_start(now or datetime.utcnow()), -keep_months)
+    pruned = 0
+    while True:
+        result = await pool.execute(PRUNE_NOTIFICATION_KEYS_STMT, cutoff, batch_size)
+        # 'DELETE <count>'
+        deleted = int(result.split()[-1])
+        pruned += deleted
+        if deleted < batch_size:
+            return pruned
+
+
+async def notification_keys_task(pool, keep_months:int=NOTIFICATION_KEYS_RETENTION_MONTHS,
+                                 interval:float=3600) -> None:
+    while True:
+        try:
+            pruned = await prune_notification_keys(pool, keep_months)
+            logger.debug('notification keys pruned', pruned=pruned)
+        except Exception:
+            logger.exception('notification key pruning failed')
+        await asyncio.sleep(interval)
 
 
-async def get_last_processed_block(conn):
-    eid = await conn.fetchval(GET_LAST_BLOCK_STMT)
-    if eid:
-        return int(eid.split('/')[0]) - 1
-    return 1
+async def get_last_processed_block(pool_or_conn:PoolOrConn,
+                                   checkpoint_name:str=FOLLOWER_CHECKPOINT):
+    return await get_checkpoint(pool_or_conn, checkpoint_name)
@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+"""Monthly partitions of the notifications, actions and desktop tables
+
+Each table is RANGE partitioned on `created` with one partition per month,
+named like notifications_y2018m07, and a DEFAULT partition which catches
+rows no monthly partition covers. Partitions are created a few months
+ahead, and partitions whose range ends before a table's retention policy
+are dropped, which reclaims their space without deleting rows.
+"""
+import asyncio
+import re
+from collections import namedtuple
+from datetime import datetime
+from typing import List
+
+import sqlalchemy as sa
+import structlog
+
+logger = structlog.getLogger(__name__, source='YoDB')
+
+# months of data kept for each partitioned table, None keeps everything
+RETENTION_POLICY = {
+    'notifications': 6,
+    'actions':       3,
+    'desktop':       12
+}
+
+# partitions created ahead of the current month
+PREMAKE_MONTHS = 3
+
+# held while maintaining partitions, the sender and the follower both run it
+MAINTENANCE_LOCK_KEY = 7476926
+
+# FOR VALUES FROM ('2018-07-01 00:00:00') TO ('2018-08-01 00:00:00'), either
+# bound may be MINVALUE or MAXVALUE
+PARTITION_BOUND_RE = re.compile(r"FROM \((?P<lower>[^)]+)\) TO \((?P<upper>[^)]+)\)")
+
+TRY_LOCK_STMT = '''
+SELECT pg_try_advisory_lock($1)
+'''
+
+UNLOCK_STMT = '''
+SELECT pg_advisory_unlock($1)
+'''
+
+RELKIND_STMT = '''
+SELECT relkind FROM pg_class WHERE oid = to_regclass($1)
+'''
+
+LIST_PARTITIONS_STMT = '''
+SELECT c.relname, pg_get_expr(c.relpartbound, c.oid) AS bound
+FROM pg_inherits i
+JOIN pg_class c ON c.oid = i.inhrelid
+WHERE i.inhparent = $1::regclass
+'''
+
+Partition = namedtuple('Partition', ['name', 'lower', 'upper', 'default'])
+
+
+def month_start(dt:datetime) -> datetime:
+    return datetime(dt.year, dt.month, 1)
+
+def add_months(dt:datetime, months:int) -> datetime:
+    month = dt.month - 1 + months
+    return datetime(dt.year + month // 12, month % 12 + 1, 1)
+
+def partition_name(table_name:str, month:datetime) -> str:
+    return f'{table_name}_y{month.year:04d}m{month.month:02d}'
+
+def default_partition_name(table_name:str) -> str:
+    return f'{table_name}_default'
+
+def _bound_value(value:str, unbounded:datetime) -> datetime:
+    if value in ('MINVALUE', 'MAXVALUE'):
+        return unbounded
+    return datetime.strptime(value.strip("'").split('.')[0], '%Y-%m-%d %H:%M:%S')
+
+def parse_partition(name:str, bound:str) -> Partition:
+    """Partition from its name and pg_get_expr(relpartbound)
+    """
+    if bound == 'DEFAULT':
+        return Partition(name, None, None, True)
+    match = PARTITION_BOUND_RE.search(bound)
+    return Partition(name,
+                     _bound_value(match.group('lower'), datetime.min),
+                     _bound_value(match.group('upper'), datetime.max),
+                     False)
+
+def month_bounds(month:datetime) -> str:
+    start = month_start(month)
+    return f"FOR VALUES FROM ('{start.isoformat()}') TO ('{add_months(start, 1).isoformat()}')"
+
+def create_partition_stmt(table_name:str, month:datetime) -> str:
+    return (f'CREATE TABLE IF NOT EXISTS {partition_name(table_name, month_start(month))} '
+            f'PARTITION OF {table_name} {month_bounds(month)}')
+
+def create_default_partition_stmt(table_name:str) -> str:
+    return (f'CREATE TABLE IF NOT EXISTS {default_partition_name(table_name)} '
+            f'PARTITION OF {table_name} DEFAULT')
+
+def months_to_create(now:datetime=None, months_ahead:int=PREMAKE_MONTHS) -> List[datetime]:
+    start = month_start(now or datetime.utcnow())
+    return [add_months(start, i) for i in range(months_ahead + 1)]
+
+def missing_months(partitions:List[Partition], now:datetime=None,
+                   months_ahead:int=PREMAKE_MONTHS) -> List[datetime]:
+    """Months to create which no existing range partition overlaps
+    """
+    ranges = [(p.lower, p.upper) for p in partitions if not p.default]
+    return [month for month in months_to_create(now, months_ahead)
+            if not any(lower < add_months(month, 1) and month < upper
+                       for lower, upper in ranges)]
+
+def expired_partitions(partitions:List[Partition], keep_months:int,
+                       now:datetime=None) -> List[str]:
+    """Partitions whose whole range is older than keep_months
+    """
+    if keep_months is None:
+        return []
+    oldest_kept = add_months(month_start(now or datetime.utcnow()), -keep_months)
+    return sorted(p.name for p in partitions
+                  if not p.default and p.upper <= oldest_kept)
+
+
+def partition_by_month(table:sa.Table) -> None:
+    """Create the default, current and upcoming monthly partitions when table is created
+    """
+    def create_partitions(target, connection, **kw):
+        connection.execute(create_default_partition_stmt(target.name))
+        for month in months_to_create():
+            connection.execute(create_partition_stmt(target.name, month))
+    sa.event.listen(table, 'after_create', create_partitions)
+
+
+async def is_partitioned(conn, table_name:str) -> bool:
+    return await conn.fetchval(RELKIND_STMT, table_name) == 'p'
+
+async def list_partitions(conn, table_name:str) -> List[Partition]:
+    rows = await conn.fetch(LIST_PARTITIONS_STMT, table_name)
+    return [parse_partition(row['relname'], row['bound']) for row in rows]
+
+async def _create_partition(conn, table_name:str, default_name:str, month:datetime) -> None:
+    """Create month's partition, moving any rows the default partition holds for it
+
+    Postgres can't create a partition for rows the default partition already
+    holds, so those are moved to a new table which is then attached.
+    """
+    start = month_start(month)
+    end = add_months(start, 1)
+    name = partition_name(table_name, start)
+    async with conn.transaction():
+        # keeps rows from arriving in the default partition meanwhile
+        await conn.execute(f'LOCK TABLE {default_name} IN SHARE ROW EXCLUSIVE MODE')
+        if not await conn.fetchval(f'SELECT EXISTS (SELECT 1 FROM {default_name} '
+                                   f'WHERE created >= $1 AND created < $2)', start, end):
+            await conn.execute(create_partition_stmt(table_name, start))
+            return
+        await conn.execute(f'CREATE TABLE {name} '
+                           f'(LIKE {table_name} INCLUDING DEFAULTS INCLUDING CONSTRAINTS)')
+        await conn.execute(f'WITH moved AS (DELETE FROM {default_name} '
+                           f'WHERE created >= $1 AND created < $2 RETURNING *) '
+                           f'INSERT INTO {name} SELECT * FROM moved', start, end)
+        await conn.execute(f'ALTER TABLE {table_name} ATTACH PARTITION {name} '
+                           f'{month_bounds(start)}')
+    logger.warning('rows moved out of default partition', table=table_name, partition=name)
+
+async def create_partitions(conn, table_name:str, now:datetime=None,
+                            months_ahead:int=PREMAKE_MONTHS) -> List[str]:
+    """Create the default partition and the missing monthly ones, returns the created names
+    """
+    partitions = await list_partitions(conn, table_name)
+    created = []
+    default_name = default_partition_name(table_name)
+    if not any(p.default for p in partitions):
+        await conn.execute(create_default_partition_stmt(table_name))
+        created.append(default_name)
+    for month in missing_months(partitions, now, months_ahead):
+        await _create_partition(conn, table_name, default_name, month)
+        created.append(partition_name(table_name, month))
+    if created:
+        logger.info('partitions created', table=table_name, created=created)
+    return created
+
+async def drop_expired_partitions(conn, table_name:str, keep_months:int,
+                                  now:datetime=None) -> List[str]:
+    """Drop partitions older than keep_months, returns the dropped names
+    """
+    partitions = await list_partitions(conn, table_name)
+    dropped = []
+    for name in expired_partitions(partitions, keep_months, now):
+        # detach first so the parent is only locked for the catalog change
+        await conn.execute(f'ALTER TABLE {table_name} DETACH PARTITION {name}')
+        await conn.execute(f'DROP TABLE {name}')
+        dropped.append(name)
+    if dropped:
+        logger.info('expired partitions dropped', table=table_name, dropped=dropped)
+    return dropped
+
+async def maintain_partitions(pool, policy:dict=None, now:datetime=None,
+                              months_ahead:int=PREMAKE_MONTHS) -> dict:
+    """Create and drop the partitions of each table, returns the dropped names
+
+    Returns None without doing anything if another process is maintaining
+    the partitions.
+    """
+    policy = RETENTION_POLICY if policy is None else policy
+    dropped = dict()
+    async with pool.acquire() as conn:
+        if not await conn.fetchval(TRY_LOCK_STMT, MAINTENANCE_LOCK_KEY):
+            logger.debug('partitions maintained by another process')
+            return None
+        try:
+            for table_name, keep_months in policy.items():
+                if not await is_partitioned(conn, table_name):
+                    logger.warning('table is not partitioned, migrate the database',
+                                   table=table_name)
+                    continue
+                await create_partitions(conn, table_name, now, months_ahead)
+                dropped[table_name] = await drop_expired_partitions(conn, table_name,
+                                                                    keep_months, now)
+        finally:
+            await conn.execute(UNLOCK_STMT, MAINTENANCE_LOCK_KEY)
+    return dropped
+
+async def partition_maintenance_task(pool, policy:dict=None, interval:float=3600) -> None:
+    while True:
+        try:
+            await maintain_partitions(pool, policy)
+        except Exception:
+            logger.exception('partition maintenance failed')
+        await asyncio.sleep(interval)
@@ -1,9 +1,13 @@
 # -*- coding: utf-8 -*-
 import asyncio
+import os
 import sqlalchemy as sa
 import structlog
 from concurrent.futures import ThreadPoolExecutor
 
+from typing import Dict
+from typing import List
+from typing import Tuple
 from typing import TypeVar
 from typing import Awaitable
 from asyncpg.pool import Pool
@@ -16,6 +20,8 @@ import asyncpg
 import yo.db
 
 from yo.db import metadata
+from yo.schema import ActionStatus
+from yo.schema import Priority
 from yo.schema import TransportType
 from yo.json import loads
 from yo.db.actions import store
@@ -23,6 +29,7 @@ from yo.db.actions import mark_failed
 from yo.db.actions import mark_rate_limited
 from yo.db.actions import mark_sent
 from yo.db.actions import RateLimitException
+from yo.db.actions import PERMANENT_FAIL_COUNT
 from yo.db.actions import PermanentFailException
 from yo.db.actions import SendError
 
@@ -35,8 +42,25 @@ NotificationId = int
 
 EXECUTOR = ThreadPoolExecutor()
 
-PUSH_Q_STMT = '''
-INSERT INTO queue(data,transport) VALUES($1,$2) RETURNING qid
+DEFAULT_LEASE_SECONDS = 30
+DEFAULT_RETRY_DELAY_SECONDS = 60
+# failed items are retried after 10s, 20s, ... until PERMANENT_FAIL_COUNT failures
+FAILED_RETRY_DELAY_SECONDS = 10
+
+QUEUE_CHANNEL = 'queue_changefeed'
+WATCH_TABLE_SQL = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'watch_table.sql')
+
+MIN_POLL_INTERVAL = 0.5
+MAX_POLL_INTERVAL = 30
+
+# low priority items reach high after two hours, but never overtake always
+PRIORITY_AGING_SECONDS = 3600
+PRIORITY_AGING_MAX = Priority.high
+
+PUSH_Q_STMT = f'''
+INSERT INTO queue(data,transport,priority)
+VALUES($1,$2,COALESCE(($1::jsonb->>'priority')::int, {Priority.normal.value}))
+RETURNING qid
 '''
 
 POP_Q_STMT = '''
@@ -44,13 +68,91 @@ DELETE FROM queue
 WHERE qid = (
   SELECT qid
   FROM queue
-  ORDER BY qid
+  WHERE leased_until IS NULL OR leased_until < NOW()
+  ORDER BY priority DESC, qid
   FOR UPDATE SKIP LOCKED
   LIMIT 1
 )
 RETURNING qid, data, transport;
 '''
 
+POP_Q_BY_TRANSPORT_STMT = '''
+DELETE FROM queue
+WHERE transport = $1
+AND qid = (
+  SELECT qid
+  FROM queue
+  WHERE transport = $1
+  AND (leased_until IS NULL OR leased_until < NOW())
+  ORDER BY priority DESC, qid
+  FOR UPDATE SKIP LOCKED
+  LIMIT 1
+)
+RETURNING qid, data, transport;
+'''
+
+# claim up to $1 unleased (or lease expired) rows for $2 seconds
+LEASE_Q_STMT = '''
+UPDATE queue
+SET leased_until = NOW() + $2::float * INTERVAL '1 second'
+WHERE qid IN (
+  SELECT qid
+  FROM queue
+  WHERE leased_until IS NULL OR leased_until < NOW()
+  ORDER BY priority DESC, qid
+  FOR UPDATE SKIP LOCKED
+  LIMIT $1
+)
+RETURNING qid, data, transport, leased_until;
+'''
+
+LEASE_Q_BY_TRANSPORT_STMT = '''
+UPDATE queue
+SET leased_until = NOW() + $2::float * INTERVAL '1 second'
+WHERE transport = $3
+AND qid IN (
+  SELECT qid
+  FROM queue
+  WHERE transport = $3
+  AND (leased_until IS NULL OR leased_until < NOW())
+  ORDER BY priority DESC, qid
+  FOR UPDATE SKIP LOCKED
+  LIMIT $1
+)
+RETURNING qid, data, transport, leased_until;
+'''
+
+ACK_Q_STMT = '''
+DELETE FROM queue WHERE qid = ANY($1::bigint[])
+'''
+
+# make rows visible again after $2 seconds
+RELEASE_Q_STMT = '''
+UPDATE queue
+SET leased_until = NOW() + $2::float * INTERVAL '1 second'
+WHERE qid = ANY($1::bigint[])
+'''
+
+# give up on rows which have now failed $2 times
+DROP_FAILED_Q_STMT = '''
+DELETE FROM queue
+WHERE qid = ANY($1::bigint[])
+AND attempts + 1 >= $2
+RETURNING qid
+'''
+
+# make failed rows visible again after $2 * 2^attempts seconds
+RETRY_Q_STMT = '''
+UPDATE queue
+SET attempts = attempts + 1,
+    leased_until = NOW() + $2::float * power(2, attempts) * INTERVAL '1 second'
+WHERE qid = ANY($1::bigint[])
+'''
+
+Q_LEASED_SIZE_STMT = '''
+SELECT COUNT(*) FROM queue WHERE leased_until >= NOW();
+'''
+
 POP_Q_BY_ID_STMT = '''
 DELETE FROM queue
 WHERE qid = (
@@ -81,6 +183,31 @@ Q_SIZE_STMT = '''
 SELECT COUNT(*) FROM queue;
 '''
 
+Q_SIZE_BY_TRANSPORT_STMT = '''
+SELECT COUNT(*) FROM queue WHERE transport = $1;
+'''
+
+Q_PRIORITY_DEPTH_STMT = '''
+SELECT priority, COUNT(*) AS depth FROM queue GROUP BY priority;
+'''
+
+Q_PRIORITY_DEPTH_BY_TRANSPORT_STMT = '''
+SELECT priority, COUNT(*) AS depth FROM queue WHERE transport = $1 GROUP BY priority;
+'''
+
+# raise each item one priority level per $1 seconds spent in the queue,
+# counted from the priority it was enqueued with, up to at most $2
+AGE_Q_PRIORITIES_STMT = '''
+UPDATE queue
+SET priority = LEAST($2::int,
+  (data->>'priority')::int
+  + floor(extract(epoch FROM NOW() - timestamp) / $1::float)::int)
+WHERE priority < $2::int
+AND timestamp < NOW() - $1::float * INTERVAL '1 second'
+AND (data->>'priority')::int
+  + floor(extract(epoch FROM NOW() - timestamp) / $1::float)::int > priority
+'''
+
 NEWEST_QID_STMT = '''
 SELECT qid
 FROM queue
@@ -89,15 +216,42 @@ LIMIT 1
 '''
 
 
+# the queue is LIST partitioned by transport so each transport's consumers
+# only scan their own rows; the partition key must be part of the primary key
 queue = sa.Table(
     'queue',
     metadata,
-    sa.Column('qid', sa.BigInteger(), primary_key=True),
+    sa.Column('qid', sa.BigInteger(), primary_key=True, autoincrement=True),
     sa.Column('data', JSONB(), index=False, nullable=False),
-    sa.Column('transport', sa.Integer(), index=True),
-    sa.Column('timestamp', sa.TIMESTAMP, default=sa.func.now, index=True)
+    sa.Column('transport', sa.Integer(), primary_key=True, autoincrement=False),
+    sa.Column('timestamp', sa.TIMESTAMP, server_default=sa.func.now(), index=True),
+    sa.Column('leased_until', sa.TIMESTAMP, nullable=True, index=True),
+    sa.Column('priority', sa.SmallInteger(), nullable=False,
+              server_default=str(Priority.normal.value)),
+    sa.Column('attempts', sa.SmallInteger(), nullable=False, server_default='0'),
+    sa.Index('queue_priority_qid_ix', sa.text('priority DESC'), 'qid'),
+    postgresql_partition_by='LIST (transport)'
 )
 
+QUEUE_PARTITIONS = {t: f'queue_{t.name}' for t in TransportType}
+
+for _transport_type, _partition in QUEUE_PARTITIONS.items():
+    sa.event.listen(queue, 'after_create', sa.DDL(
+        f'CREATE TABLE {_partition} PARTITION OF queue '
+        f'FOR VALUES IN ({_transport_type.value})'))
+
+
+def _watch_table_ddl() -> sa.DDL:
+    with open(WATCH_TABLE_SQL) as f:
+        # DDL statements are %-formatted
+        sql = f.read().replace('%', '%%')
+    return sa.DDL(sql)
+
+# NOTIFY QUEUE_CHANNEL on insert so idle workers can be woken
+sa.event.listen(queue, 'after_create', _watch_table_ddl())
+sa.event.listen(queue, 'after_create', sa.DDL(
+    f"SELECT watch_queue_table('queue', '{QUEUE_CHANNEL}')"))
+
 async def put(conn:PoolOrConn, data:dict, transport_type:TransportType) -> int:
     logger.debug(f'enqueing {data["nid"]} for transport type {transport_type.name}')
     return await conn.fetchval(PUSH_Q_STMT, data, transport_type.value)
@@ -105,49 +259,210 @@ async def put(conn:PoolOrConn, data:dict, transport_type:TransportType) -> int:
 async def put_many(conn:PoolOrConn, q_items:list):
     await conn.executemany(PUSH_Q_STMT, q_items)
 
-async def get(conn:PoolOrConn) -> asyncpg.Record:
-    return await conn.fetchrow(POP_Q_STMT)
-
-async def size(conn:PoolOrConn) -> int:
-    return await conn.fetchval(Q_SIZE_STMT)
+async def get(conn:PoolOrConn, transport_type:TransportType=None) -> asyncpg.Record:
+    if transport_type is None:
+        return await conn.fetchrow(POP_Q_STMT)
+    return await conn.fetchrow(POP_Q_BY_TRANSPORT_STMT, transport_type.value)
+
+async def size(conn:PoolOrConn, transport_type:TransportType=None) -> int:
+    if transport_type is None:
+        return await conn.fetchval(Q_SIZE_STMT)
+    return await conn.fetchval(Q_SIZE_BY_TRANSPORT_STMT, transport_type.value)
+
+async def depth_by_priority(conn:PoolOrConn,
+                            transport_type:TransportType=None) -> Dict[Priority, int]:
+    if transport_type is None:
+        rows = await conn.fetch(Q_PRIORITY_DEPTH_STMT)
+    else:
+        rows = await conn.fetch(Q_PRIORITY_DEPTH_BY_TRANSPORT_STMT, transport_type.value)
+    depths = {p: 0 for p in Priority}
+    for row in rows:
+        depths[Priority(row['priority'])] = row['depth']
+    return depths
+
+async def age_priorities(conn:PoolOrConn,
+                         aging_seconds:float=PRIORITY_AGING_SECONDS,
+                         max_priority:Priority=PRIORITY_AGING_MAX) -> int:
+    """Promote items that have waited long enough so low priority items are not starved
+    """
+    result = await conn.execute(AGE_Q_PRIORITIES_STMT, aging_seconds, max_priority.value)
+    # 'UPDATE <count>'
+    return int(result.split()[-1])
+
+async def priority_aging_task(pool:Pool,
+                              interval:float=60,
+                              aging_seconds:float=PRIORITY_AGING_SECONDS,
+                              max_priority:Priority=PRIORITY_AGING_MAX) -> None:
+    while True:
+        try:
+            aged = await age_priorities(pool, aging_seconds, max_priority)
+            logger.debug('queue priorities aged', aged=aged)
+            logger.info('queue depth', **{p.name: depth for p, depth in
+                                          (await depth_by_priority(pool)).items()})
+        except Exception:
+            logger.exception('priority aging failed')
+        await asyncio.sleep(interval)
+
+async def leased_size(conn:PoolOrConn) -> int:
+    return await conn.fetchval(Q_LEASED_SIZE_STMT)
+
+async def lease(conn:PoolOrConn, n:int=1, lease_seconds:float=DEFAULT_LEASE_SECONDS,
+                transport_type:TransportType=None) -> List[asyncpg.Record]:
+    """Claim up to n queue items, invisible to other consumers for lease_seconds
+
+    Claimed items must be removed with ack before the lease expires,
+    otherwise they become visible and will be leased again.
+    """
+    if transport_type is None:
+        rows = await conn.fetch(LEASE_Q_STMT, n, lease_seconds)
+    else:
+        rows = await conn.fetch(LEASE_Q_BY_TRANSPORT_STMT, n, lease_seconds,
+                                transport_type.value)
+    return sorted(rows, key=lambda row: row['qid'])
+
+async def ack(conn:PoolOrConn, qids:List[QItemId]) -> None:
+    if qids:
+        await conn.execute(ACK_Q_STMT, list(qids))
+
+async def release(conn:PoolOrConn, qids:List[QItemId], delay:float=0) -> None:
+    if qids:
+        await conn.execute(RELEASE_Q_STMT, list(qids), delay)
+
+async def retry(conn:PoolOrConn, qids:List[QItemId],
+                base_delay:float=FAILED_RETRY_DELAY_SECONDS,
+                max_attempts:int=PERMANENT_FAIL_COUNT) -> List[QItemId]:
+    """Release failed items with an exponential backoff
+
+    Items which have failed max_attempts times are deleted instead, their
+    qids are returned.
+    """
+    if not qids:
+        return []
+    rows = await conn.fetch(DROP_FAILED_Q_STMT, list(qids), max_attempts)
+    await conn.execute(RETRY_Q_STMT, list(qids), base_delay)
+    return [row['qid'] for row in rows]
 
 
 async def _worker(database_url:str,
                   num_workers:int=10,
-                  q_visibility_timeout:int=5,
+                  lease_seconds:float=DEFAULT_LEASE_SECONDS,
                   worker_func=None,
                   worker_func_kwargs=None) -> None:
 
     workers = []
     for i in range(num_workers):
-      workers.append(worker_factory(database_url,q_visibility_timeout,worker_func, worker_func_kwargs ))
+      workers.append(worker_factory(database_url,lease_seconds,worker_func, worker_func_kwargs ))
+
+
+class Backoff:
+    """Exponentially growing delay between polls of an empty queue
+    """
+    def __init__(self, minimum:float=MIN_POLL_INTERVAL,
+                 maximum:float=MAX_POLL_INTERVAL, factor:float=2):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.factor = factor
+        self.delay = minimum
+
+    def reset(self) -> None:
+        self.delay = self.minimum
+
+    def next(self) -> float:
+        delay = self.delay
+        self.delay = min(self.delay * self.factor, self.maximum)
+        return delay
+
+
+async def process_qitems(conn:PoolOrConn, qitems:List[asyncpg.Record],
+                         worker_func, local_logger,
+                         worker_func_kwargs:dict=None,
+                         item_timeout:float=None) -> Tuple[List[QItemId], List[QItemId]]:
+    """Run worker_func on each leased qitem, settled by a QItem
+
+    The QItem acks, releases or retries the item and records the outcome.
+    Items are processed one after another, so the batch must be leased for
+    item_timeout seconds per item; an item taking longer fails.
+    """
+    worker_func_kwargs = worker_func_kwargs or dict()
+    done = []
+    failed = []
+    for qitem in qitems:
+        try:
+            async with QItem(conn, local_logger, qitem=qitem) as leased:
+                await asyncio.wait_for(worker_func(leased, local_logger, **worker_func_kwargs),
+                                       item_timeout)
+            done.append(qitem['qid'])
+        except RateLimitException:
+            failed.append(qitem['qid'])
+        except PermanentFailException:
+            local_logger.warning('dropping permanently failed qitem', qid=qitem['qid'])
+            done.append(qitem['qid'])
+        except (Exception, SendError):
+            local_logger.exception('worker_func failed', qid=qitem['qid'])
+            failed.append(qitem['qid'])
+    return done, failed
+
+
+async def record_outcome(conn:PoolOrConn, nid:NotificationId, username:str,
+                         transport:int, ex:BaseException=None) -> ActionStatus:
+    """Store the action for a delivery attempt which raised ex, or succeeded if ex is None
+    """
+    if ex is None:
+        await mark_sent(conn, nid, username, transport)
+        return ActionStatus.sent
+    if isinstance(ex, RateLimitException):
+        await mark_rate_limited(conn, nid, username, transport)
+        return ActionStatus.rate_limited
+    if isinstance(ex, PermanentFailException):
+        status = ActionStatus.perm_failed
+    else:
+        status = ActionStatus.failed
+    await store(conn, nid, username, transport, status=status)
+    return status
 
 
 class QItem:
-    __slots__ = ('conn', 'tx','qitem','logger','timers',
-                 'qid','nid','transport','username')
-
-    def __init__(self, conn, logger, timers=None):
+    """Lease one queue item for the duration of the context
+
+    The item is acked (deleted) when the block exits cleanly, and released
+    back to the queue otherwise, rate limited items until the exceeded
+    window has room again. Failed items are retried with a growing
+    delay and dropped after PERMANENT_FAIL_COUNT failures. No transaction is held open while the
+    caller works; an abandoned item becomes visible again when its lease
+    expires. An item already leased as part of a batch can be passed as
+    qitem, it is then settled the same way.
+    """
+    __slots__ = ('conn', 'qitem','logger','timers','transport_type',
+                 'lease_seconds','retry_delay','qid','nid','transport','username')
+
+    def __init__(self, conn, logger=None, timers=None,
+                 transport_type:TransportType=None,
+                 lease_seconds:float=DEFAULT_LEASE_SECONDS,
+                 retry_delay:float=DEFAULT_RETRY_DELAY_SECONDS,
+                 qitem:asyncpg.Record=None):
         self.conn = conn
-        self.tx = None
-        self.qitem = None
-        self.logger = logger
-        self.timers = timers or dict()
+        self.qitem = qitem
+        self.logger = logger if logger is not None else structlog.getLogger(__name__, source='YoDB')
+        self.timers = timers if timers is not None else dict()
+        self.transport_type = transport_type
+        self.lease_seconds = lease_seconds
+        self.retry_delay = retry_delay
         self.qid = None
         self.nid = None
         self.transport = None
         self.username = None
 
     async def __aenter__(self):
-        # start main transation
-        self.tx = self.conn.transaction()
-        await self.tx.start()
-        self.timers['transaction.start'] = perf_counter()
-        qitem = await self.conn.fetchrow(POP_Q_STMT)
-        self.timers['qitem.returned'] = perf_counter()
-        if not qitem: # item might have been removed/processed before we got it
-            self.logger.debug('no qitem', qitem=qitem)
-            return
+        qitem = self.qitem
+        if qitem is None:
+            self.timers['qitem.lease.start'] = perf_counter()
+            qitems = await lease(self.conn, 1, self.lease_seconds,
+                                 transport_type=self.transport_type)
+            self.timers['qitem.returned'] = perf_counter()
+            if not qitems:
+                self.logger.debug('no qitem')
+                return
+            qitem = qitems[0]
         self.logger.debug('qitem', qitem=qitem)
 
         self.qid = qitem['qid']
@@ -164,72 +479,61 @@ class QItem:
 
     async def __aexit__(self, extype, ex, tb):
         self.timers['qitem.aexit.begin'] = perf_counter()
-        if extype is not None:
-            self.timers['qitem.aexit.rollback'] = perf_counter()
-            await self.tx.rollback()
-            self.timers['qitem.aexit.rolled_back'] = perf_counter()
-            if isinstance(ex, RateLimitException):
-                self.timers['qitem.aexit.mark_rate_limited.start'] = perf_counter()
-                await mark_rate_limited(self.conn,self.nid, self.username, self.transport)
-                self.timers[
-                    'qitem.aexit.mark_rate_limited.complete'] = perf_counter()
-            elif isinstance(ex, (PermanentFailException, SendError)):
-                self.timers[
-                    'qitem.aexit.mark_failed.start'] = perf_counter()
-                #await mark_failed(self.conn, self.nid, self.username,
-                #                        self.transport)
-                self.timers[
-                    'qitem.aexit.mark_failed.complete'] = perf_counter()
-
-            else:
-                self.timers[
-                    'qitem.aexit.mark_failed.start'] = perf_counter()
-                #await mark_failed(self.conn, self.nid, self.username,
-                #                  self.transport)
-                self.timers[
-                    'qitem.aexit.mark_failed.complete'] = perf_counter()
-            self.logger.debug('returning qitem to q', qid=self.qitem['qid'])
-        else:
-            self.timers[
-                'qitem.aexit.commit.start'] = perf_counter()
-            await self.tx.commit()
-            self.timers[
-                'qitem.aexit.commit.complete'] = perf_counter()
-            self.timers[
-                'qitem.aexit.mark_sent.start'] = perf_counter()
-            await mark_sent(self.conn,self.nid, self.username, self.transport)
-            self.timers[
-                'qitem.aexit.mark_failed.complete'] = perf_counter()
-            self.logger.debug('deleted qitem from q', qid=self.qitem['qid'])
-
+        if self.qitem is None:
+            return
+        if extype is None or isinstance(ex, PermanentFailException):
+            await ack(self.conn, [self.qid])
+        elif isinstance(ex, RateLimitException):
+            # wait out the exceeded window rather than re-leasing every retry_delay
+            delay = self.retry_delay if ex.retry_after is None else ex.retry_after
+            await release(self.conn, [self.qid], delay=delay)
+        elif await retry(self.conn, [self.qid]):
+            self.logger.warning('dropping qitem after repeated failures')
+            ex = PermanentFailException()
+        self.timers['qitem.aexit.q.complete'] = perf_counter()
+        status = await record_outcome(self.conn, self.nid, self.username,
+                                      self.transport, ex)
+        self.logger.debug('qitem settled', status=status.name)
         self.timers['qitem.aexit.complete'] = perf_counter()
 
+
 def worker_factory(database_url:str,
-                         q_visibility_timeout:int=5,
-                         worker_func=None,
-                         worker_func_kwargs=None):
+                   lease_seconds:float=DEFAULT_LEASE_SECONDS,
+                   worker_func=None,
+                   worker_func_kwargs=None,
+                   batch_size:int=10,
+                   transport_type:TransportType=None,
+                   min_poll_interval:float=MIN_POLL_INTERVAL,
+                   max_poll_interval:float=MAX_POLL_INTERVAL):
+    """Polling worker, backing off while the queue is empty
+
+    See yo.db.queue.watcher.QueueDispatcher for workers woken by NOTIFY.
+    Each item of a batch gets lease_seconds to be processed.
+    """
     worker_func_kwargs = worker_func_kwargs or dict()
     async def q_worker(database_url,
-                       q_visibility_timeout,
+                       lease_seconds,
                        worker_func,
                        worker_func_kwargs):
-        idle_in_transaction_session_timeout = q_visibility_timeout * 1000
-        conn = await yo.db.create_asyncpg_conn(database_url, server_settings={'idle_in_transaction_session_timeout':str(idle_in_transaction_session_timeout)})
+        conn = await yo.db.create_asyncpg_conn(database_url)
         local_logger = logger.bind()
-        timers = {'loop_start':perf_counter()}
+        backoff = Backoff(min_poll_interval, max_poll_interval)
         while True:
-            async with QItem(conn, local_logger) as qitem:
-                timers['qitem.receive'] = perf_counter()
-                if not qitem:
-                    local_logger.debug('no qitem available')
-                    await asyncio.sleep(0)  # yield to others
-                    timers['qitem.empty'] = perf_counter()
-                local_logger.debug('qitem marked invisible', qitem=qitem['qid'])
-                timers['worker_func.start'] = perf_counter()
-                await worker_func(qitem, local_logger, **worker_func_kwargs)
-                timers['worker_func.complete'] = perf_counter()
-                timers['qitem.processed'] = perf_counter()
-            logger.debug('qitem processed',**timers)
-
-
-    return lambda: q_worker(database_url,q_visibility_timeout,worker_func,worker_func_kwargs)
+            timers = {'loop_start':perf_counter()}
+            qitems = await lease(conn, batch_size, lease_seconds * batch_size,
+                                 transport_type=transport_type)
+            timers['qitems.leased'] = perf_counter()
+            if not qitems:
+                local_logger.debug('no qitem available')
+                await asyncio.sleep(backoff.next())
+                continue
+            backoff.reset()
+            done, failed = await process_qitems(conn, qitems, worker_func,
+                                                local_logger, worker_func_kwargs,
+                                                item_timeout=lease_seconds)
+            timers['qitems.processed'] = perf_counter()
+            logger.debug('qitems processed', processed=len(done),
+                         failed=len(failed), **timers)
+
+
+    return lambda: q_worker(database_url,lease_seconds,worker_func,worker_func_kwargs)
@@ -21,6 +21,9 @@ import yo.db
 from yo.db import metadata
 from yo.schema import TransportType
 from yo.json import loads
+from yo.db.queue import get
+from yo.db.queue import put
+from yo.db.queue import size
 
 logger = structlog.getLogger(__name__, source='YoDB')
 
@@ -38,13 +41,15 @@ class QueueStorage:
     '''A mixin class to preserve compatability with asyncio.Queue which
     calls len(self._queue)
     '''
-    def __init__(self, loop, pool):
+    def __init__(self, loop, pool, transport_type:TransportType=None):
         self.loop = loop
         self.pool = pool
+        self.transport_type = transport_type
 
 
     def __len__(self) -> int:
-        return self.loop.run_until_complete(size(self.pool))
+        return self.loop.run_until_complete(
+            size(self.pool, transport_type=self.transport_type))
 
 class WorkQueue(Queue):
 
@@ -54,10 +59,11 @@ class WorkQueue(Queue):
         super().__init__(loop=loop)
 
     def _init(self, maxsize):
-        self._queue = QueueStorage(self._loop, self.pool)
+        self._queue = QueueStorage(self._loop, self.pool, self.transport_type)
 
     def _get(self):
-        return self._loop.run_until_complete(get(self.pool))
+        return self._loop.run_until_complete(
+            get(self.pool, transport_type=self.transport_type))
 
     def _put(self, item):
         return self._loop.run_until_complete(
@@ -1,45 +1,24 @@
 # -*- coding: utf-8 -*-
 import asyncio
-import dateutil
-import dateutil.parser
-import sqlalchemy as sa
+from collections import deque
+
 import structlog
-import toolz
-from functools import partial
-from concurrent.futures import ThreadPoolExecutor
 
-from typing import TypeVar
-from asyncpg.pool import Pool
 from asyncpg.connection import Connection
-from asyncio.queues import Queue
-from time import perf_counter
-
-from sqlalchemy.dialects.postgresql import JSONB
-import asyncpg
 import yo.db
 
-from yo.db import metadata
 from yo.schema import TransportType
 from yo.json import loads
+from yo.db.queue import Backoff
+from yo.db.queue import DEFAULT_LEASE_SECONDS
+from yo.db.queue import MAX_POLL_INTERVAL
+from yo.db.queue import MIN_POLL_INTERVAL
+from yo.db.queue import QUEUE_CHANNEL
+from yo.db.queue import lease
+from yo.db.queue import process_qitems
 
 logger = structlog.getLogger(__name__, source='YoDB')
 
-PoolOrConn = TypeVar('PoolOrConn', Pool, Connection)
-QItemId = int
-NotificationId = int
-
-
-POP_Q_BY_ID_STMT = '''
-DELETE FROM queue
-WHERE qid = (
-  SELECT qid
-  FROM queue
-  WHERE qid=$1
-  FOR UPDATE SKIP LOCKED
-)
-RETURNING qid, data;
-'''
-
 
 NEWEST_QID_STMT = '''
 SELECT qid
@@ -53,72 +32,229 @@ SELECT watch_queue_table($1, $2);
 '''
 
 UNWATCH_Q_TABLE_STMT = '''
-SELECT unwatch_queue_table($1, $2);
+SELECT unwatch_queue_table($1);
 '''
 
-NOTIFY_STMT = '''SELECT pg_notify($1, $2)'''
-
-SET_QUEUE_TIMEOUT_MS_STMT = '''SET idle_in_transaction_session_timeout=$1;'''
-
-
 
 async def watch(conn:Connection, table_name:str, channel:str) -> None:
     await conn.execute(WATCH_Q_TABLE_STMT, table_name, channel)
 
-async def unwatch(conn:Connection, table_name:str, channel:str) -> None:
-    await conn.execute(UNWATCH_Q_TABLE_STMT, table_name, channel)
+async def unwatch(conn:Connection, table_name:str) -> None:
+    await conn.execute(UNWATCH_Q_TABLE_STMT, table_name)
 
 async def newest_qid(conn:Connection) -> int:
     return await conn.fetchval(NEWEST_QID_STMT)
 
 
-
-async def worker_function(payload,worker_conn_pool=None, source=None, **kwargs):
+def parse_payload(payload) -> dict:
     if isinstance(payload, (str, bytes)):
         payload = loads(payload)
-    qid = payload['qid']
-    local_logger = logger.bind(qid=qid, source=source)
-    local_logger.debug('worker_function', payload=payload)
-    async with worker_conn_pool.acquire() as conn:
-        tx = conn.transaction()
+    return payload
+
+
+def payload_count(payload:dict) -> int:
+    """Number of new items a queue NOTIFY payload announces
+
+    Statement triggers send a qid range with a count for each transport,
+    the older row trigger sends a single qid.
+    """
+    if 'count' in payload:
+        return payload['count']
+    if 'min_qid' in payload and 'max_qid' in payload:
+        return payload['max_qid'] - payload['min_qid'] + 1
+    return 1
+
+
+class QueueDispatcher:
+    """Queue workers which sleep until a NOTIFY says there is work
+
+    One connection LISTENs on the queue channel and each notification wakes
+    at most one idle worker per new item. Idle workers also poll with an
+    exponential backoff so notifications missed while the LISTEN connection
+    was down are still picked up.
+
+    Workers lease items and run worker_func on each, or, if batch_func is
+    given, call batch_func(conn, batch_size, **worker_func_kwargs) which
+    consumes items itself and returns how many it processed. If given,
+    before_batch(qitems) is awaited with each leased batch before
+    worker_func runs on its items. Batches are processed one item at a time,
+    so each is leased for lease_seconds per item.
+    """
+    def __init__(self,
+                 database_url:str,
+                 worker_func,
+                 worker_func_kwargs:dict=None,
+                 transport_type:TransportType=None,
+                 num_workers:int=10,
+                 batch_size:int=10,
+                 lease_seconds:float=DEFAULT_LEASE_SECONDS,
+                 channel:str=QUEUE_CHANNEL,
+                 min_poll_interval:float=MIN_POLL_INTERVAL,
+                 max_poll_interval:float=MAX_POLL_INTERVAL,
+                 batch_func=None,
+                 before_batch=None,
+                 loop=None):
+        self.database_url = database_url
+        self.worker_func = worker_func
+        self.batch_func = batch_func
+        self.before_batch = before_batch
+        self.worker_func_kwargs = worker_func_kwargs or dict()
+        self.transport_type = transport_type
+        self.num_workers = num_workers
+        self.batch_size = batch_size
+        self.lease_seconds = lease_seconds
+        self.channel = channel
+        self.min_poll_interval = min_poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.loop = loop or asyncio.get_event_loop()
+
+        self.pool = None
+        self._listen_conn = None
+        self._waiters = deque()
+        # wakeups which arrived while no worker was waiting
+        self._pending = 0
+        self._stopped = asyncio.Event(loop=self.loop)
+        self.logger = logger.bind(channel=channel,
+                                  transport=getattr(transport_type, 'name', None))
+
+    def wake(self, n:int=1) -> int:
+        woken = 0
+        while self._waiters and woken < n:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(True)
+                woken += 1
+        self._pending = min(self._pending + n - woken, self.num_workers)
+        return woken
+
+    async def wait(self, timeout:float) -> bool:
+        """Wait for a wakeup, returns False if timeout passed without one
+        """
+        if self._pending:
+            self._pending -= 1
+            return True
+        waiter = self.loop.create_future()
+        self._waiters.append(waiter)
         try:
-            await tx.start()
-            row = await conn.fetchrow(POP_Q_BY_ID_STMT, qid)
-            if not row:
-                local_logger.debug('no free item in q')
-                await tx.rollback()
-                return
-            local_logger.debug('worker_function received qitem', item=row)
-            await asyncio.sleep(1)
-        except Exception as e:
-            await tx.rollback()
-            local_logger.exception('worker_function error')
-        else:
-            await tx.commit()
-            local_logger.debug('worker_function success')
+            return await asyncio.wait_for(waiter, timeout, loop=self.loop)
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            try:
+                self._waiters.remove(waiter)
+            except ValueError:
+                pass
 
+    def _on_notify(self, conn, pid, channel, payload):
+        try:
+            payload = parse_payload(payload)
+        except Exception:
+            self.logger.warning('unparseable NOTIFY payload', payload=payload)
+            self.wake(self.num_workers)
+            return
+        if self.transport_type is not None and \
+                payload.get('transport') not in (None, self.transport_type.value):
+            return
+        # each woken worker leases up to batch_size items
+        count = payload_count(payload)
+        self.wake(-(-count // self.batch_size))
 
-def queue_callback(conn, pid, channel, payload, worker_func=None, worker_conn_pool=None, **kwargs):
-    logger.debug('NOTIFY', conn=conn, pid=pid, channel=channel, payload=payload,payload_type=type(payload))
-    asyncio.ensure_future(worker_func(payload, worker_conn_pool=worker_conn_pool, source='notify',**kwargs))
+    async def listen(self) -> None:
+        if self._listen_conn is not None and not self._listen_conn.is_closed():
+            await self._listen_conn.close()
+        self._listen_conn = await yo.db.create_asyncpg_conn(self.database_url,
+                                                            loop=self.loop)
+        await self._listen_conn.add_listener(self.channel, self._on_notify)
+        self.logger.info('listening')
+        # items enqueued while we weren't listening
+        self.wake(self.num_workers)
 
+    async def _worker(self, worker_id:int) -> None:
+        local_logger = self.logger.bind(worker_id=worker_id)
+        backoff = Backoff(self.min_poll_interval, self.max_poll_interval)
+        while not self._stopped.is_set():
+            try:
+                async with self.pool.acquire() as conn:
+                    if self.batch_func is not None:
+                        processed = await self.batch_func(conn, self.batch_size,
+                                                          **self.worker_func_kwargs)
+                    else:
+                        qitems = await lease(conn, self.batch_size,
+                                             self.lease_seconds * self.batch_size,
+                                             transport_type=self.transport_type)
+                        processed = len(qitems)
+                        if qitems and self.before_batch is not None:
+                            await self.before_batch(qitems)
+                        if qitems:
+                            done, failed = await process_qitems(
+                                conn, qitems, self.worker_func, local_logger,
+                                self.worker_func_kwargs, item_timeout=self.lease_seconds)
+                            local_logger.debug('qitems processed', processed=len(done),
+                                               failed=len(failed))
+            except Exception:
+                local_logger.exception('queue worker error')
+                await asyncio.sleep(backoff.next())
+                continue
+            if processed:
+                backoff.reset()
+                continue
+            if await self.wait(backoff.next()):
+                backoff.reset()
 
-async def queue_watcher(database_url,
-                        channel='queue_changefeed',
-                        callback_func=queue_callback,
-                        worker_func=None,
-                        worker_func_kwargs=None):
-    worker_func_kwargs = worker_func_kwargs or dict()
-    worker_conn_pool = await yo.db.create_asyncpg_pool(database_url)
-    conn = await yo.db.create_asyncpg_conn(database_url)
-    starting_qid = await newest_qid(conn)
+    async def _supervise_listener(self) -> None:
+        while not self._stopped.is_set():
+            try:
+                await asyncio.wait_for(self._stopped.wait(), self.max_poll_interval,
+                                       loop=self.loop)
+            except asyncio.TimeoutError:
+                pass
+            if self._stopped.is_set():
+                return
+            if self._listen_conn.is_closed():
+                self.logger.warning('LISTEN connection lost, reconnecting')
+                try:
+                    await self.listen()
+                except Exception:
+                    self.logger.exception('unable to reconnect LISTEN connection')
 
+    async def run(self) -> None:
+        self.pool = await yo.db.create_asyncpg_pool(self.database_url,
+                                                    loop=self.loop,
+                                                    max_size=self.num_workers)
+        await self.listen()
+        workers = [asyncio.ensure_future(self._worker(i), loop=self.loop)
+                   for i in range(self.num_workers)]
+        try:
+            await self._supervise_listener()
+            await asyncio.gather(*workers, loop=self.loop)
+        finally:
+            for worker in workers:
+                worker.cancel()
+            await self.close()
 
-    callback_func = partial(callback_func,
-                            worker_func=worker_func,
-                            worker_conn_pool=worker_conn_pool,
-                            **worker_func_kwargs)
-    await conn.add_listener(channel, callback_func)
+    def stop(self) -> None:
+        """Let workers finish their current batch, then exit run
+        """
+        self._stopped.set()
+        self.wake(self.num_workers)
 
+    async def close(self) -> None:
+        if self._listen_conn is not None:
+            await self._listen_conn.close()
+            self._listen_conn = None
+        if self.pool is not None:
+            await self.pool.close()
+            self.pool = None
 
 
+async def queue_watcher(database_url:str,
+                        channel:str=QUEUE_CHANNEL,
+                        worker_func=None,
+                        worker_func_kwargs:dict=None,
+                        **kwargs) -> None:
+    dispatcher = QueueDispatcher(database_url,
+                                 worker_func,
+                                 worker_func_kwargs=worker_func_kwargs,
+                                 channel=channel,
+                                 **kwargs)
+    await dispatcher.run()
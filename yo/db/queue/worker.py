@@ -16,17 +16,15 @@ async def worker_funcy(qitem, local_logger, **kwargs):
 
 @click.command(name='work')
 @click.option('--database_url', envvar='DATABASE_URL')
-def work(database_url):
+@click.option('--num_workers', type=int, default=50)
+def work(database_url, num_workers):
     loop = asyncio.get_event_loop()
-    from yo.db.queue import worker_factory
-    q_workers = []
-    for i in range(50):
-        worker = worker_factory(database_url=database_url,
-                              q_visibility_timeout=5,
-                              worker_func=worker_funcy)
-        q_workers.append(worker())
-
-    loop.run_until_complete(asyncio.gather(*q_workers))
+    from yo.db.queue.watcher import QueueDispatcher
+    dispatcher = QueueDispatcher(database_url,
+                                 worker_func=worker_funcy,
+                                 num_workers=num_workers,
+                                 loop=loop)
+    loop.run_until_complete(dispatcher.run())
 
 
 
@@ -1,7 +1,6 @@
 # -*- coding: utf-8 -*-
 import asyncio
 import ujson
-from collections.abc import MutableMapping
 from collections import namedtuple
 from typing import Optional
 from typing import TypeVar
@@ -12,15 +11,17 @@ import structlog
 from asyncpg.pool import Pool
 from asyncpg.connection import Connection
 
-from pylru import WriteThroughCacheManager
 from sqlalchemy.dialects.postgresql import JSONB
 
+from yo.cache import AsyncTTLCache
 from yo.rpc_client import get_user_data
+from yo.rpc_client import get_user_data_batch
 
 from ..schema import NOTIFICATION_TYPES
 from ..schema import NotificationType
 
 from yo.db import metadata
+from yo.db import create_asyncpg_conn
 
 class UserNotFoundError(Exception):
     pass
@@ -45,6 +46,11 @@ CREATE_USER_WITHOUT_TRANSPORTS_STMT = '''INSERT INTO users(username) VALUES($1)
 UPDATE_USER_TRANSPORTS_STMT = '''UPDATE users SET transports = $1 WHERE username = $2 RETURNING username'''
 GET_USER_TRANSPORTS_STMT = '''SELECT transports FROM users WHERE username = $1'''
 
+USERS_CHANNEL = 'users_changefeed'
+
+# conveyor user data, users conveyor doesn't know are cached as None
+USER_DATA = AsyncTTLCache(maxsize=100000, ttl=600, negative_ttl=60, name='user_data')
+
 
 user_settings_table = sa.Table(
     'users', metadata,
@@ -65,6 +71,19 @@ user_settings_table = sa.Table(
         index=True),
     sa.Index('users_transports_ix', 'transports', postgresql_using='gin'))
 
+# NOTIFY the username of every changed user so transport caches can invalidate it
+sa.event.listen(user_settings_table, 'after_create', sa.DDL(f'''
+CREATE OR REPLACE FUNCTION notify_users_changed() RETURNS TRIGGER AS $$
+BEGIN
+    PERFORM pg_notify('{USERS_CHANNEL}', OLD.username);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER users_changed_trigger AFTER UPDATE OR DELETE ON users
+FOR EACH ROW EXECUTE PROCEDURE notify_users_changed();
+'''))
+
 
 async def create_user(conn:PoolOrConn, username:str, transports:dict=None) -> bool:
     transports = transports or DEFAULT_USER_TRANSPORT_SETTINGS
@@ -115,13 +134,49 @@ async def set_user_transports(conn:PoolOrConn, username:str, transports:dict=Non
     logger.info('creating user to set transports', username=username)
     return await create_user(conn, username, transports=transports)
 
-async def get_user_email(username:str=None) -> str:
-    response = await get_user_data(username)
-    return response['email']
-
-async def get_user_phone(username:str=None) -> str:
-    response = await get_user_data(username)
-    return response['phone']
+async def _fetch_user_data(username:str) -> Optional[dict]:
+    try:
+        return await get_user_data(username)
+    except KeyError:
+        # conveyor responded with an error instead of a result
+        logger.debug('user data not found', username=username)
+        return None
+
+async def get_cached_user_data(username:str) -> Optional[dict]:
+    return await USER_DATA.get_or_fetch(username, _fetch_user_data, username)
+
+async def prefetch_user_data(usernames) -> int:
+    """Fetch the uncached users among usernames with one batched request
+
+    Users which can't be prefetched are still looked up one at a time by
+    get_cached_user_data. Returns the number of users fetched.
+    """
+    missing = sorted({username for username in usernames if username not in USER_DATA})
+    if not missing:
+        return 0
+    try:
+        results = await get_user_data_batch(missing)
+    except Exception:
+        logger.exception('user data prefetch failed', count=len(missing))
+        return 0
+    for username, user_data in results.items():
+        USER_DATA.set(username, user_data)
+    return len(missing)
+
+def user_data_cache_stats() -> dict:
+    return USER_DATA.stats()
+
+async def get_user_email(username:str=None) -> Optional[str]:
+    user_data = await get_cached_user_data(username)
+    if user_data is None:
+        return None
+    return user_data.get('email')
+
+async def get_user_phone(username:str=None) -> Optional[str]:
+    user_data = await get_cached_user_data(username)
+    if user_data is None:
+        return None
+    return user_data.get('phone')
 
 
 async def get_user_transports_for_notification(conn:PoolOrConn, username:str, notification_type:NotificationType) -> list:
@@ -144,54 +199,49 @@ class User:
     def phone(self):
         pass
 
-def _run(coro, loop=None):
-    loop = loop or asyncio.get_event_loop()
-    return loop.run_until_complete(coro)
-
-class Users(MutableMapping):
-    def __init__(self, pool:Pool):
-        self.pool = pool
-
-    def __getitem__(self, username:str):
-        return _run(get_user_transports(self.pool, username))
-
-    def __setitem__(self, username, transports):
-        _run(set_user_transports(self.pool, username))
-
-    def __delitem__(self, key):
-        raise NotImplementedError
-
-    def __iter__(self):
-        raise NotImplementedError
-
-    def __len__(self):
-        raise NotImplementedError
-
-    def __contains__(self, username):
-        raise NotImplementedError
-
-    def keys(self):
-        raise NotImplementedError
-
-    def values(self):
-        raise NotImplementedError
-
-    def items(self):
-        raise NotImplementedError
-
-    def popitem(self):
-        raise NotImplementedError
-
-    def pop(self, key, default=None):
-        raise NotImplementedError
-
-
-async def create_users_writethrough_cache_async(pool):
-    users = Users(pool)
-    return WriteThroughCacheManager(users, 100000)
-
-
-def create_users_writethrough_cache(pool):
-    return _run(create_users_writethrough_cache_async(pool))
 
+class UserTransportsCache:
+    """Read-through cache of user transport settings
 
+    Entries are evicted by LRU and TTL, and invalidated when the users
+    trigger NOTIFYs a change, so writes from any process are seen here.
+    """
+    def __init__(self, pool:Pool, maxsize:int=100000, ttl:float=300):
+        self.pool = pool
+        self.cache = AsyncTTLCache(maxsize=maxsize, ttl=ttl, name='user_transports')
+        self._listen_conn = None
+
+    async def get(self, username:str) -> dict:
+        return await self.cache.get_or_fetch(username, get_user_transports, self.pool, username)
+
+    async def get_for_notification(self, username:str,
+                                   notification_type:NotificationType) -> list:
+        transports = await self.get(username)
+        name = notification_type.name
+        return [k for k,v in transports.items() if name in v['notification_types']]
+
+    async def set(self, username:str, transports:dict) -> bool:
+        result = await set_user_transports(self.pool, username, transports=transports)
+        self.invalidate(username)
+        return result
+
+    def invalidate(self, username:str) -> None:
+        logger.debug('invalidating user transports', username=username)
+        self.cache.invalidate(username)
+
+    def _users_changed(self, conn, pid, channel, payload):
+        self.invalidate(payload)
+
+    async def listen(self, database_url:str) -> None:
+        self._listen_conn = await create_asyncpg_conn(database_url)
+        await self._listen_conn.add_listener(USERS_CHANNEL, self._users_changed)
+        # changes made before we were listening are unknown
+        self.cache.clear()
+
+    async def close(self) -> None:
+        if self._listen_conn is not None:
+            await self._listen_conn.close()
+            self._listen_conn = None
+
+    def stats(self) -> dict:
+        return self.cache.stats()
@@ -33,9 +33,7 @@ async def watch_table(database_url, table_name, channel):
 @click.option('--channel')
 def watch(database_url, table_name, channel):
     loop = asyncio.get_event_loop()
-    from yo.db.queue import queue_watcher
-    from yo.db.queue import worker_function
-    loop.run_until_complete(queue_watcher(database_url=database_url, channel=channel, worker_func=worker_function))
+    loop.run_until_complete(watch_table(database_url, table_name, channel))
 
 
 
@@ -69,7 +69,7 @@ DECLARE
   stmt text;
 BEGIN
     -- Drop existing triggers if they exist.
-    EXECUTE unwatch_table(target_table);
+    PERFORM unwatch_table(target_table);
 
     -- Row level watch trigger.
     stmt = 'CREATE TRIGGER watch_trigger_row AFTER INSERT OR UPDATE OR DELETE ON ' ||
@@ -105,7 +105,8 @@ BEGIN
     IF TG_WHEN <> 'AFTER' THEN
         RAISE EXCEPTION 'if_insert_queue_table_func() may only run as an AFTER trigger';
     END IF;
-    IF TG_TABLE_NAME <> 'queue' THEN
+    -- row triggers on the partitioned queue table fire on its partitions
+    IF TG_TABLE_NAME <> 'queue' AND TG_TABLE_NAME NOT LIKE 'queue\_%' THEN
         RAISE EXCEPTION 'if_insert_queue_table_func() may only run as trigger on queue table';
     END IF;
     IF TG_OP <> 'INSERT' THEN
@@ -120,7 +121,8 @@ BEGIN
                                  'transaction_time', transaction_timestamp(),
                                  'capture_time', clock_timestamp(),
                                  'source', 'trigger',
-                                 'qid', qid);
+                                 'qid', qid,
+                                 'transport', NEW.transport);
 
 
     channel = TG_ARGV[0];
@@ -133,10 +135,49 @@ END;
 $$ LANGUAGE plpgsql;
 
 
+-- Check if rows on queue table have been added by a statement.
+-- Sends one notification per transport with the range of inserted qids,
+-- rather than one per row. Requires Postgres 10+ (transition tables).
+CREATE OR REPLACE FUNCTION if_insert_queue_table_stmt_func() RETURNS TRIGGER AS $$
+DECLARE
+    channel text;
+    inserted record;
+
+BEGIN
+    IF TG_WHEN <> 'AFTER' OR TG_LEVEL <> 'STATEMENT' THEN
+        RAISE EXCEPTION 'if_insert_queue_table_stmt_func() may only run as an AFTER STATEMENT trigger';
+    END IF;
+    IF TG_OP <> 'INSERT' THEN
+        RAISE EXCEPTION 'if_insert_queue_table_stmt_func() may only run as trigger on INSERT operations';
+    END IF;
+
+    channel = TG_ARGV[0];
+
+    FOR inserted IN
+        SELECT transport, MIN(qid) AS min_qid, MAX(qid) AS max_qid, COUNT(*) AS count
+        FROM new_rows
+        GROUP BY transport
+    LOOP
+        perform pg_notify(channel, jsonb_build_object(
+                                 'table_name', TG_TABLE_NAME::text,
+                                 'transaction_time', transaction_timestamp(),
+                                 'source', 'trigger',
+                                 'transport', inserted.transport,
+                                 'min_qid', inserted.min_qid,
+                                 'max_qid', inserted.max_qid,
+                                 'count', inserted.count)::text);
+    END LOOP;
+
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+
 -- Unwatch queue table.
 CREATE OR REPLACE FUNCTION unwatch_queue_table(target_table regclass) RETURNS void AS $$
 BEGIN
     EXECUTE 'DROP TRIGGER IF EXISTS watch_trigger_row ON ' || target_table;
+    EXECUTE 'DROP TRIGGER IF EXISTS watch_trigger_stmt ON ' || target_table;
 END;
 $$ LANGUAGE plpgsql;
 
@@ -146,11 +187,12 @@ DECLARE
   stmt text;
 BEGIN
     -- Drop existing triggers if they exist.
-    EXECUTE unwatch_queue_table(target_table);
+    PERFORM unwatch_queue_table(target_table);
 
-    -- Row level watch trigger.
-    stmt = 'CREATE TRIGGER watch_trigger_row AFTER INSERT ON ' || target_table ||
-           ' FOR EACH ROW EXECUTE PROCEDURE if_insert_queue_table_func(' ||
+    -- Statement level watch trigger, one NOTIFY per transport per INSERT.
+    stmt = 'CREATE TRIGGER watch_trigger_stmt AFTER INSERT ON ' || target_table ||
+           ' REFERENCING NEW TABLE AS new_rows' ||
+           ' FOR EACH STATEMENT EXECUTE PROCEDURE if_insert_queue_table_stmt_func(' ||
              quote_literal(channel) || ');';
     RAISE NOTICE '%', stmt;
     EXECUTE stmt;
@@ -11,17 +11,104 @@ logger = structlog.getLogger(__name__, source='rpc_client')
 
 from rpcauth import sign
 
+SESSION_POOL_SIZE = 100
+SESSION_DNS_CACHE_TTL = 300
+SESSION_KEEPALIVE_TIMEOUT = 60
+
+_session = None
+
+
+def configure_session(pool_size:int=SESSION_POOL_SIZE,
+                      dns_cache_ttl:int=SESSION_DNS_CACHE_TTL,
+                      keepalive_timeout:int=SESSION_KEEPALIVE_TIMEOUT,
+                      loop=None) -> aiohttp.ClientSession:
+    """Create the shared session, replacing any existing one
+
+    The previous session, if any, must be closed with close_session first.
+    """
+    # pylint: disable=global-statement
+    global _session
+    connector = aiohttp.TCPConnector(limit=pool_size,
+                                     ttl_dns_cache=dns_cache_ttl,
+                                     keepalive_timeout=keepalive_timeout,
+                                     loop=loop)
+    _session = aiohttp.ClientSession(connector=connector,
+                                     json_serialize=dumps,
+                                     loop=loop)
+    logger.debug('session configured', pool_size=pool_size,
+                 dns_cache_ttl=dns_cache_ttl, keepalive_timeout=keepalive_timeout)
+    return _session
+
+
+def get_session() -> aiohttp.ClientSession:
+    if _session is None or _session.closed:
+        return configure_session()
+    return _session
+
+
+async def close_session() -> None:
+    # pylint: disable=global-statement
+    global _session
+    if _session is not None:
+        await _session.close()
+        _session = None
+
+
+async def _post(payload, url:str):
+    async with get_session().post(url, json=payload, encoding='utf8') as resp:
+        return await resp.json(encoding='utf8', loads=loads)
+
+
 async def auth_request(jsonrpc_request:dict, account:str='test', keys:tuple=('test'), url:str='https://api.steemit.com') -> dict:
     signed_request = sign(jsonrpc_request, account, list(keys))
-    async with aiohttp.ClientSession(json_serialize=dumps) as session:
-        async with session.post(url, json=signed_request, encoding='utf8') as resp:
-            return await resp.json(encoding='utf8', loads=loads)
+    return await _post(signed_request, url)
 
-async def get_user_data(username:str, account:str=None, keys:tuple=None, url:str='https://api.steemit.com') -> dict:
-    rpc_request = {
-        'id':     1, 'jsonrpc': '2.0',
+
+async def auth_batch_request(jsonrpc_requests:list, account:str='test', keys:tuple=('test'), url:str='https://api.steemit.com') -> list:
+    """Sign each request and send them together as one JSON-RPC batch
+    """
+    signed_requests = [sign(request, account, list(keys)) for request in jsonrpc_requests]
+    return await _post(signed_requests, url)
+
+
+def _user_data_request(username:str, request_id:int=1) -> dict:
+    return {
+        'id':     request_id, 'jsonrpc': '2.0',
         'method': 'conveyor.get_user_data',
         'params': {'username': username}
     }
+
+
+async def get_user_data(username:str, account:str=None, keys:tuple=None, url:str='https://api.steemit.com') -> dict:
+    rpc_request = _user_data_request(username)
     response = await auth_request(rpc_request, account=account, keys=keys, url=url)
     return response['result']
+
+
+async def get_user_data_batch(usernames:list, account:str=None, keys:tuple=None, url:str='https://api.steemit.com') -> dict:
+    """Look up several users with one POST
+
+    Raises ValueError if the whole batch is rejected with a single error.
+
+    Returns:
+        dict: username -> user data, None for users conveyor returned an error for
+    """
+    usernames = list(usernames)
+    rpc_requests = [_user_data_request(username, request_id=i)
+                    for i, username in enumerate(usernames)]
+    responses = await auth_batch_request(rpc_requests, account=account, keys=keys, url=url)
+    if not isinstance(responses, list):
+        raise ValueError(f'get_user_data_batch rejected: {responses.get("error", responses)}')
+    results = dict.fromkeys(usernames)
+    for response in responses:
+        request_id = response.get('id')
+        if not isinstance(request_id, int) or not 0 <= request_id < len(usernames):
+            logger.debug('get_user_data_batch unmatched response', response=response)
+            continue
+        username = usernames[request_id]
+        if 'error' in response:
+            logger.debug('get_user_data_batch error', username=username,
+                         error=response['error'])
+            continue
+        results[username] = response['result']
+    return results
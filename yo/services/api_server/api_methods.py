@@ -1,115 +1,158 @@
 # -*- coding: utf-8 -*-
 
+import datetime
+
+import dateutil.parser
 import structlog
 
+from ...schema import NotificationType
 from ...schema import TransportType
-from db.desktop import get__notifications
-from db.desktop import mark_read
-from db.desktop import mark_unread
-from db.desktops import mark_shown
-from db.desktop import mark_unshown
+from ...db.desktop import get_counts
+from ...db.desktop import get_user_desktop_notifications
+from ...db.desktop import mark_read
+from ...db.desktop import mark_unread
+from ...db.desktop import mark_shown
+from ...db.desktop import mark_unshown
 
 
 logger = structlog.getLogger(__name__)
 
 TRANSPORT_KEYS = {'notification_types', 'sub_data'}
-TRANSPORT_TYPES = set(t.value for t in TransportType)
-
-
+TRANSPORT_TYPES = set(t.name for t in TransportType)
+
+
+def _parse_timestamp(value):
+    """Parse an ISO8601 timestamp to a naive UTC datetime
+    """
+    if value is None:
+        return None
+    timestamp = dateutil.parser.parse(value)
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return timestamp
+
+
+def _notification(row) -> dict:
+    return {
+        'notify_id':     row['dnid'],
+        'notify_type':   NotificationType(row['notify_type']).name,
+        'to_username':   row['to_username'],
+        'from_username': row['from_username'],
+        'json_data':     row['json_data'],
+        'created':       row['created'],
+        'updated':       row['updated'],
+        'shown':         row['shown'] is not None,
+        'read':          row['read'] is not None
+    }
+
+
+# pylint: disable=too-many-arguments
 async def api_get_notifications(username=None,
                                 created_before=None,
+                                before_id=None,
                                 updated_after=None,
                                 read=None,
                                 notify_types=None,
                                 limit=30,
                                 context=None):
-    """ Get all notifications since the specified time
+    """ Get a page of notifications, newest first
 
    Keyword args:
       username(str): The username to query for
       created_before(str): ISO8601-formatted timestamp
+      before_id(int): notify_id of the last notification of the previous page,
+          paired with its created timestamp as created_before
       updated_after(str): ISO8601-formatted timestamp
       read(bool): If set, only returns notifications with read flag set to this value
-      notify_types(str): The notification type to return
+      notify_types(list): The notification types to return
       limit(int): The maximum number of notifications to return, defaults to 30
 
    Returns:
       list: list of notifications represented in dictionary format
    """
-    engine = context['app'].async_db_engine
-    async with engine.acquire() as conn:
-        result = get_wwwpoll_notifications(conn,
-            to_username=username,
-            created_before=created_before,
-            updated_after=updated_after,
-            notify_types=notify_types,
-            read=read,
-            limit=limit)
-    return result
+    if isinstance(notify_types, str):
+        notify_types = [notify_types]
+    if notify_types:
+        notify_types = [NotificationType[t].value for t in notify_types]
+    rows = await get_user_desktop_notifications(
+        context['app'].db_pool,
+        username,
+        created_before=_parse_timestamp(created_before),
+        before_dnid=before_id,
+        updated_after=_parse_timestamp(updated_after),
+        read=read,
+        notify_types=notify_types,
+        limit=limit)
+    return [_notification(row) for row in rows]
 # pylint: enable=too-many-arguments
 
-async def api_mark_read(ids=None, context=None):
+async def api_get_unread_count(username=None, context=None):
+    """ Get the number of unread and unshown notifications
+
+   Keyword args:
+      username(str): The username to query for
+
+   Returns:
+      dict: unread and unshown counts
+   """
+    return await get_counts(context['app'].db_pool, username)
+
+
+async def api_mark_read(username=None, ids=None, context=None):
     """ Mark a list of notifications as read
 
    Keyword args:
+       username(str): The user the notifications belong to, others' are left alone
        ids(list): List of notifications to mark read
 
    Returns:
-       list: list of notifications updated
+       list: ids of the notifications which were changed
    """
-    engine = context['app'].async_db_engine
-    async with engine.acquire() as conn:
-        ids = ids or []
-        return [wwwpoll_mark_read(conn, nid) for nid in ids]
+    return await mark_read(context['app'].db_pool, username, ids or [])
 
 
-async def api_mark_unread(ids=None, context=None):
+async def api_mark_unread(username=None, ids=None, context=None):
     """ Mark a list of notifications as unread
 
    Keyword args:
+       username(str): The user the notifications belong to, others' are left alone
        ids(list): List of notifications to mark unread
 
    Returns:
-       list: list of notifications updated
+       list: ids of the notifications which were changed
    """
-    engine = context['app'].async_db_engine
-    async with engine.acquire() as conn:
-        ids = ids or []
-        return [wwwpoll_mark_unread(conn,nid) for nid in ids]
+    return await mark_unread(context['app'].db_pool, username, ids or [])
 
 
-async def api_mark_shown(ids=None, context=None):
+async def api_mark_shown(username=None, ids=None, context=None):
     """ Mark a list of notifications as shown
 
    Keyword args:
+       username(str): The user the notifications belong to, others' are left alone
        ids(list): List of notifications to mark shown
 
    Returns:
-       list: list of notifications updated
+       list: ids of the notifications which were changed
    """
-    engine = context['app'].async_db_engine
-    async with engine.acquire() as conn:
-        return [wwwpoll_mark_shown(conn,nid) for nid in ids]
+    return await mark_shown(context['app'].db_pool, username, ids or [])
 
 
-async def api_mark_unshown(ids=None, context=None):
+async def api_mark_unshown(username=None, ids=None, context=None):
     """ Mark a list of notifications as unshown
 
    Keyword args:
+       username(str): The user the notifications belong to, others' are left alone
        ids(list): List of notifications to mark unshown
 
    Returns:
-       list: list of notifications updated
+       list: ids of the notifications which were changed
    """
-    engine = context['app'].async_db_engine
-    async with engine.acquire() as conn:
-        ids = ids or []
-        return [wwwpoll_mark_unshown(conn,nid) for nid in ids]
+    return await mark_unshown(context['app'].db_pool, username, ids or [])
 
 
 async def api_get_transports(username=None, context=None):
-    Users = context['app'].Users
-    return Users[username]
+    user_transports = context['app'].user_transports
+    return await user_transports.get(username)
 
 
 async def api_set_transports(username=None, transports=None, context=None):
@@ -120,8 +163,8 @@ async def api_set_transports(username=None, transports=None, context=None):
     for transport in transports.values():
         assert TRANSPORT_KEYS.issuperset(transport.keys()), 'bad transport data'
 
-    Users = context['app'].Users
-    Users[username] = transports
+    user_transports = context['app'].user_transports
+    return await user_transports.set(username, transports)
 
 
 def init_api(self):
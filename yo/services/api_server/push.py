@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+"""Push new desktop notifications to websocket clients"""
+import asyncio
+import functools
+from collections import defaultdict
+
+import structlog
+from aiohttp import web
+from aiohttp import WSCloseCode
+from aiohttp import WSMsgType
+
+from ...db import create_asyncpg_conn
+from ...db.desktop import DESKTOP_CHANNEL
+from ...json import loads
+from ...schema import NotificationType
+
+logger = structlog.getLogger(__name__, service_name='api_server')
+
+MAX_PENDING_MESSAGES = 100
+WEBSOCKET_HEARTBEAT = 30
+# seconds between checks of the LISTEN connection
+LISTEN_CHECK_INTERVAL = 5
+
+
+class Subscription:
+    """Bounded queue of messages for one websocket connection
+
+    When a client can't keep up the queue fills, further messages are
+    dropped and the client is told to resync once it catches up.
+    """
+    __slots__ = ('username', 'queue', 'overflowed')
+
+    def __init__(self, username:str, maxsize:int=MAX_PENDING_MESSAGES):
+        self.username = username
+        self.queue = asyncio.Queue(maxsize=maxsize)
+        self.overflowed = False
+
+    def put(self, message:dict) -> None:
+        try:
+            self.queue.put_nowait(message)
+        except asyncio.QueueFull:
+            self.overflowed = True
+
+    async def get(self) -> dict:
+        message = await self.queue.get()
+        if self.overflowed and self.queue.empty():
+            self.overflowed = False
+            # the dropped notifications have to be fetched with yo.get_db_notifications
+            self.put({'type': 'resync'})
+        return message
+
+
+def _message(row:list) -> dict:
+    dnid, to_username, notify_type, from_username = row
+    return {
+        'type':          'notification',
+        'notify_id':     dnid,
+        'notify_type':   NotificationType(notify_type).name,
+        'to_username':   to_username,
+        'from_username': from_username
+    }
+
+
+class DesktopPushHub:
+    """Fan out desktop inserts from one LISTEN connection to subscribed users
+
+    A lost LISTEN connection is reconnected, and since inserts made while it
+    was down were never pushed every subscriber is then told to resync.
+    """
+    def __init__(self, maxsize:int=MAX_PENDING_MESSAGES,
+                 check_interval:float=LISTEN_CHECK_INTERVAL):
+        self.maxsize = maxsize
+        self.check_interval = check_interval
+        self.subscriptions = defaultdict(set)
+        self.sockets = set()
+        self.database_url = None
+        self._listen_conn = None
+        self._supervisor = None
+
+    def subscribe(self, username:str) -> Subscription:
+        subscription = Subscription(username, maxsize=self.maxsize)
+        self.subscriptions[username].add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription:Subscription) -> None:
+        subscriptions = self.subscriptions.get(subscription.username)
+        if subscriptions is None:
+            return
+        subscriptions.discard(subscription)
+        if not subscriptions:
+            del self.subscriptions[subscription.username]
+
+    def publish(self, rows:list) -> None:
+        for row in rows:
+            subscriptions = self.subscriptions.get(row[1])
+            if not subscriptions:
+                continue
+            message = _message(row)
+            for subscription in subscriptions:
+                subscription.put(message)
+
+    def resync(self) -> None:
+        for subscriptions in self.subscriptions.values():
+            for subscription in subscriptions:
+                subscription.put({'type': 'resync'})
+
+    def _on_notify(self, conn, pid, channel, payload):
+        try:
+            self.publish(loads(payload))
+        except Exception:
+            logger.exception('bad desktop NOTIFY payload', payload=payload)
+
+    async def _connect(self) -> None:
+        self._listen_conn = await create_asyncpg_conn(self.database_url)
+        await self._listen_conn.add_listener(DESKTOP_CHANNEL, self._on_notify)
+
+    async def _supervise_listener(self) -> None:
+        while True:
+            await asyncio.sleep(self.check_interval)
+            if self._listen_conn is not None and not self._listen_conn.is_closed():
+                continue
+            logger.warning('desktop LISTEN connection lost, reconnecting')
+            try:
+                await self._connect()
+            except Exception:
+                logger.exception('unable to reconnect desktop LISTEN connection')
+                continue
+            self.resync()
+
+    async def listen(self, database_url:str) -> None:
+        self.database_url = database_url
+        await self._connect()
+        self._supervisor = asyncio.ensure_future(self._supervise_listener())
+
+    async def close_sockets(self) -> None:
+        for ws in list(self.sockets):
+            await ws.close(code=WSCloseCode.GOING_AWAY, message=b'server shutdown')
+
+    async def close(self) -> None:
+        if self._supervisor is not None:
+            self._supervisor.cancel()
+            self._supervisor = None
+        if self._listen_conn is not None:
+            await self._listen_conn.close()
+            self._listen_conn = None
+
+    async def _send(self, ws:web.WebSocketResponse, subscription:Subscription) -> None:
+        while True:
+            message = await subscription.get()
+            # waits for the socket to drain, a slow client fills its queue
+            await ws.send_json(message)
+
+    def _on_send_done(self, ws:web.WebSocketResponse, subscription:Subscription,
+                      sender:asyncio.Future) -> None:
+        self.unsubscribe(subscription)
+        if sender.cancelled():
+            return
+        logger.warning('websocket send failed', username=subscription.username,
+                       error=repr(sender.exception()))
+        # nothing more will be pushed to this socket, let the client reconnect
+        if not ws.closed:
+            asyncio.ensure_future(ws.close(code=WSCloseCode.INTERNAL_ERROR,
+                                           message=b'send failed'))
+
+    def start_sender(self, ws:web.WebSocketResponse,
+                     subscription:Subscription) -> asyncio.Future:
+        sender = asyncio.ensure_future(self._send(ws, subscription))
+        sender.add_done_callback(functools.partial(self._on_send_done, ws, subscription))
+        return sender
+
+    async def websocket_handler(self, request):
+        username = request.query.get('username')
+        if not username:
+            raise web.HTTPBadRequest(text='username is required')
+        ws = web.WebSocketResponse(heartbeat=WEBSOCKET_HEARTBEAT)
+        await ws.prepare(request)
+        self.sockets.add(ws)
+        subscription = self.subscribe(username)
+        sender = self.start_sender(ws, subscription)
+        try:
+            async for msg in ws:
+                if msg.type == WSMsgType.ERROR:
+                    logger.debug('websocket error', username=username,
+                                 error=ws.exception())
+        finally:
+            sender.cancel()
+            self.unsubscribe(subscription)
+            self.sockets.discard(ws)
+        return ws
+
+    def stats(self) -> dict:
+        return {
+            'users':       len(self.subscriptions),
+            'connections': sum(len(s) for s in self.subscriptions.values())
+        }
@@ -10,17 +10,20 @@ import uvloop
 from aiohttp import web
 from jsonrpcserver import config
 from jsonrpcserver.async_methods import AsyncMethods
-
-import services.api_server.api_methods
+from jsonrpcserver.response import NotificationResponse
 
 from ..base_service import YoBaseService
+from ...db import create_asyncpg_pool
+from ...db.users import UserTransportsCache
 from .api_methods import api_get_notifications
+from .api_methods import api_get_unread_count
 from .api_methods import api_mark_read
 from .api_methods import api_mark_shown
 from .api_methods import api_mark_unread
 from .api_methods import api_mark_unshown
 from .api_methods import api_get_transports
 from .api_methods import api_set_transports
+from .push import DesktopPushHub
 
 config.log_responses = False
 config.log_requests = False
@@ -48,15 +51,25 @@ class YoAPIServer(YoBaseService):
         self.host = http_host
         self.port = http_port
 
+        self.db_pool = None
+        self.user_transports = None
+        self.push_hub = DesktopPushHub()
+
         self.web_app = web.Application(loop=self.loop)
+        self.web_app.on_startup.append(self.on_startup)
+        self.web_app.on_shutdown.append(self.on_shutdown)
+        self.web_app.on_cleanup.append(self.on_cleanup)
         self.api_methods = AsyncMethods()
         self.web_app.router.add_post('/', self.handle_api)
         self.web_app.router.add_get('/.well-known/healthcheck.json',
                                     self.healthcheck_handler)
         self.web_app.router.add_get('/health', self.healthcheck_handler)
+        self.web_app.router.add_get('/ws', self.push_hub.websocket_handler)
         self.api_methods.add(
             api_get_notifications,
             'yo.get_db_notifications')
+        self.api_methods.add(api_get_unread_count,
+                             'yo.get_unread_count')
         self.api_methods.add(api_mark_read,
                              'yo.mark_read')
         self.api_methods.add(api_mark_unread,
@@ -71,12 +84,36 @@ class YoAPIServer(YoBaseService):
                              'yo.set_transports')
         self.api_methods.add(self.api_healthcheck, 'health')
 
+    async def on_startup(self, app):
+        self.db_pool = await create_asyncpg_pool(self.database_url)
+        self.user_transports = UserTransportsCache(self.db_pool)
+        await self.user_transports.listen(self.database_url)
+        await self.push_hub.listen(self.database_url)
+
+    async def on_shutdown(self, app):
+        await self.push_hub.close_sockets()
+
+    async def on_cleanup(self, app):
+        await self.push_hub.close()
+        if self.user_transports is not None:
+            await self.user_transports.close()
+        if self.db_pool is not None:
+            await self.db_pool.close()
+
     async def healthcheck_handler(self, request):
         return web.json_response(await self.api_healthcheck())
 
     async def handle_api(self, request):
         request = await request.json()
         context = {'app': self}
+        if isinstance(request, list) and request:
+            # run the calls of a batch concurrently
+            responses = await asyncio.gather(
+                *[self.api_methods.dispatch(r, context=context) for r in request])
+            responses = [r for r in responses if not isinstance(r, NotificationResponse)]
+            if not responses:
+                return web.Response(status=204)
+            return json_response(responses)
         response = await self.api_methods.dispatch(request, context=context)
         return json_response(response)
 
@@ -5,17 +5,64 @@
 import click
 import yo.yolog
 
-@click.command(name='follower')
+@click.group(name='follower')
+def follower():
+    pass
+
+
+@follower.command(name='follow')
 @click.option('--database_url', envvar='DATABASE_URL')
 @click.option('--steemd_url', envvar='STEEMD_URL',
               default='https://api.steemit.com')
-@click.option('--start_block', envvar='START_BLOCK',default=None)
-def yo_blockchain_follower_service(database_url, steemd_url, start_block):
+@click.option('--start_block', envvar='START_BLOCK', type=int, default=None)
+@click.option('--blocks_per_batch', envvar='BLOCKS_PER_BATCH', type=int, default=1,
+              help='max number of blocks fetched, handled and stored together')
+@click.option('--fetch_concurrency', envvar='FETCH_CONCURRENCY', type=int, default=4,
+              help='max number of block batches fetched ahead')
+@click.option('--transform_concurrency', envvar='TRANSFORM_CONCURRENCY', type=int,
+              default=2, help='max number of block batches handled concurrently')
+@click.option('--write_concurrency', envvar='WRITE_CONCURRENCY', type=int, default=2,
+              help='max number of block batches stored concurrently')
+@click.option('--use_async_steemd/--no-use_async_steemd', envvar='USE_ASYNC_STEEMD',
+              default=False, help='fetch blocks with the batching async steemd client')
+def yo_blockchain_follower_service(database_url, steemd_url, start_block,
+                                   blocks_per_batch, fetch_concurrency,
+                                   transform_concurrency, write_concurrency,
+                                   use_async_steemd):
     from yo.services.blockchain_follower.service import main_task
     main_task(database_url=database_url,
               steemd_url=steemd_url,
-              start_block=start_block)
+              start_block=start_block,
+              blocks_per_batch=blocks_per_batch,
+              fetch_concurrency=fetch_concurrency,
+              transform_concurrency=transform_concurrency,
+              write_concurrency=write_concurrency,
+              use_async_steemd=use_async_steemd)
+
+
+@follower.command(name='backfill')
+@click.option('--database_url', envvar='DATABASE_URL')
+@click.option('--steemd_url', envvar='STEEMD_URL',
+              default='https://api.steemit.com')
+@click.option('--start_block', type=int, required=True)
+@click.option('--end_block', type=int, required=True)
+@click.option('--shards', type=int, default=8,
+              help='number of block ranges processed concurrently')
+@click.option('--blocks_per_batch', type=int, default=10,
+              help='max number of blocks fetched, handled and stored together')
+@click.option('--use_async_steemd/--no-use_async_steemd', envvar='USE_ASYNC_STEEMD',
+              default=False, help='fetch blocks with the batching async steemd client')
+def yo_blockchain_follower_backfill(database_url, steemd_url, start_block, end_block,
+                                    shards, blocks_per_batch, use_async_steemd):
+    from yo.services.blockchain_follower.service import backfill_task
+    backfill_task(database_url=database_url,
+                  steemd_url=steemd_url,
+                  start_block=start_block,
+                  end_block=end_block,
+                  shards=shards,
+                  blocks_per_batch=blocks_per_batch,
+                  use_async_steemd=use_async_steemd)
 
 
 if __name__ == "__main__":
-    yo_blockchain_follower_service()
+    follower()
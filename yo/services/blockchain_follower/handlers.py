@@ -1,15 +1,23 @@
 
+import asyncio
 import yo.json
 import re
 
 import steem
 import structlog
 
+from ...cache import AsyncTTLCache
 from ...schema import Priority
 from ...schema import NotificationType as Notification
 
 logger = structlog.get_logger(__name__)
 
+# '@author/permlink' -> True if the post is a comment, False if it is a root post
+PARENT_POSTS = AsyncTTLCache(maxsize=100000, ttl=3600, name='parent_posts')
+
+# when set, parent posts are fetched with this AsyncSteemd instead of the steem library
+_ASYNC_STEEMD = None
+
 
 # any valid @username with a trailing whitespace
 MENTION_PATTERN = re.compile(r'@([a-z][a-z0-9\-]{2,15})\s')
@@ -18,6 +26,31 @@ MENTION_PATTERN = re.compile(r'@([a-z][a-z0-9\-]{2,15})\s')
 def eid(op):
     return f'{op["block"]}/{op["trx_in_block"]}/{op["op_in_trx"]}/{op["virtual_op"]}'
 
+def post_id(author:str, permlink:str) -> str:
+    return '@' + author + '/' + permlink
+
+def remember_post(comment_data:dict) -> None:
+    """ Cache whether a post seen in a comment op is itself a comment
+    """
+    PARENT_POSTS.set(post_id(comment_data['author'], comment_data['permlink']),
+                     comment_data['parent_author'] != '')
+
+def _fetch_is_comment(parent_id:str) -> bool:
+    return steem.post.Post(parent_id).is_comment()
+
+async def fetch_is_comment(parent_id:str) -> bool:
+    if _ASYNC_STEEMD is not None:
+        author, permlink = parent_id[1:].split('/', 1)
+        content = await _ASYNC_STEEMD.get_content(author, permlink)
+        return content['depth'] > 0
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(None, _fetch_is_comment, parent_id)
+
+def set_async_steemd(steemd) -> None:
+    # pylint: disable=global-statement
+    global _ASYNC_STEEMD
+    _ASYNC_STEEMD = steemd
+
 def handle_vote(op):
     vote_info = op['op'][1]
     logger.info(
@@ -81,7 +114,7 @@ def handle_account_update(op):
          'to_username': op_data['account'],
          'json_data':   yo.json.dumps(op_data),
          'notify_type': Notification.account_update,
-         'priority':    Priority.low.value
+         'priority':    Priority.always.value
         }
     ]
 
@@ -104,7 +137,7 @@ def handle_send(op):
          'to_username': send_data['from'],
          'json_data':   yo.json.dumps(send_data),
          'notify_type': Notification.send,
-         'priority':    Priority.low.value
+         'priority':    Priority.high.value
         }
     ]
 
@@ -128,7 +161,7 @@ def handle_receive(op):
          'from_username': receive_data['from'],
          'json_data':     yo.json.dumps(receive_data),
          'notify_type':   Notification.receive,
-         'priority':      Priority.low.value
+         'priority':      Priority.high.value
         }
     ]
 
@@ -144,7 +177,7 @@ def handle_power_down(op):
          'to_username': op_data['account'],
          'json_data':   yo.json.dumps(op_data),
          'notify_type': Notification.power_down,
-         'priority':    Priority.low.value
+         'priority':    Priority.high.value
         }
     ]
 
@@ -170,15 +203,20 @@ def handle_mention(op):
     return notifications
 
 
-def handle_comment(op):
+async def handle_comment(op):
+    """ Notify the parent author of a reply
+
+    The post of the op is remembered by gather_block_notifications, before
+    the handlers of its window run.
+    """
     logger.debug('handle_comment', op=['op'][0])
     op_data = op['op'][1]
     if op_data['parent_author'] == '':
         # top level post
         return []
-    parent_id = '@' + op_data['parent_author'] + '/' + op_data['parent_permlink']
-    parent = steem.post.Post(parent_id)
-    note_type = Notification.comment_reply if parent.is_comment() else Notification.post_reply
+    parent_id = post_id(op_data['parent_author'], op_data['parent_permlink'])
+    is_comment = await PARENT_POSTS.get_or_fetch(parent_id, fetch_is_comment, parent_id)
+    note_type = Notification.comment_reply if is_comment else Notification.post_reply
     logger.debug(
         'handle_comment',
         note_type=note_type,
@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 import asyncio
+import inspect
 import time
 
 from concurrent.futures import ThreadPoolExecutor
@@ -15,7 +16,14 @@ import uvloop
 
 from funcy import flatten
 
-from ...db.notifications import create_notification
+from ...db.notifications import create_notifications
+from ...db.notifications import create_block_notifications
+from ...db.notifications import get_last_processed_block
+from ...db.notifications import notification_keys_task
+from ...db.partitions import RETENTION_POLICY
+from ...db.partitions import partition_maintenance_task
+from ...db.checkpoints import FOLLOWER_CHECKPOINT
+from ...steemd_client import AsyncSteemd
 from ...db import create_asyncpg_pool
 
 from .handlers import handle_vote
@@ -27,11 +35,17 @@ from .handlers import handle_resteem
 from .handlers import handle_power_down
 from .handlers import handle_mention
 from .handlers import handle_comment
+from .handlers import remember_post
+from .handlers import PARENT_POSTS
+from .handlers import set_async_steemd
 
 logger = structlog.getLogger(__name__,service_name='blockchain_follower')
 asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
 logger = logger.bind()
 EXECUTOR = ThreadPoolExecutor()
+BLOCK_INTERVAL = 3
+# a window is written this many times, with doubling delays, before the follower gives up
+WRITE_ATTEMPTS = 6
 
 '''
 {
@@ -74,25 +88,41 @@ async def execute_sync(func, *args, **kwargs):
     except CancelledError:
         logger.debug('ignoring CancelledError')
 
-def get_start_block(start_block:int = None, blockchain: Blockchain=None):
-    start_block = None
-    try:
-        if isinstance(start_block, int) and start_block < 0:
-            start_block = blockchain.get_current_block_num() - start_block
-    except Exception:
-        logger.exception('service error')
-        start_block = None
+def get_start_block(start_block:int = None, head_block:int = None):
+    if isinstance(start_block, int) and start_block < 0:
+        start_block = head_block + start_block
     logger.debug('get_start_block', start_block=start_block)
     return start_block
 
-async def store_notifications(notifications, pool) -> bool:
+async def resolve_start_block(pool, source=None, start_block:int=None,
+                              checkpoint_name:str=FOLLOWER_CHECKPOINT):
+    """ An explicit start_block wins, otherwise resume after the last checkpoint
+    """
+    if start_block is not None and start_block < 0:
+        return get_start_block(start_block, await source.get_current_block_num())
+    if start_block is not None:
+        return start_block
+    last_block = await get_last_processed_block(pool, checkpoint_name)
+    logger.debug('resolve_start_block', checkpoint_name=checkpoint_name,
+                 last_block=last_block)
+    if last_block is not None:
+        return last_block + 1
+    return None
+
+async def store_notifications(notifications, pool, block_num:int=None,
+                              checkpoint_name:str=FOLLOWER_CHECKPOINT,
+                              queue:bool=True) -> bool:
     logger.debug('store_notifications', notifications=list(notifications))
-    futures = [create_notification(pool, **notification) for notification in notifications]
-    result = await asyncio.gather(*futures)
+    if block_num is None:
+        result = await create_notifications(pool, notifications, queue)
+    else:
+        result = await create_block_notifications(pool, notifications, block_num,
+                                                  checkpoint_name=checkpoint_name,
+                                                  queue=queue)
     logger.debug('store_notifications', result=result)
-    return True
+    return result is not None
 
-def gather_notifications(blockchain_op:dict = None) -> list:
+async def gather_notifications(blockchain_op:dict = None) -> list:
     """ Handle notification for a particular op
     """
     op_type = blockchain_op['op'][0]
@@ -100,7 +130,57 @@ def gather_notifications(blockchain_op:dict = None) -> list:
         logger.debug('skipping operation', op_type=op_type)
         return []
 
-    return [handler(blockchain_op) for handler in op_map[op_type]]
+    results = []
+    for handler in op_map[op_type]:
+        result = handler(blockchain_op)
+        if inspect.isawaitable(result):
+            result = await result
+        results.append(result)
+    return results
+
+async def gather_block_notifications(ops:list = None) -> list:
+    """ Handle notifications for all ops of a block window
+    """
+    # learn about every post in the window before resolving any reply parents
+    for op in ops:
+        if op['op'][0] == 'comment':
+            remember_post(op['op'][1])
+    results = await asyncio.gather(*[gather_notifications(op) for op in ops])
+    return list(flatten(results))
+
+def get_blocks_ops(blockchain:Blockchain=None, block_nums:list=None) -> list:
+    """ Fetch the ops of several blocks, blocking
+    """
+    ops = []
+    for block_num in block_nums:
+        ops.extend(blockchain.steem.get_ops_in_block(block_num, False))
+    return ops
+
+class ThreadedBlockSource:
+    """ Runs the synchronous steem library on the thread pool
+
+    Block sources provide the `get_current_block_num` and `get_blocks_ops`
+    coroutines, AsyncSteemd is the native async source.
+    """
+    def __init__(self, blockchain:Blockchain):
+        self.blockchain = blockchain
+
+    async def get_current_block_num(self) -> int:
+        return await execute_sync(self.blockchain.get_current_block_num)
+
+    async def get_blocks_ops(self, block_nums:list) -> list:
+        return await execute_sync(get_blocks_ops, self.blockchain, block_nums)
+
+    async def close(self) -> None:
+        pass
+
+def create_block_source(steemd_url:str=None, use_async_steemd:bool=False, loop=None):
+    if use_async_steemd:
+        steemd = AsyncSteemd(url=steemd_url, loop=loop)
+        set_async_steemd(steemd)
+        return steemd
+    steemd = steem.steemd.Steemd(nodes=[steemd_url])
+    return ThreadedBlockSource(Blockchain(steemd_instance=steemd))
 
 async def ops_iter(blockchain:Blockchain=None, start_block:int=None):
     ops_func = blockchain.stream_from(
@@ -113,36 +193,242 @@ async def ops_iter(blockchain:Blockchain=None, start_block:int=None):
         yield ops
         loop_elapsed = time.perf_counter() - loop_start
 
+async def block_windows_iter(source=None, start_block:int=None,
+                             blocks_per_batch:int=1):
+    """ Yield lists of up to `blocks_per_batch` consecutive block numbers
+
+    Windows never extend past the current block, so at the head of the
+    chain this yields one block at a time.
+    """
+    block_num = start_block or await source.get_current_block_num()
+    head_block = 0
+    while True:
+        if block_num > head_block:
+            head_block = await source.get_current_block_num()
+            if block_num > head_block:
+                await asyncio.sleep(BLOCK_INTERVAL)
+                continue
+        last_block = min(block_num + blocks_per_batch - 1, head_block)
+        yield list(range(block_num, last_block + 1))
+        block_num = last_block + 1
+
+async def fetch_stage(source, start_block:int, blocks_per_batch:int,
+                      out_q:asyncio.Queue):
+    """ Start fetching block windows in order, at most out_q.maxsize ahead
+    """
+    async for block_nums in block_windows_iter(source, start_block, blocks_per_batch):
+        fetch = asyncio.ensure_future(source.get_blocks_ops(block_nums))
+        await out_q.put((block_nums, fetch))
+
+async def transform_stage(in_q:asyncio.Queue, out_q:asyncio.Queue, concurrency:int=1):
+    """ Run the handlers over up to `concurrency` fetched windows at once
+
+    At most out_q.maxsize handled windows wait for the write stage.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    while True:
+        block_nums, fetch = await in_q.get()
+        ops = await fetch
+        await semaphore.acquire()
+        transform = asyncio.ensure_future(gather_block_notifications(ops))
+        transform.add_done_callback(lambda _: semaphore.release())
+        await out_q.put((block_nums, len(ops), transform))
+
+async def _write_window(pool, block_nums:list, op_count:int, transform, previous_write,
+                        checkpoint_name:str):
+    notifications = await transform
+    loop_start = time.perf_counter()
+    # never skip a batch, the checkpoint only advances once it is stored
+    attempt = 1
+    while await create_block_notifications(pool, notifications, block_nums[-1],
+                                           checkpoint_name=checkpoint_name,
+                                           before_checkpoint=previous_write) is None:
+        if attempt >= WRITE_ATTEMPTS:
+            raise RuntimeError(f'unable to store notifications for blocks {block_nums}')
+        delay = BLOCK_INTERVAL * 2 ** (attempt - 1)
+        logger.error('write failed, retrying', block_nums=block_nums,
+                     attempt=attempt, delay=delay)
+        await asyncio.sleep(delay)
+        attempt += 1
+    logger.debug('window stored',
+                 block_nums=block_nums,
+                 op_count=op_count,
+                 notification_count=len(notifications),
+                 elapsed=time.perf_counter() - loop_start,
+                 parent_posts=PARENT_POSTS.stats())
+
+async def write_stage(pool, in_q:asyncio.Queue, concurrency:int=1,
+                      checkpoint_name:str=FOLLOWER_CHECKPOINT):
+    """ Store windows with up to `concurrency` concurrent writers
 
-async def _main_task(database_url=None, loop=None, steemd_url=None, start_block=None):
+    Each write waits for the write of the preceding window before it stores
+    its checkpoint, so checkpoints always commit in block order.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    failed_writes = []
+
+    def write_done(write):
+        semaphore.release()
+        if not write.cancelled() and write.exception() is not None:
+            failed_writes.append(write)
+
+    previous_write = None
+    while True:
+        block_nums, op_count, transform = await in_q.get()
+        await semaphore.acquire()
+        if failed_writes:
+            # later windows can never commit their checkpoints
+            raise failed_writes[0].exception()
+        write = asyncio.ensure_future(_write_window(pool, block_nums, op_count, transform,
+                                                    previous_write, checkpoint_name))
+        write.add_done_callback(write_done)
+        previous_write = write
+
+async def run_pipeline(pool, source=None, start_block:int=None,
+                       blocks_per_batch:int=1, fetch_concurrency:int=1,
+                       transform_concurrency:int=1, write_concurrency:int=1):
+    """ Overlap block fetches, handler execution and database writes
+
+    The stages are connected by bounded queues, so a slow stage applies
+    backpressure to the stages before it.
+    """
+    fetched_q = asyncio.Queue(maxsize=fetch_concurrency)
+    transformed_q = asyncio.Queue(maxsize=transform_concurrency)
+    stages = [
+        asyncio.ensure_future(fetch_stage(source, start_block, blocks_per_batch,
+                                          fetched_q)),
+        asyncio.ensure_future(transform_stage(fetched_q, transformed_q,
+                                              transform_concurrency)),
+        asyncio.ensure_future(write_stage(pool, transformed_q, write_concurrency))
+    ]
+    try:
+        await asyncio.gather(*stages)
+    finally:
+        for stage in stages:
+            stage.cancel()
+
+
+async def _main_task(database_url=None, loop=None, steemd_url=None, start_block=None,
+                     blocks_per_batch=1, fetch_concurrency=1, transform_concurrency=1,
+                     write_concurrency=1, use_async_steemd=False):
     logger.debug('main task starting')
     loop = loop or asyncio.get_event_loop()
-    steemd = steem.steemd.Steemd(nodes=[steemd_url])
-    blockchain = Blockchain(steemd_instance=steemd)
+    source = create_block_source(steemd_url, use_async_steemd, loop=loop)
     pool = await create_asyncpg_pool(database_url=database_url, loop=loop)
+    # the follower only premakes partitions, the sender's retention policy drops them
+    create_only = {table_name: None for table_name in RETENTION_POLICY}
+    background = [asyncio.ensure_future(notification_keys_task(pool)),
+                  asyncio.ensure_future(partition_maintenance_task(pool, create_only))]
+    try:
+        start_block = await resolve_start_block(pool, source, start_block)
+        logger.info('main task start block', start_block=start_block)
+        await run_pipeline(pool, source,
+                           start_block=start_block,
+                           blocks_per_batch=blocks_per_batch,
+                           fetch_concurrency=fetch_concurrency,
+                           transform_concurrency=transform_concurrency,
+                           write_concurrency=write_concurrency)
+    finally:
+        for task in background:
+            task.cancel()
+        await source.close()
 
-    last_block_num_handled = None
+def split_block_range(start_block:int, end_block:int, shards:int) -> list:
+    """ Split the inclusive range start_block..end_block into contiguous shards
+    """
+    block_count = end_block - start_block + 1
+    shards = max(1, min(shards, block_count))
+    shard_size, remainder = divmod(block_count, shards)
+    ranges = []
+    shard_start = start_block
+    for i in range(shards):
+        shard_end = shard_start + shard_size - 1 + (1 if i < remainder else 0)
+        ranges.append((shard_start, shard_end))
+        shard_start = shard_end + 1
+    return ranges
 
-    loop_elapsed= 0
-    async for op in ops_iter(blockchain, start_block):
-        loop_start = time.perf_counter()
-        logger.debug('main task', loop_elapsed=loop_elapsed,  op=op)
-        block_num = op['block']
-        unstored_notifications = list(flatten(gather_notifications(op)))
-        logger.debug(
-            'main_task',
-            block_num=block_num,
-            unstored_count=len(unstored_notifications)
-        )
-        resp = await store_notifications(unstored_notifications, pool)
-        if resp:
-            last_block_num_handled = block_num
-        loop_elapsed = time.perf_counter() - loop_start
+async def process_block_range(pool, source=None, start_block:int=None,
+                              end_block:int=None, blocks_per_batch:int=1):
+    """ Handle and store the notifications for every block in start_block..end_block
+
+    The events are in the past, so their notifications are stored without
+    being queued for delivery.
+    """
+    checkpoint_name = f'backfill/{start_block}-{end_block}'
+    log = logger.bind(start_block=start_block, end_block=end_block)
+    resume_block = await resolve_start_block(pool, checkpoint_name=checkpoint_name)
+    log.info('processing block range', resume_block=resume_block)
+    for window_start in range(resume_block or start_block, end_block + 1, blocks_per_batch):
+        block_nums = list(range(window_start,
+                                min(window_start + blocks_per_batch, end_block + 1)))
+        ops = await source.get_blocks_ops(block_nums)
+        notifications = await gather_block_notifications(ops)
+        if not await store_notifications(notifications, pool,
+                                         block_num=block_nums[-1],
+                                         checkpoint_name=checkpoint_name,
+                                         queue=False):
+            raise RuntimeError(f'unable to store notifications for blocks {block_nums}')
+        log.debug('processed blocks', block_nums=block_nums,
+                  notification_count=len(notifications))
+    log.info('processed block range')
+
+async def _backfill_task(database_url=None, loop=None, steemd_url=None, start_block=None,
+                         end_block=None, shards=1, blocks_per_batch=1,
+                         use_async_steemd=False):
+    logger.debug('backfill task starting')
+    loop = loop or asyncio.get_event_loop()
+    ranges = split_block_range(start_block, end_block, shards)
+    pool = await create_asyncpg_pool(database_url=database_url, loop=loop,
+                                     max_size=max(len(ranges), 10))
+    # the async client pools its connections, threaded clients are per shard
+    shared_source = None
+    sources = []
+    try:
+        if use_async_steemd:
+            shared_source = create_block_source(steemd_url, use_async_steemd, loop=loop)
+        futures = []
+        for shard_start, shard_end in ranges:
+            source = shared_source or create_block_source(steemd_url, loop=loop)
+            sources.append(source)
+            futures.append(process_block_range(pool, source,
+                                               start_block=shard_start,
+                                               end_block=shard_end,
+                                               blocks_per_batch=blocks_per_batch))
+        results = await asyncio.gather(*futures, return_exceptions=True)
+    finally:
+        for source in set(sources):
+            await source.close()
+        await pool.close()
+    for (shard_start, shard_end), result in zip(ranges, results):
+        if isinstance(result, Exception):
+            logger.error('backfill shard failed', start_block=shard_start,
+                         end_block=shard_end, error=str(result))
+    logger.info('backfill task complete', start_block=start_block, end_block=end_block)
 
-def main_task(database_url=None, steemd_url=None, start_block=None):
+def main_task(database_url=None, steemd_url=None, start_block=None, blocks_per_batch=1,
+              fetch_concurrency=1, transform_concurrency=1, write_concurrency=1,
+              use_async_steemd=False):
     loop = asyncio.get_event_loop()
     loop.run_until_complete(_main_task(
         database_url=database_url,
         loop=loop,
         steemd_url=steemd_url,
-        start_block=start_block))
+        start_block=start_block,
+        blocks_per_batch=blocks_per_batch,
+        fetch_concurrency=fetch_concurrency,
+        transform_concurrency=transform_concurrency,
+        write_concurrency=write_concurrency,
+        use_async_steemd=use_async_steemd))
+
+def backfill_task(database_url=None, steemd_url=None, start_block=None, end_block=None,
+                  shards=1, blocks_per_batch=1, use_async_steemd=False):
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(_backfill_task(
+        database_url=database_url,
+        loop=loop,
+        steemd_url=steemd_url,
+        start_block=start_block,
+        end_block=end_block,
+        shards=shards,
+        blocks_per_batch=blocks_per_batch,
+        use_async_steemd=use_async_steemd))
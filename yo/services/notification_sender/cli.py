@@ -4,9 +4,66 @@ import yo.yolog
 
 @click.command(name='sender')
 @click.option('--database_url', envvar='DATABASE_URL')
-def yo_noitification_sender_service(database_url):
-    from yo.services.notification_sender import main_task
-    main_task(database_url=database_url)
+@click.option('--desktop_workers', envvar='DESKTOP_WORKERS', type=int, default=20,
+              help='number of concurrent desktop queue workers')
+@click.option('--email_workers', envvar='EMAIL_WORKERS', type=int, default=10,
+              help='number of concurrent email queue workers')
+@click.option('--sms_workers', envvar='SMS_WORKERS', type=int, default=5,
+              help='number of concurrent sms queue workers')
+@click.option('--batch_size', envvar='BATCH_SIZE', type=int, default=10,
+              help='max number of queue items leased by a worker at once')
+@click.option('--desktop_batch_size', envvar='DESKTOP_BATCH_SIZE', type=int, default=500,
+              help='max number of desktop queue items delivered by one statement')
+@click.option('--drain_timeout', envvar='DRAIN_TIMEOUT', type=float, default=30,
+              help='seconds to finish in-flight items after SIGTERM')
+@click.option('--metrics_interval', envvar='METRICS_INTERVAL', type=float, default=60,
+              help='seconds between per-transport metrics reports')
+@click.option('--processes', envvar='SENDER_PROCESSES', type=int, default=1,
+              help='number of sender processes, more than 1 runs a supervisor')
+@click.option('--rpc_pool_size', envvar='RPC_POOL_SIZE', type=int, default=100,
+              help='max number of open connections to conveyor per sender process')
+@click.option('--notifications_retention_months', envvar='NOTIFICATIONS_RETENTION_MONTHS',
+              type=int, default=6, help='months of notifications partitions to keep')
+@click.option('--actions_retention_months', envvar='ACTIONS_RETENTION_MONTHS',
+              type=int, default=3, help='months of actions partitions to keep')
+@click.option('--desktop_retention_months', envvar='DESKTOP_RETENTION_MONTHS',
+              type=int, default=12, help='months of desktop notification partitions to keep')
+@click.option('--sendgrid_priv_key', envvar='SENDGRID_PRIV_KEY')
+@click.option('--sendgrid_templates_dir', envvar='SENDGRID_TEMPLATES_DIR')
+@click.option('--twilio_account_sid', envvar='TWILIO_ACCOUNT_SID')
+@click.option('--twilio_auth_token', envvar='TWILIO_AUTH_TOKEN')
+@click.option('--twilio_from_number', envvar='TWILIO_FROM_NUMBER')
+def yo_noitification_sender_service(database_url, desktop_workers, email_workers,
+                                    sms_workers, batch_size, desktop_batch_size, drain_timeout,
+                                    metrics_interval, processes, rpc_pool_size,
+                                    notifications_retention_months,
+                                    actions_retention_months, desktop_retention_months,
+                                    **transport_kwargs):
+    from yo.schema import TransportType
+    workers = {
+        TransportType.desktop: desktop_workers,
+        TransportType.email:   email_workers,
+        TransportType.sms:     sms_workers
+    }
+    sender_kwargs = dict(database_url=database_url,
+                         workers=workers,
+                         batch_size=batch_size,
+                         desktop_batch_size=desktop_batch_size,
+                         drain_timeout=drain_timeout,
+                         metrics_interval=metrics_interval,
+                         rpc_pool_size=rpc_pool_size,
+                         retention_policy={
+                             'notifications': notifications_retention_months,
+                             'actions':       actions_retention_months,
+                             'desktop':       desktop_retention_months
+                         },
+                         **transport_kwargs)
+    if processes > 1:
+        from yo.services.notification_sender.supervisor import supervise
+        supervise(processes, **sender_kwargs)
+    else:
+        from yo.services.notification_sender.service import main_task
+        main_task(**sender_kwargs)
 
 if __name__ == '__main__':
     yo_noitification_sender_service()
@@ -1,3 +1,138 @@
 # -*- coding: utf-8 -*-
+import asyncio
+import time
+from bisect import bisect_right
+
+import structlog
+
+from yo.db.actions import get_recent_sends
+from yo.db.actions import get_user_recent_sends
+from yo.db.actions import RateLimitException
+from yo.schema import TransportType
+
+logger = structlog.getLogger(__name__, source='RateLimiter')
 
 RATELIMITS = {'email': {'hour': 1, 'day': 10}, 'sms': {'hour': 10, 'day': 20}}
+
+WINDOWS = {'hour': 3600, 'day': 86400}
+
+# local sends this recent are kept when reconciling, their actions may not
+# be committed yet
+RECONCILE_GRACE_SECONDS = 30
+
+
+class RateLimiter:
+    """Sliding hour and day windows of sends per user and transport
+
+    Windows live in memory so checking a limit needs no query. They are
+    seeded from, and periodically reconciled with, the sent actions in the
+    database, which picks up sends made by other processes.
+
+    Between reconciles a process only sees its own sends, so N processes
+    sending to the same user could each use the whole limit. Limiters
+    shared by several processes must be given a pool; acquire then
+    refreshes the user's windows from the sent actions before checking.
+    Two processes can still both pass a check made before either send is
+    stored as an action.
+    """
+    def __init__(self, limits:dict=None, pool=None):
+        self.limits = {TransportType[name]: limit
+                       for name, limit in (limits or RATELIMITS).items()}
+        self.pool = pool
+        # (username, transport) -> sorted send times
+        self._sends = dict()
+        self.reconciled = None
+
+    def _window(self, key, now:float) -> list:
+        sends = self._sends.get(key)
+        if sends is None:
+            return []
+        # drop sends older than the longest window
+        del sends[:bisect_right(sends, now - WINDOWS['day'])]
+        if not sends:
+            del self._sends[key]
+        return sends
+
+    def counts(self, username:str, transport_type:TransportType, now:float=None) -> dict:
+        now = now or time.time()
+        sends = self._window((username, transport_type), now)
+        return {name: len(sends) - bisect_right(sends, now - seconds)
+                for name, seconds in WINDOWS.items()}
+
+    def check(self, username:str, transport_type:TransportType, now:float=None) -> None:
+        limit = self.limits.get(transport_type)
+        if limit is None:
+            return
+        now = now or time.time()
+        sends = self._window((username, transport_type), now)
+        retry_after = None
+        for name, seconds in WINDOWS.items():
+            if name not in limit:
+                continue
+            count = len(sends) - bisect_right(sends, now - seconds)
+            if count >= limit[name]:
+                # the window has room once its oldest count - limit + 1 sends age out
+                oldest = sends[len(sends) - limit[name]] if limit[name] else now
+                retry_after = max(retry_after or 0, oldest + seconds - now)
+                logger.debug('rate limited', username=username,
+                             transport=transport_type.name, window=name, count=count)
+        if retry_after is not None:
+            raise RateLimitException(retry_after=retry_after)
+
+    async def acquire(self, username:str, transport_type:TransportType) -> float:
+        """Check the limits and reserve a send, raising RateLimitException if over a limit
+        """
+        if self.pool is not None and transport_type in self.limits:
+            await self.refresh(username, transport_type)
+        now = time.time()
+        self.check(username, transport_type, now=now)
+        if transport_type in self.limits:
+            self._sends.setdefault((username, transport_type), []).append(now)
+        return now
+
+    def cancel(self, username:str, transport_type:TransportType, sent_at:float) -> None:
+        """Give back a reservation for a send which did not happen
+        """
+        sends = self._sends.get((username, transport_type))
+        if sends and sent_at in sends:
+            sends.remove(sent_at)
+
+    def _unstored(self, key, now:float) -> list:
+        # local sends whose actions may not be committed yet
+        return [t for t in self._sends.get(key, []) if t > now - RECONCILE_GRACE_SECONDS]
+
+    async def refresh(self, username:str, transport_type:TransportType) -> None:
+        """Replace one user's windows with the sends stored in actions
+        """
+        start = time.time()
+        key = (username, transport_type)
+        ages = await get_user_recent_sends(self.pool, username, transport_type)
+        sends = sorted([start - age for age in ages] + self._unstored(key, start))
+        if sends:
+            self._sends[key] = sends
+        else:
+            self._sends.pop(key, None)
+
+    async def reconcile(self, pool) -> None:
+        start = time.time()
+        rows = await get_recent_sends(pool, list(self.limits))
+        sends = dict()
+        for row in rows:
+            key = (row['username'], TransportType(row['transport']))
+            sends[key] = sorted(start - age for age in row['ages'])
+        for key in self._sends:
+            recent = self._unstored(key, start)
+            if recent:
+                sends[key] = sorted(sends.get(key, []) + recent)
+        self._sends = sends
+        self.reconciled = start
+        logger.debug('rate limits reconciled', keys=len(sends),
+                     duration=time.time() - start)
+
+    async def reconcile_task(self, pool, interval:float=60) -> None:
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.reconcile(pool)
+            except Exception:
+                logger.exception('rate limit reconcile failed')
@@ -1,28 +1,249 @@
 # -*- coding: utf-8 -*-
 import asyncio
-
+import functools
+import signal
+import time
+from time import perf_counter
 
 import uvloop
 import structlog
 
-
 from ...db import create_asyncpg_pool
+from ...db.actions import PermanentFailException
+from ...db.desktop import deliver_batch
+from ...db.desktop import reconcile_counts_task
+from ...db.partitions import partition_maintenance_task
+from ...db.actions import RateLimitException
+from ...db.actions import SendError
+from ...db.queue import DEFAULT_LEASE_SECONDS
+from ...db.queue import priority_aging_task
+from ...db.queue.watcher import QueueDispatcher
+from ...db.users import prefetch_user_data
+from ...rpc_client import close_session
+from ...rpc_client import configure_session
+from ...rpc_client import SESSION_POOL_SIZE
+from ...schema import TransportType
+from .ratelimits import RateLimiter
+from .transports.desktop import handle_desktop_transport
+from .transports.email import handle_email_transport
+from .transports.email import SendGridTransport
+from .transports.sms import handle_sms
+from .transports.sms import TwilioTransport
 
 logger = structlog.getLogger(__name__, service_name='notification_sender')
 
 asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
 
-async def _main_task(database_url:str=None, loop=None):
+DEFAULT_WORKERS = {
+    TransportType.desktop: 20,
+    TransportType.email:   10,
+    TransportType.sms:     5
+}
+
+HANDLERS = {
+    TransportType.desktop: handle_desktop_transport,
+    TransportType.email:   handle_email_transport,
+    TransportType.sms:     handle_sms
+}
+
+
+class TransportMetrics:
+    """Delivery counts and latencies for one transport since the last report
+    """
+    def __init__(self, transport_type:TransportType):
+        self.transport_type = transport_type
+        self.reset()
+
+    def reset(self) -> None:
+        self.started = perf_counter()
+        self.sent = 0
+        self.failed = 0
+        self.rate_limited = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+
+    def record(self, status:str, latency:float, count:int=1) -> None:
+        setattr(self, status, getattr(self, status) + count)
+        self.latency_total += latency * count
+        self.latency_max = max(self.latency_max, latency)
+
+    def report(self) -> dict:
+        elapsed = perf_counter() - self.started
+        attempts = self.sent + self.failed + self.rate_limited
+        report = {
+            'transport':          self.transport_type.name,
+            'sent':               self.sent,
+            'failed':             self.failed,
+            'rate_limited':       self.rate_limited,
+            'sent_per_minute':    round(self.sent * 60 / elapsed, 1) if elapsed else 0,
+            'latency_avg_ms':     round(self.latency_total * 1000 / attempts, 2) if attempts else 0,
+            'latency_max_ms':     round(self.latency_max * 1000, 2)
+        }
+        self.reset()
+        return report
+
+
+async def deliver(qitem, local_logger, handler=None, pool=None,
+                  metrics:TransportMetrics=None, **handler_kwargs):
+    """Deliver one leased qitem with handler
+
+    Exceptions are re-raised so the QItem settling the qitem acks, releases
+    or retries it and records the outcome in actions.
+    """
+    start = perf_counter()
+    item = qitem['data']
+    local_logger = local_logger.bind(qid=qitem['qid'], nid=item['nid'])
+    try:
+        await handler(pool, item, local_logger, **handler_kwargs)
+    except RateLimitException:
+        metrics.record('rate_limited', perf_counter() - start)
+        raise
+    except (Exception, PermanentFailException, SendError):
+        metrics.record('failed', perf_counter() - start)
+        raise
+    metrics.record('sent', perf_counter() - start)
+
+
+async def deliver_desktop(conn, batch_size:int, metrics:TransportMetrics=None) -> int:
+    """Deliver a batch of desktop items with one statement
+    """
+    start = perf_counter()
+    delivered = await deliver_batch(conn, batch_size)
+    if delivered:
+        metrics.record('sent', perf_counter() - start, count=len(delivered))
+    return len(delivered)
+
+
+async def prefetch_recipients(qitems:list) -> None:
+    """Look up the conveyor data of a batch's recipients with one request
+    """
+    await prefetch_user_data(qitem['data']['to_username'] for qitem in qitems)
+
+
+async def report_metrics(metrics:dict, interval:float) -> None:
+    while True:
+        await asyncio.sleep(interval)
+        for transport_metrics in metrics.values():
+            logger.info('transport metrics', **transport_metrics.report())
+
+
+async def beat(heartbeat, interval:float) -> None:
+    """Tell a supervising process this event loop is still running
+    """
+    while True:
+        heartbeat.value = time.time()
+        await asyncio.sleep(interval)
+
+
+async def _main_task(database_url:str=None,
+                     loop=None,
+                     workers:dict=None,
+                     batch_size:int=10,
+                     desktop_batch_size:int=500,
+                     lease_seconds:float=DEFAULT_LEASE_SECONDS,
+                     drain_timeout:float=30,
+                     metrics_interval:float=60,
+                     rpc_pool_size:int=SESSION_POOL_SIZE,
+                     sendgrid_priv_key:str=None,
+                     sendgrid_templates_dir:str=None,
+                     twilio_account_sid:str=None,
+                     twilio_auth_token:str=None,
+                     twilio_from_number:str=None,
+                     rate_limit_reconcile_interval:float=60,
+                     retention_policy:dict=None,
+                     heartbeat=None,
+                     heartbeat_interval:float=5,
+                     run_maintenance:bool=True,
+                     shared_rate_limits:bool=False):
     logger.debug('main task starting')
     loop = loop or asyncio.get_event_loop()
+    workers = workers or DEFAULT_WORKERS
+    configure_session(pool_size=rpc_pool_size, loop=loop)
     pool = await create_asyncpg_pool(database_url=database_url, loop=loop)
-    # FIXME
+    # other sender processes' sends are only seen through the actions table
+    rate_limiter = RateLimiter(pool=pool if shared_rate_limits else None)
+    await rate_limiter.reconcile(pool)
+
+    handler_kwargs = {
+        TransportType.desktop: dict(),
+        TransportType.email: dict(transport=SendGridTransport(
+            sendgrid_privkey=sendgrid_priv_key,
+            sendgrid_templates_dir=sendgrid_templates_dir),
+            rate_limiter=rate_limiter),
+        TransportType.sms: dict(transport=TwilioTransport(
+            account_sid=twilio_account_sid,
+            auth_token=twilio_auth_token,
+            from_number=twilio_from_number),
+            rate_limiter=rate_limiter)
+    }
+    metrics = {t: TransportMetrics(t) for t in workers}
+    dispatchers = []
+    for transport_type, num_workers in workers.items():
+        if not num_workers:
+            continue
+        if transport_type == TransportType.desktop:
+            dispatchers.append(QueueDispatcher(database_url,
+                                               worker_func=None,
+                                               worker_func_kwargs=dict(metrics=metrics[transport_type]),
+                                               batch_func=deliver_desktop,
+                                               transport_type=transport_type,
+                                               num_workers=num_workers,
+                                               batch_size=desktop_batch_size,
+                                               loop=loop))
+            continue
+        worker_func_kwargs = dict(handler=HANDLERS[transport_type],
+                                  pool=pool,
+                                  metrics=metrics[transport_type],
+                                  **handler_kwargs[transport_type])
+        dispatchers.append(QueueDispatcher(database_url,
+                                           worker_func=deliver,
+                                           worker_func_kwargs=worker_func_kwargs,
+                                           before_batch=prefetch_recipients,
+                                           transport_type=transport_type,
+                                           num_workers=num_workers,
+                                           batch_size=batch_size,
+                                           lease_seconds=lease_seconds,
+                                           loop=loop))
+
+    background = [asyncio.ensure_future(report_metrics(metrics, metrics_interval)),
+                  asyncio.ensure_future(rate_limiter.reconcile_task(
+                      pool, rate_limit_reconcile_interval))]
+    if run_maintenance:
+        background.append(asyncio.ensure_future(priority_aging_task(pool)))
+        background.append(asyncio.ensure_future(reconcile_counts_task(pool)))
+        background.append(asyncio.ensure_future(
+            partition_maintenance_task(pool, retention_policy)))
+    if heartbeat is not None:
+        background.append(asyncio.ensure_future(beat(heartbeat, heartbeat_interval)))
+    runs = asyncio.gather(*[d.run() for d in dispatchers], loop=loop)
 
+    def drain(signame):
+        logger.info('draining', signal=signame, drain_timeout=drain_timeout)
+        for dispatcher in dispatchers:
+            dispatcher.stop()
+        # unfinished items are released when their lease expires
+        loop.call_later(drain_timeout, runs.cancel)
 
+    for signame in ('SIGINT', 'SIGTERM'):
+        loop.add_signal_handler(getattr(signal, signame),
+                                functools.partial(drain, signame))
+    try:
+        await runs
+    except asyncio.CancelledError:
+        logger.warning('drain timed out')
+    finally:
+        for task in background:
+            task.cancel()
+        for transport_metrics in metrics.values():
+            logger.info('transport metrics', **transport_metrics.report())
+        await close_session()
+        await pool.close()
+    logger.info('main task stopped')
 
 
-def main_task(database_url:str=None):
+def main_task(database_url:str=None, **kwargs):
     loop = asyncio.get_event_loop()
     loop.run_until_complete(_main_task(
         database_url=database_url,
-        loop=loop))
+        loop=loop,
+        **kwargs))
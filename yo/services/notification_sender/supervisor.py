@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+"""Runs the notification sender in several processes to use more than one core"""
+import asyncio
+import multiprocessing
+import os
+import signal
+import threading
+import time
+
+import structlog
+import uvloop
+
+logger = structlog.getLogger(__name__, service_name='notification_sender_supervisor')
+
+HEARTBEAT_INTERVAL = 5
+HEARTBEAT_TIMEOUT = 60
+MAX_RESTART_DELAY = 60
+
+
+def _run_sender(index:int, heartbeat, sender_kwargs:dict) -> None:
+    # forked children must not share the parent's loop or connections
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    asyncio.set_event_loop(asyncio.new_event_loop())
+    # drop the supervisor's handlers, the sender installs its own
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    from yo.services.notification_sender.service import main_task
+    main_task(heartbeat=heartbeat,
+              heartbeat_interval=HEARTBEAT_INTERVAL,
+              # only one process needs to run queue maintenance
+              run_maintenance=index == 0,
+              shared_rate_limits=True,
+              **sender_kwargs)
+
+
+class SenderProcess:
+    def __init__(self, index:int, sender_kwargs:dict, ctx):
+        self.index = index
+        self.sender_kwargs = sender_kwargs
+        self.ctx = ctx
+        self.heartbeat = ctx.Value('d', 0.0)
+        self.process = None
+        self.restarts = 0
+        self.started = None
+
+    def start(self) -> None:
+        self.heartbeat.value = time.time()
+        self.process = self.ctx.Process(target=_run_sender,
+                                        name=f'yo-sender-{self.index}',
+                                        args=(self.index, self.heartbeat, self.sender_kwargs))
+        self.process.start()
+        self.started = time.time()
+        logger.info('sender process started', index=self.index, pid=self.process.pid,
+                    restarts=self.restarts)
+
+    def is_alive(self) -> bool:
+        return self.process is not None and self.process.is_alive()
+
+    def is_hung(self, timeout:float) -> bool:
+        return time.time() - self.heartbeat.value > timeout
+
+    def restart_delay(self) -> float:
+        # back off when a process keeps crashing right after starting
+        return min(2 ** min(self.restarts, 6), MAX_RESTART_DELAY)
+
+    def terminate(self) -> None:
+        if self.is_alive():
+            os.kill(self.process.pid, signal.SIGTERM)
+
+    def kill(self) -> None:
+        if self.is_alive():
+            os.kill(self.process.pid, signal.SIGKILL)
+
+
+class SenderSupervisor:
+    """Fork sender processes, restart them when they exit or stop heartbeating,
+    and forward SIGTERM to all of them on shutdown.
+    """
+    def __init__(self, processes:int, sender_kwargs:dict,
+                 heartbeat_timeout:float=HEARTBEAT_TIMEOUT,
+                 drain_timeout:float=30):
+        self.ctx = multiprocessing.get_context('fork')
+        self.heartbeat_timeout = heartbeat_timeout
+        self.drain_timeout = drain_timeout
+        # set by SIGTERM and SIGINT, waits on it return as soon as it is set
+        self.stopping = threading.Event()
+        self.children = [SenderProcess(i, sender_kwargs, self.ctx)
+                         for i in range(processes)]
+
+    def _stop(self, signum, frame) -> None:
+        logger.info('stopping sender processes', signal=signum)
+        self.stopping.set()
+
+    def check(self) -> None:
+        for child in self.children:
+            if not child.is_alive():
+                logger.error('sender process exited', index=child.index,
+                             exitcode=child.process.exitcode)
+            elif child.is_hung(self.heartbeat_timeout):
+                logger.error('sender process stopped heartbeating, killing',
+                             index=child.index, pid=child.process.pid)
+                child.kill()
+                child.process.join()
+            else:
+                continue
+            if time.time() - child.started > MAX_RESTART_DELAY:
+                child.restarts = 0
+            if self.stopping.wait(child.restart_delay()):
+                # shutdown was requested during the backoff
+                return
+            child.restarts += 1
+            child.start()
+
+    def shutdown(self) -> None:
+        for child in self.children:
+            child.terminate()
+        deadline = time.time() + self.drain_timeout + HEARTBEAT_INTERVAL
+        for child in self.children:
+            child.process.join(max(deadline - time.time(), 0))
+            if child.is_alive():
+                logger.warning('sender process did not drain, killing', index=child.index)
+                child.kill()
+                child.process.join()
+        logger.info('sender processes stopped')
+
+    def run(self) -> None:
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        for child in self.children:
+            child.start()
+        while not self.stopping.wait(HEARTBEAT_INTERVAL):
+            self.check()
+        self.shutdown()
+
+
+def supervise(processes:int, drain_timeout:float=30, **sender_kwargs) -> None:
+    sender_kwargs['drain_timeout'] = drain_timeout
+    SenderSupervisor(processes, sender_kwargs, drain_timeout=drain_timeout).run()
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+"""Base class for transports which deliver notifications to a third party"""
+import abc
+
+from yo.json import loads
+
+
+def render_data(notification:dict) -> dict:
+    """A queued notification with its json_data decoded as `data`
+    """
+    data = notification.get('json_data') or '{}'
+    if isinstance(data, (str, bytes)):
+        data = loads(data)
+    return dict(notification, data=data)
+
+
+class BaseTransport(abc.ABC):
+    transport_type = None
+
+    @abc.abstractmethod
+    def send_notification(self, notification, **kwargs):
+        """Render and send a queued notification, blocking
+        """
+
+    @abc.abstractmethod
+    def render(self, notification):
+        """Render the message for a queued notification
+
+        Raises if the notification can't be rendered, so it is never sent
+        empty.
+        """
@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 """ Sendgrid transport class
 """
+import asyncio
+
 import structlog
 import toolz
 from sendgrid import SendGridAPIClient
@@ -8,46 +10,38 @@ from sendgrid.helpers.mail import Content
 from sendgrid.helpers.mail import Email
 from sendgrid.helpers.mail import Mail
 
-from services.notification_sender.email_templates import EmailRenderer
-from .base_transport import BaseTransport
+from yo.db.actions import PermanentFailException
+from yo.db.users import get_user_email
+from yo.schema import TransportType
+from .email_templates import EmailRenderer
+from .email_templates import template_name
+from ..base_transport import BaseTransport
+from ..base_transport import render_data
 
 logger = structlog.getLogger(
     __name__, transport='SendGridTranport', transport_type='email')
 
 
-async def send_email(notification):
-    asyncio.sleep(1)
-
-
-
+async def send_email(transport, notification:dict, to_email:str):
+    # rendering (premailer) and the sendgrid client are blocking
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(None, transport.send_notification,
+                                      notification, to_email)
 
-async def handle_email_transport(pool):
-    conn = await pool.acquire()
-    while True:
-        loop_start = time.perf_counter()
-        # begin transaction
-        transport_type = TransportType['email']
-        loop_start = time.perf_counter()
-        # begin transaction
-        async with QItem(conn, transport_type=transport_type) as item:
-            logger.debug('qitem received', item_str=item)
-            time_to_acquire_item = time.perf_counter() - loop_start
-            rates = await get_rates(conn, item['to_username'],transport_type)
-            if rates or True:
-                user_email = await get_user_email(item['to_username'])
-                result = await send_email(item, user_email)
-                time_to_send = time.perf_counter() - time_to_acquire_item
-                await sent(conn, item['nid'], item['to_username'], transport_type.value)
-                time_to_mark_sent = time.perf_counter() - time_to_send
-            else:
-                time_to_send = 0
-                time_to_mark_sent = 0
 
-        logger.debug('email notification processed',
-                     acquire_item=time_to_acquire_item,
-                     send_item=time_to_send,
-                     mark_sent=time_to_mark_sent,
-                     loop_total=time.perf_counter() - loop_start)
+async def handle_email_transport(pool, item:dict, local_logger=None, transport=None,
+                                 rate_limiter=None):
+    transport_type = TransportType.email
+    user_email = await get_user_email(item['to_username'])
+    if not user_email:
+        raise PermanentFailException()
+    sent_at = await rate_limiter.acquire(item['to_username'], transport_type)
+    try:
+        await send_email(transport, item, user_email)
+    except BaseException:
+        rate_limiter.cancel(item['to_username'], transport_type, sent_at)
+        raise
+    (local_logger or logger).debug('email notification sent')
 
 
 
@@ -76,9 +70,9 @@ class SendGridTransport(BaseTransport):
         logger.info('configured')
 
     # pylint: disable=arguments-differ
-    def send_notification(self, notification):
+    def send_notification(self, notification, to_email=None):
         if self.can_send:
-            to_email = toolz.get_in(notification, ['transports', 'sms', 'subdata'])
+            to_email = to_email or toolz.get_in(notification, ['transports', 'email', 'data'])
             logger.debug('SendGrid sending notification', to_email=to_email)
             from_email = Email('no-reply@steemit.com', 'steemit.com')
 
@@ -107,7 +101,9 @@ class SendGridTransport(BaseTransport):
     # pylint: enable=arguments-differ
     def render(self, notification):
         try:
-            return self.renderer.render(notification['notify_type'], notification)
+            return self.renderer.render(template_name(notification['notify_type']),
+                                        render_data(notification))
         except Exception:
-            logger.exception('Exception occurred when rendering email template')
-            return False
+            logger.exception('unable to render email template',
+                             notify_type=notification['notify_type'])
+            raise
@@ -7,6 +7,8 @@ from jinja2 import Environment
 from jinja2 import FileSystemLoader
 from premailer import transform
 
+from yo.schema import NotificationType
+
 
 class TemplatesMissing(Exception):
     pass
@@ -16,6 +18,12 @@ class MalformedTemplate(Exception):
     pass
 
 
+def template_name(notify_type:int) -> str:
+    """Templates are named after the notification type, like vote.txt
+    """
+    return NotificationType(int(notify_type)).name
+
+
 class EmailRenderer:
     def __init__(self, templates_dir):
         self.env = Environment(loader=FileSystemLoader(templates_dir))
@@ -1,28 +1,59 @@
 # -*- coding: utf-8 -*-
 """Twilio transport, sends sms"""
+import asyncio
 
 import structlog
 import toolz
 from twilio.rest import Client
 
-from .base_transport import BaseTransport
+from yo.db.actions import PermanentFailException
+from yo.db.users import get_user_phone
+from yo.schema import NotificationType
+from yo.schema import TransportType
+from ..base_transport import BaseTransport
+from ..base_transport import render_data
 
 logger = structlog.getLogger(__name__, transport='TwilioTranport', transport_type='sms')
 
-
-
-
-async def handle_sms(conn, item):
-    transport_type = TransportType['sms']
-    rates = await get_rates(conn, item['to_username'], transport_type)
-    if rates or True:
-        user_phone = await get_user_phone(item['to_username'])
-        result = await send_sms(item, user_phone)
-        await sent(conn, item['nid'], item['to_username'], transport_type.value)
-        time_to_mark_sent = time.perf_counter() - time_to_send
-    else:
-        time_to_send = 0
-        time_to_mark_sent = 0
+POST_URL = 'https://steemit.com/@{data[author]}/{data[permlink]}'
+
+# formatted with the queued notification, json_data is decoded as data
+SMS_MESSAGES = {
+    NotificationType.power_down:     'Steemit: a power down of {data[vesting_shares]} '
+                                     'started on @{to_username}',
+    NotificationType.resteem:        'Steemit: @{from_username} resteemed your post ' + POST_URL,
+    NotificationType.send:           'Steemit: you sent {data[amount]} to @{data[to]}',
+    NotificationType.mention:        'Steemit: @{from_username} mentioned you in ' + POST_URL,
+    NotificationType.follow:         'Steemit: @{from_username} followed you',
+    NotificationType.vote:           'Steemit: @{from_username} voted on ' + POST_URL,
+    NotificationType.comment_reply:  'Steemit: @{from_username} replied to your comment '
+                                     + POST_URL,
+    NotificationType.post_reply:     'Steemit: @{from_username} replied to your post ' + POST_URL,
+    NotificationType.account_update: 'Steemit: the account @{to_username} was updated',
+    NotificationType.receive:        'Steemit: you received {data[amount]} from @{data[from]}'
+}
+
+
+async def send_sms(transport, notification:dict, to_number:str):
+    # the twilio client is blocking
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(None, transport.send_notification,
+                                      notification, to_number)
+
+
+async def handle_sms(pool, item:dict, local_logger=None, transport=None,
+                     rate_limiter=None):
+    transport_type = TransportType.sms
+    user_phone = await get_user_phone(item['to_username'])
+    if not user_phone:
+        raise PermanentFailException()
+    sent_at = await rate_limiter.acquire(item['to_username'], transport_type)
+    try:
+        await send_sms(transport, item, user_phone)
+    except BaseException:
+        rate_limiter.cancel(item['to_username'], transport_type, sent_at)
+        raise
+    (local_logger or logger).debug('sms notification sent')
 
 
 
@@ -49,8 +80,8 @@ class TwilioTransport(BaseTransport):
         logger.info('configured')
 
     # pylint: disable=arguments-differ
-    def send_notification(self, notification):
-        to_sms_number = toolz.get_in(notification, ['transports', 'sms', 'subdata'])
+    def send_notification(self, notification, to_sms_number=None):
+        to_sms_number = to_sms_number or toolz.get_in(notification, ['transports', 'sms', 'data'])
         notify_type = notification['notify_type']
         logger.debug(
             'send_notifiction', notify_type=notify_type, to_sms_number=to_sms_number)
@@ -66,4 +97,9 @@ class TwilioTransport(BaseTransport):
     # pylint: enable=arguments-differ
 
     def render(self, notification):
-        raise NotImplementedError()
+        notify_type = NotificationType(int(notification['notify_type']))
+        try:
+            return SMS_MESSAGES[notify_type].format(**render_data(notification))
+        except Exception:
+            logger.exception('unable to render sms', notify_type=notify_type.name)
+            raise
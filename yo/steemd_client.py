@@ -0,0 +1,107 @@
+# coding=utf-8
+import asyncio
+
+import aiohttp
+import structlog
+from funcy import chunks
+
+from yo.json import loads
+from yo.json import dumps
+
+logger = structlog.getLogger(__name__, source='steemd_client')
+
+
+class SteemdRPCError(Exception):
+    pass
+
+
+class AsyncSteemd:
+    """JSON-RPC client for steemd using one pooled keep-alive aiohttp session
+
+    Range methods send their calls as JSON-RPC batch requests of at most
+    `max_batch_size` calls each.
+    """
+    def __init__(self,
+                 url:str='https://api.steemit.com',
+                 max_connections:int=20,
+                 max_batch_size:int=50,
+                 timeout:float=30,
+                 loop=None):
+        self.url = url
+        self.max_connections = max_connections
+        self.max_batch_size = max_batch_size
+        self.timeout = timeout
+        self.loop = loop or asyncio.get_event_loop()
+        self._session = None
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.max_connections,
+                                             ttl_dns_cache=300,
+                                             keepalive_timeout=60,
+                                             loop=self.loop)
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                json_serialize=dumps,
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+                loop=self.loop)
+        return self._session
+
+    async def close(self) -> None:
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def _post(self, payload):
+        async with self.session.post(self.url, json=payload) as resp:
+            return await resp.json(loads=loads, content_type=None)
+
+    async def call(self, method:str, params:list=None):
+        request = {'id': 1, 'jsonrpc': '2.0', 'method': method, 'params': params or []}
+        response = await self._post(request)
+        if 'error' in response:
+            raise SteemdRPCError(response['error'])
+        return response['result']
+
+    async def batch(self, calls:list) -> list:
+        """Send (method, params) calls as batch requests, results are returned in order
+        """
+        results = []
+        for calls_chunk in chunks(self.max_batch_size, calls):
+            requests = [{'id': i, 'jsonrpc': '2.0', 'method': method, 'params': params}
+                        for i, (method, params) in enumerate(calls_chunk)]
+            responses = await self._post(requests)
+            if isinstance(responses, dict):
+                # the whole batch was rejected
+                raise SteemdRPCError(responses.get('error', responses))
+            for response in sorted(responses, key=lambda r: r['id']):
+                if 'error' in response:
+                    raise SteemdRPCError(response['error'])
+                results.append(response['result'])
+        return results
+
+    async def get_dynamic_global_properties(self) -> dict:
+        return await self.call('condenser_api.get_dynamic_global_properties')
+
+    async def get_current_block_num(self) -> int:
+        props = await self.get_dynamic_global_properties()
+        return props['last_irreversible_block_num']
+
+    async def get_blocks(self, block_nums:list) -> list:
+        return await self.batch(
+            [('condenser_api.get_block', [block_num]) for block_num in block_nums])
+
+    async def get_ops_in_blocks(self, block_nums:list, virtual_only:bool=False) -> list:
+        return await self.batch(
+            [('condenser_api.get_ops_in_block', [block_num, virtual_only])
+             for block_num in block_nums])
+
+    async def get_blocks_ops(self, block_nums:list) -> list:
+        ops = []
+        for block_ops in await self.get_ops_in_blocks(block_nums):
+            ops.extend(block_ops)
+        return ops
+
+    async def get_content(self, author:str, permlink:str) -> dict:
+        return await self.call('condenser_api.get_content', [author, permlink])